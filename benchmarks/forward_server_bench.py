@@ -0,0 +1,362 @@
+"""Throughput benchmark for ForwardServer.
+
+Streams a block of data through an echo-mode ForwardServer and reports the
+throughput for each instrumentation configuration. The uninstrumented
+configuration (observer=None) is the reference; its loop carries no per-chunk
+instrumentation, so the no-op observer's overhead relative to it is the cost
+of the hooks alone.
+
+Then streams text through a compressed tunnel (a TUNNEL_COMPRESS forwarder in
+front of a TUNNEL_DECOMPRESS echo forwarder) for each available codec and
+reports throughput, compression ratio, codec CPU time and added latency.
+
+Then streams data from a chargen BenchServer through a forwarder, which is
+the bottleneck, since the BenchServer saturates loopback on its own.
+
+Finally, streams small messages, one send each and paced a few microseconds
+apart, through a forwarder in front of an echo BenchServer, with and without
+write coalescing, and reports the forwarder's syscalls per MB (receives,
+sends, and the coalescing stage's readiness waits and empty receives), TCP
+segments per message (all hops, from the host-wide /proc/net/snmp counters, so
+run it on an otherwise quiet host) and ping-pong round-trip latency
+percentiles. Coalescing holds each direction's chunks for at most the hold
+time, so the p99 round trip may exceed the uncoalesced one by at most twice
+the hold time; the benchmark exits with status 1 when it does.
+
+Last, streams data over many concurrent sessions through an echo forwarder
+with each concurrency model (a thread per session, worker processes, and
+event-loop shards) and reports aggregate throughput. Sharded event loops only
+scale past one core on an interpreter without a GIL; the report says whether
+the running interpreter has one.
+
+Usage:
+    python benchmarks/forward_server_bench.py [--megabytes N] [--rounds N]
+                                              [--messages N] [--pace-usec N]
+                                              [--coalesce-hold-usec N]
+                                              [--parallel-sessions N]
+                                              [--parallelism N]
+"""
+from __future__ import print_function
+
+import argparse
+import ctypes
+import multiprocessing
+import platform
+import socket
+import sys
+import threading
+import time
+
+from inetpy.bench_server import BenchServer
+from inetpy.forward_server import ForwardServer
+from inetpy.forward_stats import ForwardObserver, HistogramObserver
+from inetpy.tunnel_codec import available_codecs
+
+
+
+def _stream_through(server_address, payload, total_bytes):
+    """Send total_bytes through the echo forwarder and read them back
+
+    :returns: elapsed seconds
+    """
+    sock = socket.socket()
+    sock.connect(server_address)
+
+    def produce():
+        sent = 0
+        while sent < total_bytes:
+            sock.sendall(payload)
+            sent += len(payload)
+        sock.shutdown(socket.SHUT_WR)
+
+    start = time.time()
+    producer = threading.Thread(target=produce)
+    producer.start()
+
+    received = 0
+    while True:
+        data = sock.recv(64 * 1024)
+        if not data:
+            break
+        received += len(data)
+
+    elapsed = time.time() - start
+    producer.join()
+    sock.close()
+    assert received >= total_bytes, (received, total_bytes)
+    return elapsed
+
+
+
+def _measure(observer, total_bytes, rounds):
+    """:returns: best throughput, in MB/s, over the given number of rounds"""
+    payload = b"x" * (64 * 1024)
+    best = None
+    with ForwardServer(None, observer=observer) as fwd:
+        for _ in range(rounds):
+            elapsed = _stream_through(fwd.server_address, payload, total_bytes)
+            best = elapsed if best is None else min(best, elapsed)
+
+    return total_bytes / best / 1e6
+
+
+
+def _measure_source(server_address, total_bytes):
+    """:returns: throughput, in MB/s, of receiving total_bytes"""
+    sock = socket.socket()
+    sock.connect(server_address)
+    start = time.time()
+    received = 0
+    while received < total_bytes:
+        data = sock.recv(256 * 1024)
+        assert data, "Source closed the connection"
+        received += len(data)
+    elapsed = time.time() - start
+    sock.close()
+    return received / elapsed / 1e6
+
+
+
+def _measure_tunnel(codec, total_bytes, rounds):
+    """:returns: (best throughput in MB/s, compressing forwarder's stats)"""
+    line = b"2016-01-01 12:00:00 INFO connection accepted from 10.0.0.1\n"
+    payload = line * (64 * 1024 // len(line))
+    best = None
+    with ForwardServer(None, tunnel=ForwardServer.TUNNEL_DECOMPRESS) as peer:
+        with ForwardServer(peer.server_address,
+                           tunnel=ForwardServer.TUNNEL_COMPRESS,
+                           tunnel_codec=codec) as fwd:
+            for _ in range(rounds):
+                elapsed = _stream_through(fwd.server_address, payload,
+                                          total_bytes)
+                best = elapsed if best is None else min(best, elapsed)
+
+    return total_bytes / best / 1e6, fwd.stats
+
+
+
+class _SyscallCountingObserver(ForwardObserver):
+    """Counts the forwarder's receives and sends in shared memory"""
+
+    def __init__(self):
+        self.receives = multiprocessing.Value(ctypes.c_longlong, 0)
+        self.sends = multiprocessing.Value(ctypes.c_longlong, 0)
+
+
+    def chunk_received(self, session_id, direction, nbytes, elapsed):
+        with self.receives.get_lock():
+            self.receives.value += 1
+
+
+    def chunk_sent(self, session_id, direction, nbytes, elapsed):
+        with self.sends.get_lock():
+            self.sends.value += 1
+
+
+
+def _tcp_out_segments():
+    """:returns: host-wide count of TCP segments sent, from /proc/net/snmp"""
+    with open("/proc/net/snmp") as snmp_file:
+        names, values = [line.split() for line in snmp_file
+                         if line.startswith("Tcp:")]
+    return int(values[names.index("OutSegs")])
+
+
+
+def _percentile(sorted_values, percent):
+    """:returns: the value at the given percentile of a sorted sequence"""
+    index = int(round((len(sorted_values) - 1) * percent / 100.0))
+    return sorted_values[index]
+
+
+
+def _stream_messages(server_address, message, count, pace):
+    """Send count messages, one send each, pace seconds apart, while reading
+    back the echoes
+    """
+    sock = socket.socket()
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.connect(server_address)
+
+    def produce():
+        for _ in range(count):
+            sock.sendall(message)
+            # NOTE: spin, since sleeps this short are too coarse
+            deadline = time.time() + pace
+            while time.time() < deadline:
+                pass
+        sock.shutdown(socket.SHUT_WR)
+
+    producer = threading.Thread(target=produce)
+    producer.start()
+
+    received = 0
+    while True:
+        data = sock.recv(64 * 1024)
+        if not data:
+            break
+        received += len(data)
+
+    producer.join()
+    sock.close()
+    assert received == len(message) * count, (received, count)
+
+
+
+def _ping_pong(server_address, message, count):
+    """:returns: sorted list of round-trip times, in seconds"""
+    sock = socket.socket()
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.connect(server_address)
+
+    rtts = []
+    for _ in range(count):
+        start = time.time()
+        sock.sendall(message)
+        received = 0
+        while received < len(message):
+            data = sock.recv(len(message) - received)
+            assert data, "Session closed by forwarder"
+            received += len(data)
+        rtts.append(time.time() - start)
+
+    sock.close()
+    rtts.sort()
+    return rtts
+
+
+
+def _measure_coalescing(hold_time, messages, pace):
+    """:returns: (syscalls per MB, segments per message, sorted rtts)"""
+    message = b"m" * 64
+    observer = _SyscallCountingObserver()
+    with BenchServer(BenchServer.MODE_ECHO) as echo:
+        # NOTE: with an observer, coalesced chunks are joined and sent with
+        # one sendall instead of sendmsg, which takes the same one syscall
+        with ForwardServer(echo.server_address, observer=observer,
+                           coalesce_hold_time=hold_time) as fwd:
+            segments_before = _tcp_out_segments()
+            _stream_messages(fwd.server_address, message, messages, pace)
+            segments = _tcp_out_segments() - segments_before
+            polls = fwd.stats["coalesce_polls"]
+
+        with ForwardServer(echo.server_address,
+                           coalesce_hold_time=hold_time) as fwd:
+            rtts = _ping_pong(fwd.server_address, message,
+                              min(messages, 2000))
+
+    megabytes = 2.0 * len(message) * messages / 1e6
+    syscalls = observer.receives.value + observer.sends.value + polls
+    return syscalls / megabytes, float(segments) / messages, rtts
+
+
+
+def _measure_concurrency(server_kwargs, sessions, total_bytes, rounds):
+    """:returns: best aggregate throughput, in MB/s, of streaming total_bytes
+    split evenly over the given number of concurrent sessions
+    """
+    payload = b"x" * (64 * 1024)
+    per_session = total_bytes // sessions
+    best = None
+    with ForwardServer(None, **server_kwargs) as fwd:
+        for _ in range(rounds):
+            streams = [threading.Thread(target=_stream_through,
+                                        args=(fwd.server_address, payload,
+                                              per_session))
+                       for _ in range(sessions)]
+            start = time.time()
+            for stream in streams:
+                stream.start()
+            for stream in streams:
+                stream.join()
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+    return per_session * sessions / best / 1e6
+
+
+
+def main():
+    """Benchmark entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--megabytes", type=int, default=256)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--messages", type=int, default=20000,
+                        help="number of small messages for coalescing")
+    parser.add_argument("--pace-usec", type=int, default=50,
+                        help="interval between the small messages")
+    parser.add_argument("--coalesce-hold-usec", type=int, default=200)
+    parser.add_argument("--parallel-sessions", type=int, default=64,
+                        help="number of concurrent streaming sessions")
+    parser.add_argument("--parallelism", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="worker processes or event-loop shards")
+    args = parser.parse_args()
+
+    total_bytes = args.megabytes * 1000 * 1000
+
+    reference = _measure(None, total_bytes, args.rounds)
+    print("observer=None               %8.1f MB/s" % (reference,))
+
+    for label, observer in (("ForwardObserver (no-op)", ForwardObserver()),
+                            ("HistogramObserver", HistogramObserver())):
+        rate = _measure(observer, total_bytes, args.rounds)
+        print("%-27s %8.1f MB/s  overhead %5.1f%%"
+              % (label, rate, 100.0 * (reference - rate) / reference))
+
+    with BenchServer(BenchServer.MODE_CHARGEN) as chargen:
+        direct = max(_measure_source(chargen.server_address, total_bytes)
+                     for _ in range(args.rounds))
+        with ForwardServer(chargen.server_address) as fwd:
+            forwarded = max(_measure_source(fwd.server_address, total_bytes)
+                            for _ in range(args.rounds))
+    print("chargen BenchServer direct  %8.1f MB/s" % (direct,))
+    print("  through ForwardServer     %8.1f MB/s" % (forwarded,))
+
+    for codec in available_codecs():
+        rate, stats = _measure_tunnel(codec, total_bytes, args.rounds)
+        print("tunnel %-20s %8.1f MB/s  ratio %.3f  codec cpu %.2fs  "
+              "mean hold %.0f usec"
+              % (codec, rate, stats["tunnel_compression_ratio"],
+                 stats["tunnel_codec_usec"] / 1e6,
+                 stats["tunnel_mean_hold_usec"]))
+
+    hold_time = args.coalesce_hold_usec / 1e6
+    p99s = []
+    for label, coalesce_hold_time in (("no coalescing", None),
+                                      ("coalescing", hold_time)):
+        syscalls_per_mb, segments_per_message, rtts = _measure_coalescing(
+            coalesce_hold_time, args.messages, args.pace_usec / 1e6)
+        p99s.append(_percentile(rtts, 99))
+        print("%-27s %8.0f syscalls/MB  %.2f segments/message  "
+              "rtt p50/p99 %.0f / %.0f usec"
+              % (label, syscalls_per_mb, segments_per_message,
+                 1e6 * _percentile(rtts, 50), 1e6 * p99s[-1]))
+    added_p99 = p99s[1] - p99s[0]
+    hold_bound_exceeded = added_p99 > 2 * hold_time
+    print("%-27s p99 rtt increase %.0f usec, bound %.0f usec%s"
+          % ("", 1e6 * added_p99, 2e6 * hold_time,
+             "  EXCEEDED" if hold_bound_exceeded else ""))
+
+    gil = getattr(sys, "_is_gil_enabled", lambda: True)()
+    print("%s %s, GIL %s, %d CPUs"
+          % (platform.python_implementation(), platform.python_version(),
+             "enabled" if gil else "disabled", multiprocessing.cpu_count()))
+    for label, server_kwargs in (
+            ("thread per session", {}),
+            ("%d worker processes" % (args.parallelism,),
+             dict(worker_processes=args.parallelism)),
+            ("%d event-loop shards" % (args.parallelism,),
+             dict(event_loop_shards=args.parallelism))):
+        rate = _measure_concurrency(server_kwargs, args.parallel_sessions,
+                                    total_bytes, args.rounds)
+        print("%-27s %8.1f MB/s over %d sessions"
+              % (label, rate, args.parallel_sessions))
+
+    if hold_bound_exceeded:
+        sys.exit(1)
+
+
+
+if __name__ == "__main__":
+    main()
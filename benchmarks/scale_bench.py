@@ -0,0 +1,245 @@
+"""Scale harness for ForwardServer.
+
+Opens and holds many concurrent sessions through a forwarder, trickles small
+messages over all of them and reports, for the forwarding subprocess, memory
+per session while the sessions are idle and after they have carried traffic,
+file descriptor and thread usage, plus round-trip tail latency. Sessions
+refused by the forwarder's file descriptor budget are counted and left out of
+the per-session figures.
+
+In "echo" mode the forwarder echoes; in "forward" mode it forwards to an
+echo-mode BenchServer, whose resources are not included.
+
+Linux only: resource usage is read from /proc.
+
+Usage:
+    python benchmarks/scale_bench.py [--sessions N] [--mode echo|forward|both]
+                                     [--rounds N] [--max-open-files N]
+                                     [--worker-processes N]
+                                     [--thread-stack-kib N]
+                                     [--event-loop-shards N]
+"""
+from __future__ import print_function
+
+import argparse
+import errno
+import os
+import resource
+import socket
+import time
+
+from inetpy.bench_server import BenchServer
+from inetpy.forward_server import ForwardServer
+
+
+# Seconds to wait for the forwarder to account for every new session
+_SETTLE_TIMEOUT = 60
+
+
+
+def _proc_status(pid):
+    """:returns: dict of the fields of /proc/<pid>/status"""
+    status = {}
+    with open("/proc/%d/status" % (pid,)) as status_file:
+        for line in status_file:
+            name, _, value = line.partition(":")
+            status[name] = value.strip()
+    return status
+
+
+
+def _usage(pid):
+    """:returns: (rss_kib, vsz_kib, open_fds, threads) of the given process
+    and its worker processes, if any
+    """
+    children_path = "/proc/%d/task/%d/children" % (pid, pid)
+    pids = [pid]
+    if os.path.exists(children_path):
+        with open(children_path) as children_file:
+            pids.extend(int(child) for child in children_file.read().split())
+
+    rss = vsz = fds = threads = 0
+    for each in pids:
+        status = _proc_status(each)
+        rss += int(status["VmRSS"].split()[0])
+        vsz += int(status["VmSize"].split()[0])
+        fds += len(os.listdir("/proc/%d/fd" % (each,)))
+        threads += int(status["Threads"])
+
+    return rss, vsz, fds, threads
+
+
+
+def _percentile(sorted_values, percent):
+    """:returns: the value at the given percentile of a sorted sequence"""
+    index = int(round((len(sorted_values) - 1) * percent / 100.0))
+    return sorted_values[index]
+
+
+
+def _open_sessions(server_address, count):
+    """:returns: list of connected sockets"""
+    socks = []
+    for _ in range(count):
+        sock = socket.socket()
+        sock.connect(server_address)
+        sock.settimeout(30)
+        socks.append(sock)
+    return socks
+
+
+
+def _settle(fwd, sessions):
+    """Wait until the forwarder has either started or refused every session
+
+    :returns: the forwarder's stats; short of sessions if the wait timed out
+    """
+    deadline = time.time() + _SETTLE_TIMEOUT
+    while True:
+        stats = fwd.stats
+        if (stats["active_sessions"] + stats["refused_fd_budget"] +
+                stats["refused_fd_exhausted"]) >= sessions:
+            return stats
+        if time.time() >= deadline:
+            print("Gave up waiting for sessions after %ds: %d of %d active, "
+                  "%d refused by fd budget, %d refused on fd exhaustion"
+                  % (_SETTLE_TIMEOUT, stats["active_sessions"], sessions,
+                     stats["refused_fd_budget"],
+                     stats["refused_fd_exhausted"]))
+            return stats
+        time.sleep(0.1)
+
+
+
+def _live_sessions(socks):
+    """Close the sessions that the forwarder has closed, e.g. refused
+
+    :returns: list of the remaining sockets
+    """
+    live = []
+    for sock in socks:
+        timeout = sock.gettimeout()
+        sock.setblocking(False)
+        try:
+            closed = not sock.recv(1)
+        except socket.error as exc:
+            closed = exc.errno not in (errno.EAGAIN, errno.EWOULDBLOCK)
+        sock.settimeout(timeout)
+
+        if closed:
+            sock.close()
+        else:
+            live.append(sock)
+    return live
+
+
+
+def _trickle(socks, rounds):
+    """Send a small message over every session per round and wait for its echo
+
+    :returns: sorted list of round-trip times, in seconds
+    """
+    message = b"0123456789abcdef"
+    rtts = []
+    for _ in range(rounds):
+        for sock in socks:
+            start = time.time()
+            sock.sendall(message)
+            received = 0
+            while received < len(message):
+                data = sock.recv(len(message) - received)
+                if not data:
+                    raise RuntimeError("Session closed by forwarder")
+                received += len(data)
+            rtts.append(time.time() - start)
+
+    rtts.sort()
+    return rtts
+
+
+
+def _run(label, fwd, sessions, rounds):
+    """Open sessions through fwd, trickle traffic and print the report"""
+    rss_before, vsz_before, fds_before, threads_before = _usage(fwd.pid)
+
+    start = time.time()
+    socks = _open_sessions(fwd.server_address, sessions)
+    open_elapsed = time.time() - start
+    try:
+        # Let the forwarder catch up with the backlog of new sessions
+        settled_stats = _settle(fwd, sessions)
+        socks = _live_sessions(socks)
+        rss_idle, vsz_idle, _, _ = _usage(fwd.pid)
+
+        rtts = _trickle(socks, rounds) if socks else None
+        rss_after, _, fds_after, threads_after = _usage(fwd.pid)
+        stats = fwd.stats
+    finally:
+        for sock in socks:
+            sock.close()
+
+    print("%s: %d sessions opened in %.1fs, %d live, %d refused by fd budget"
+          % (label, sessions, open_elapsed, len(socks),
+             settled_stats["refused_fd_budget"]))
+    if not socks:
+        print("  stats           %r" % (stats,))
+        return
+
+    print("  memory/session  %8.1f KiB idle, %.1f KiB after traffic"
+          % (float(rss_idle - rss_before) / len(socks),
+             float(rss_after - rss_before) / len(socks)))
+    print("  address space/session  %8.1f KiB idle"
+          % (float(vsz_idle - vsz_before) / len(socks),))
+    print("  fds             %8d (%d before)" % (fds_after, fds_before))
+    print("  threads         %8d (%d before)" % (threads_after, threads_before))
+    print("  rtt p50/p99/p99.9/max  %.3f / %.3f / %.3f / %.3f ms"
+          % tuple(1000 * value for value in (
+              _percentile(rtts, 50), _percentile(rtts, 99),
+              _percentile(rtts, 99.9), rtts[-1])))
+    print("  stats           %r" % (stats,))
+
+
+
+def main():
+    """Harness entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=10000)
+    parser.add_argument("--mode", choices=["echo", "forward", "both"],
+                        default="both")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--max-open-files", type=int, default=65536)
+    parser.add_argument("--worker-processes", type=int, default=None,
+                        help="hand sessions off to this many worker processes")
+    parser.add_argument("--thread-stack-kib", type=int, default=None,
+                        help="stack size of the forwarder's threads")
+    parser.add_argument("--event-loop-shards", type=int, default=None,
+                        help="serve sessions on this many event-loop threads")
+    args = parser.parse_args()
+
+    server_kwargs = dict(
+        max_open_files=args.max_open_files,
+        worker_processes=args.worker_processes,
+        thread_stack_size=(args.thread_stack_kib * 1024
+                           if args.thread_stack_kib else None),
+        event_loop_shards=args.event_loop_shards)
+
+    # This process holds one descriptor per session, too, even when the
+    # forwarder's budget is smaller and refuses some of them
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE,
+                       (min(max(args.max_open_files, args.sessions + 64), hard),
+                        hard))
+
+    if args.mode in ("echo", "both"):
+        with ForwardServer(None, **server_kwargs) as fwd:
+            _run("echo", fwd, args.sessions, args.rounds)
+
+    if args.mode in ("forward", "both"):
+        with BenchServer(BenchServer.MODE_ECHO) as target:
+            with ForwardServer(target.server_address, **server_kwargs) as fwd:
+                _run("forward", fwd, args.sessions, args.rounds)
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,625 @@
+"""Multi-connection echo, discard and chargen server for load testing.
+
+A single non-blocking event loop serves any number of connections: "echo"
+sends everything back, "discard" sinks everything, and "chargen" sends the
+RFC 864 character pattern until the peer goes away. Large buffers and no
+per-chunk copies in the common case let it saturate loopback, so that the
+forwarder under test, not the target, is the bottleneck.
+
+Usage:
+    python -m inetpy.bench_server [--mode echo|discard|chargen] [--host HOST]
+                                  [--port N] [--report-interval SECONDS]
+
+Or from code, in a subprocess:
+
+    with BenchServer(BenchServer.MODE_DISCARD) as target:
+        with ForwardServer(target.server_address) as fwd:
+            ...
+        print(target.stats["bytes_received"])
+"""
+from __future__ import print_function
+
+import argparse
+from datetime import datetime
+import errno
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+
+from inetpy.forward_stats import _SharedCounters
+from inetpy.poller import EVENT_ERROR, EVENT_READ, EVENT_WRITE, create_poller
+
+
+
+MODE_ECHO = "echo"
+MODE_DISCARD = "discard"
+MODE_CHARGEN = "chargen"
+
+MODES = (MODE_ECHO, MODE_DISCARD, MODE_CHARGEN)
+
+# Names of the counters exposed via BenchServer.stats
+_COUNTER_NAMES = (
+    "connections_accepted",
+    "active_connections",
+    "connections_shed",
+    "bytes_received",
+    "bytes_sent",
+)
+
+# Size of the loop's receive buffer and of chargen's sends
+_IO_CHUNK_SIZE = 256 * 1024
+
+# Maximum connections accepted per listener readiness event
+_ACCEPT_BATCH = 64
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+_PEER_GONE = (errno.ECONNRESET, errno.EPIPE)
+
+
+
+def _trace(fmt, *args):
+    """Format and output the text to stderr"""
+    print((fmt % args) + "\n", end="", file=sys.stderr)
+
+
+
+def _chargen_pattern():
+    """:returns: one period of the RFC 864 pattern: 95 lines of 72
+    printable characters, each line starting one character further along
+    """
+    printable = bytearray(range(32, 127))
+    lines = []
+    for first in range(len(printable)):
+        rotated = printable[first:] + printable[:first]
+        lines.append(bytes((rotated * 2)[:72]) + b"\r\n")
+    return b"".join(lines)
+
+
+
+class BenchServer(object):
+    """ Runs an echo, discard or chargen event loop in a subprocess. Stops
+    when the context exits; all of its connections are dropped then.
+    """
+    # Amount of time, in seconds, we're willing to wait for the subprocess
+    _SUBPROC_TIMEOUT = 10
+
+    MODE_ECHO = MODE_ECHO
+    MODE_DISCARD = MODE_DISCARD
+    MODE_CHARGEN = MODE_CHARGEN
+
+
+    def __init__(self,
+                 mode=MODE_ECHO,
+                 server_addr=("127.0.0.1", 0),
+                 server_addr_family=socket.AF_INET,
+                 report_interval=None):
+        """
+        :param str mode: MODE_ECHO (default), MODE_DISCARD or MODE_CHARGEN
+        :param server_addr: address for binding the listening socket; the
+          format depends on server_addr_family; defaults to ("127.0.0.1", 0)
+        :param server_addr_family: socket.AF_INET (the default),
+          socket.AF_INET6 or socket.AF_UNIX
+        :param float report_interval: when not None, the subprocess prints
+          throughput and connection counts to stdout this often, in seconds
+        """
+        assert mode in MODES, mode
+
+        self._logger = logging.getLogger(__name__)
+
+        self._mode = mode
+        self._server_addr = server_addr
+        self._server_addr_family = server_addr_family
+        self._report_interval = report_interval
+
+        # NOTE: allocated here so that the subprocess inherits them
+        self._counters = _SharedCounters(_COUNTER_NAMES)
+
+        self._subproc = None
+
+
+    @property
+    def running(self):
+        """Property: True if BenchServer is active"""
+        return self._subproc is not None
+
+    @property
+    def pid(self):
+        """Property: process id of the subprocess; None if not running"""
+        return self._subproc.pid if self._subproc is not None else None
+
+    @property
+    def server_address_family(self):
+        """Property: Get listening socket's address family"""
+        return self._server_addr_family
+
+    @property
+    def server_address(self):
+        """ Property: Get listening socket's address; the returned value
+        depends on the listening socket's address family
+
+        NOTE: undefined before server starts
+        """
+        return self._server_addr
+
+    @property
+    def stats(self):
+        """ Property: Get a snapshot of the counters accumulated since the
+        BenchServer instance was created
+
+        :returns: dict of counter name to value
+        :rtype: dict
+        """
+        return self._counters.snapshot()
+
+
+    def __enter__(self):
+        """ Context manager entry. Starts the server
+
+        :returns: self
+        """
+        return self.start()
+
+
+    def __exit__(self, *args):
+        """ Context manager exit; stops the server
+        """
+        self.stop()
+
+
+    def start(self):
+        """ Start the server
+
+        NOTE: The context manager is the recommended way to use BenchServer.
+        start()/stop() are alternatives to the context manager use case and
+        are mutually exclusive with it.
+
+        :returns: self
+        """
+        queue = multiprocessing.Queue()
+
+        self._subproc = multiprocessing.Process(
+            target=_run_server,
+            kwargs=dict(
+                mode=self._mode,
+                server_addr=self._server_addr,
+                server_addr_family=self._server_addr_family,
+                report_interval=self._report_interval,
+                counters=self._counters,
+                queue=queue))
+        self._subproc.daemon = True
+        self._subproc.start()
+
+        try:
+            # Get server socket info from subprocess
+            self._server_addr = queue.get(block=True,
+                                          timeout=self._SUBPROC_TIMEOUT)
+        except Exception: # pylint: disable=W0703
+            try:
+                self._logger.exception(
+                    "Failed while waiting for listening socket info")
+                # Preserve primary exception and traceback
+                raise
+            finally:
+                try:
+                    self.stop()
+                except Exception: # pylint: disable=W0703
+                    # Suppress secondary exception in favor of the primary
+                    self._logger.exception(
+                        "Emergency subprocess shutdown failed")
+
+        return self
+
+
+    def stop(self):
+        """Stop the server"""
+        try:
+            self._subproc.terminate()
+            self._subproc.join(timeout=self._SUBPROC_TIMEOUT)
+            if self._subproc.is_alive():
+                self._logger.error(
+                    "BenchServer failed to terminate, killing it")
+                os.kill(self._subproc.pid, signal.SIGKILL)
+                self._subproc.join(timeout=self._SUBPROC_TIMEOUT)
+        finally:
+            self._subproc = None
+
+
+
+def _run_server(mode, server_addr, server_addr_family, report_interval,  # pylint: disable=R0913
+                counters, queue):
+    """ Run the event loop; executed in the subprocess
+
+    :param multiprocessing.Queue queue: queue for depositing the listening
+        socket's bound address. The parent process waits for this.
+    """
+    serve(mode,
+          server_addr,
+          server_addr_family=server_addr_family,
+          report_interval=report_interval,
+          counters=counters,
+          listening_callback=queue.put)
+
+
+
+def serve(mode, server_addr, server_addr_family=socket.AF_INET,  # pylint: disable=R0913
+          report_interval=None, counters=None, listening_callback=None):
+    """ Run the event loop in the current process until interrupted
+
+    :param str mode: MODE_ECHO, MODE_DISCARD or MODE_CHARGEN
+    :param server_addr: address for binding the listening socket
+    :param server_addr_family: listening socket's address family
+    :param float report_interval: when not None, print throughput and
+        connection counts to stdout this often, in seconds
+    :param _SharedCounters counters: optional counters with the
+        `_COUNTER_NAMES` to publish to
+    :param listening_callback: optional callable of (bound_address) called
+        once the server is listening
+    """
+    listener = socket.socket(server_addr_family, socket.SOCK_STREAM)
+    try:
+        if server_addr_family != getattr(socket, "AF_UNIX", None):
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(server_addr)
+        listener.listen(socket.SOMAXCONN)
+        listener.setblocking(False)
+
+        if listening_callback is not None:
+            listening_callback(listener.getsockname())
+
+        _EventLoop(mode, listener, counters).run(report_interval)
+    finally:
+        listener.close()
+
+
+
+class _Connection(object):
+    """State of one connection of the event loop"""
+
+    __slots__ = ("sock", "pending", "offset")
+
+    def __init__(self, sock):
+        self.sock = sock
+        # Echo: data yet to be sent back, starting at `offset`
+        # Chargen: position in the pattern, in `offset`
+        self.pending = None
+        self.offset = 0
+
+
+
+class _EventLoop(object):
+    """Single-threaded, level-triggered event loop serving one mode"""
+
+    def __init__(self, mode, listener, counters):
+        """
+        :param str mode: MODE_ECHO, MODE_DISCARD or MODE_CHARGEN
+        :param socket.socket listener: non-blocking listening socket
+        :param _SharedCounters counters: counters to publish to; None if not
+            needed
+        """
+        self._mode = mode
+        self._listener = listener
+        self._counters = counters
+
+        self._poller = create_poller()
+        self._connections = dict()
+
+        # NOTE: held for shedding a pending connection when accept fails for
+        # lack of descriptors; None while it can't be reopened
+        self._spare_fd = os.open(os.devnull, os.O_RDONLY)
+        self._listening = True
+
+        # NOTE: single-threaded, so one buffer serves all connections
+        self._rx_buf = bytearray(_IO_CHUNK_SIZE)
+        self._rx_view = memoryview(self._rx_buf)
+
+        if mode == MODE_CHARGEN:
+            period = _chargen_pattern()
+            # NOTE: enough repetitions for a full chunk from any offset in
+            # the period, so that sends slice it without copying
+            repeat = _IO_CHUNK_SIZE // len(period) + 2
+            self._pattern_period = len(period)
+            self._pattern_view = memoryview(period * repeat)
+
+        # Totals and the amounts not yet published to the shared counters
+        self._totals = dict((name, 0) for name in _COUNTER_NAMES)
+        self._unpublished = dict(self._totals)
+
+
+    def run(self, report_interval):
+        """Serve until interrupted
+
+        :param float report_interval: seconds between reports to stdout; None
+            for no reports
+        """
+        self._poller.register(self._listener.fileno(), EVENT_READ)
+
+        if self._mode == MODE_ECHO:
+            handle = self._on_echo_event
+        elif self._mode == MODE_DISCARD:
+            handle = self._on_discard_event
+        else:
+            handle = self._on_chargen_event
+
+        listener_fd = self._listener.fileno()
+        next_report = (time.time() + report_interval
+                       if report_interval is not None else None)
+        reported = dict(self._totals)
+
+        try:
+            while True:
+                timeout = (max(next_report - time.time(), 0)
+                           if next_report is not None else None)
+
+                for fd, events in self._poller.poll(timeout):
+                    if fd == listener_fd:
+                        self._accept()
+                        continue
+
+                    # NOTE: None if closed while handling an earlier event
+                    conn = self._connections.get(fd)
+                    if conn is not None:
+                        handle(conn, events)
+
+                self._publish()
+
+                if next_report is not None and time.time() >= next_report:
+                    self._report(reported, report_interval)
+                    reported = dict(self._totals)
+                    next_report += report_interval
+        finally:
+            for conn in list(self._connections.values()):
+                self._close(conn)
+            self._poller.close()
+            if self._spare_fd is not None:
+                os.close(self._spare_fd)
+
+
+    def _count(self, name, amount=1):
+        """Increment a counter locally; published once per loop iteration"""
+        self._totals[name] += amount
+        self._unpublished[name] += amount
+
+
+    def _publish(self):
+        """Add the unpublished counts to the shared counters"""
+        if self._counters is None:
+            return
+
+        amounts = [(name, amount)
+                   for name, amount in self._unpublished.items() if amount]
+        if amounts:
+            self._counters.add_many(amounts)
+            for name, _ in amounts:
+                self._unpublished[name] = 0
+
+
+    def _report(self, reported, interval):
+        """Print the throughput and connection counts since the last report"""
+        totals = self._totals
+        print("%s connections %d active, %d new; "
+              "rx %.1f MB/s, tx %.1f MB/s"
+              % (datetime.utcnow(),
+                 totals["active_connections"],
+                 totals["connections_accepted"] -
+                 reported["connections_accepted"],
+                 (totals["bytes_received"] - reported["bytes_received"]) /
+                 interval / 1e6,
+                 (totals["bytes_sent"] - reported["bytes_sent"]) /
+                 interval / 1e6))
+        sys.stdout.flush()
+
+
+    def _accept(self):
+        """Accept the pending connections, up to a batch"""
+        for _ in range(_ACCEPT_BATCH):
+            try:
+                sock, _ = self._listener.accept()
+            except socket.error as exc:
+                if exc.errno in _WOULD_BLOCK or exc.errno == errno.EINTR:
+                    return
+                if exc.errno in (errno.EMFILE, errno.ENFILE):
+                    _trace("%s accept failed: %r", datetime.utcnow(), exc)
+                    # NOTE: the pending connection would keep the listener
+                    # readable and spin the loop
+                    self._shed_pending()
+                    return
+                if exc.errno == errno.ECONNABORTED:
+                    _trace("%s accept failed: %r", datetime.utcnow(), exc)
+                    return
+                raise
+
+            sock.setblocking(False)
+            if sock.family in (socket.AF_INET, socket.AF_INET6):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            conn = _Connection(sock)
+            self._connections[sock.fileno()] = conn
+            self._poller.register(
+                sock.fileno(),
+                EVENT_READ | EVENT_WRITE if self._mode == MODE_CHARGEN
+                else EVENT_READ)
+
+            self._count("connections_accepted")
+            self._count("active_connections")
+
+
+    def _shed_pending(self):
+        """ Accept and immediately close a pending connection using the spare
+        descriptor; without a spare, stop listening until a connection closes
+        """
+        if self._spare_fd is not None:
+            os.close(self._spare_fd)
+            self._spare_fd = None
+            try:
+                sock, _ = self._listener.accept()
+            except socket.error:
+                pass
+            else:
+                sock.close()
+                self._count("connections_shed")
+
+        try:
+            self._spare_fd = os.open(os.devnull, os.O_RDONLY)
+        except OSError as exc:
+            if exc.errno not in (errno.EMFILE, errno.ENFILE):
+                raise
+            if self._listening:
+                self._poller.unregister(self._listener.fileno())
+                self._listening = False
+
+
+    def _close(self, conn):
+        """Stop serving the connection and close it"""
+        fd = conn.sock.fileno()
+        self._poller.unregister(fd)
+        del self._connections[fd]
+        conn.sock.close()
+        self._count("active_connections", -1)
+
+        if not self._listening:
+            # A descriptor is free again for the spare
+            try:
+                self._spare_fd = os.open(os.devnull, os.O_RDONLY)
+            except OSError as exc:
+                if exc.errno not in (errno.EMFILE, errno.ENFILE):
+                    raise
+            else:
+                self._poller.register(self._listener.fileno(), EVENT_READ)
+                self._listening = True
+
+
+    def _recv(self, conn):
+        """ Receive into the loop's buffer
+
+        :returns: number of bytes received; 0 on EOF or error; None if there
+            was nothing to receive after all
+        """
+        try:
+            nbytes = conn.sock.recv_into(self._rx_buf)
+        except socket.error as exc:
+            if exc.errno in _WOULD_BLOCK or exc.errno == errno.EINTR:
+                return None
+            if exc.errno in _PEER_GONE:
+                return 0
+            raise
+
+        self._count("bytes_received", nbytes)
+        return nbytes
+
+
+    def _send(self, conn, data):
+        """ Send as much of the data as the socket takes
+
+        :returns: number of bytes sent; None if the peer is gone
+        """
+        try:
+            nbytes = conn.sock.send(data)
+        except socket.error as exc:
+            if exc.errno in _WOULD_BLOCK or exc.errno == errno.EINTR:
+                return 0
+            if exc.errno in _PEER_GONE:
+                return None
+            raise
+
+        self._count("bytes_sent", nbytes)
+        return nbytes
+
+
+    def _on_echo_event(self, conn, events):
+        """Receive and send back; stop receiving while a send is pending"""
+        if conn.pending is not None:
+            if not events & (EVENT_WRITE | EVENT_ERROR):
+                return
+
+            remaining = memoryview(conn.pending)[conn.offset:]
+            sent = self._send(conn, remaining)
+            if sent is None:
+                self._close(conn)
+                return
+            conn.offset += sent
+            if conn.offset < len(conn.pending):
+                return
+
+            conn.pending = None
+            conn.offset = 0
+            self._poller.modify(conn.sock.fileno(), EVENT_READ)
+            return
+
+        nbytes = self._recv(conn)
+        if nbytes is None:
+            return
+        if not nbytes:
+            # Everything was sent back already, so pass the EOF on
+            try:
+                conn.sock.shutdown(socket.SHUT_WR)
+            except socket.error:
+                pass
+            self._close(conn)
+            return
+
+        sent = self._send(conn, self._rx_view[:nbytes])
+        if sent is None:
+            self._close(conn)
+        elif sent < nbytes:
+            # Hold the rest and wait for the peer to catch up
+            conn.pending = bytes(self._rx_buf[sent:nbytes])
+            conn.offset = 0
+            self._poller.modify(conn.sock.fileno(), EVENT_WRITE)
+
+
+    def _on_discard_event(self, conn, events):  # pylint: disable=W0613
+        """Receive and drop"""
+        nbytes = self._recv(conn)
+        if nbytes == 0:
+            self._close(conn)
+
+
+    def _on_chargen_event(self, conn, events):
+        """Send the pattern; drop whatever is received"""
+        if events & (EVENT_READ | EVENT_ERROR):
+            if self._recv(conn) == 0:
+                self._close(conn)
+                return
+
+        if events & EVENT_WRITE:
+            offset = conn.offset
+            sent = self._send(conn,
+                              self._pattern_view[offset:
+                                                 offset + _IO_CHUNK_SIZE])
+            if sent is None:
+                self._close(conn)
+                return
+            conn.offset = (offset + sent) % self._pattern_period
+
+
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=MODES, default=MODE_ECHO)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--report-interval", type=float, default=1.0,
+                        help="seconds between throughput reports")
+    args = parser.parse_args()
+
+    def listening(address):
+        print("%s listening on %s" % (args.mode, address,))
+        sys.stdout.flush()
+
+    try:
+        serve(args.mode, (args.host, args.port),
+              report_interval=args.report_interval,
+              listening_callback=listening)
+    except KeyboardInterrupt:
+        pass
+
+
+
+if __name__ == "__main__":
+    main()
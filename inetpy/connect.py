@@ -1,40 +1,60 @@
-"""Resolves name and connects socket with IPv4/IPv6 portability"""
+"""Resolves name and connects socket with IPv4/IPv6 portability; pools
+connected sockets for reuse"""
 
 
+import collections
+import contextlib
+import errno
 import logging
 import socket
+import threading
+import time
 
 
 
 g_log = logging.getLogger(__name__)
 
 
+# Sentinel for default argument values
+_DEFAULT = object()
 
-def connect_tcp(host, port):
+_now = getattr(time, "monotonic", time.time)
+
+# Not available on Windows
+_MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
+
+
+
+def connect_tcp(host, port, transport=socket):
   """Establish a TCP/IP connection
 
+  :param transport: provider of `getaddrinfo()` and `socket()`: the `socket`
+    module (default), or an `inetpy.simnet.SimNetwork` for simulated sockets
+
   :returns: A successfully-connected socket
   :rtype: socket.socket
 
   :raises socket.gaierror: address resolution error
   :raises socket.error: socket connection error
   """
-  infos = socket.getaddrinfo(host,
-                             port,
-                             0, # family
-                             0, # socktype
-                             socket.IPPROTO_TCP,
-                             0) # flags
-  return connect_from_addr_infos(infos)
+  infos = transport.getaddrinfo(host,
+                                port,
+                                0, # family
+                                0, # socktype
+                                socket.IPPROTO_TCP,
+                                0) # flags
+  return connect_from_addr_infos(infos, transport=transport)
 
 
 
-def connect_from_addr_infos(infos):
+def connect_from_addr_infos(infos, transport=socket):
   """Given a sequence of elements generated by `socket.getaddrinfo`, attempt
   connection to each one of them in the given order.
 
   :param infos: sequence of tuples that are compatible with the results returned
     by `socket.getaddrinfo`
+  :param transport: provider of `socket()`: the `socket` module (default), or
+    an `inetpy.simnet.SimNetwork`
 
   :returns: A successfully-connected socket; None if given an empty sequence
   :rtype: socket.socket or None
@@ -49,7 +69,7 @@ def connect_from_addr_infos(infos):
 
     # Attempt to create a socket
     try:
-      sock = socket.socket(family, socktype, proto)
+      sock = transport.socket(family, socktype, proto)
     except socket.error:
       if count < len(infos):
         g_log.debug("socket.socket(%r, %r, %r) failed", family, socktype, proto,
@@ -77,3 +97,365 @@ def connect_from_addr_infos(infos):
   # Should never get here!
   raise RuntimeError("Failed to connect, but didn't raise; infos: %r"
                      % (infos,))
+
+
+
+class PoolExhaustedError(Exception):
+  """Raised by `ConnectionPool.acquire` when no connection became available
+  within the allowed time
+  """
+  pass
+
+
+
+class ConnectionPool(object):
+  """Thread-safe pool of connected TCP/IP sockets keyed by (host, port)
+
+  Connections are established on demand via `connect_tcp` and returned to the
+  pool by `release` for reuse by subsequent `acquire` calls, which saves the
+  resolve and connect (and any protocol handshake) costs of the request.
+  Idle connections are evicted after `idle_ttl` seconds, and each one is
+  checked cheaply for EOF before it's handed out.
+
+  NOTE: the pool is only suitable for protocols that leave the connection
+  idle (no unread data) between requests; a connection with unread data is
+  treated as dead.
+
+  :example:
+    pool = ConnectionPool(max_per_key=4)
+
+    with pool.connection("localhost", 5672) as sock:
+      sock.sendall(request)
+      ...
+
+    pool.close()
+  """
+
+  # Names of the counters returned by `stats`
+  _COUNTER_NAMES = (
+    "acquires",       # successful acquire calls
+    "hits",           # acquires satisfied by an idle connection
+    "misses",         # acquires that established a new connection
+    "releases",       # connections returned to the pool
+    "waits",          # acquires that had to wait for a connection
+    "exhausted",      # acquires that failed with PoolExhaustedError
+    "connect_errors", # failed attempts to establish a connection
+    "evicted_idle",   # idle connections closed upon reaching idle_ttl
+    "evicted_dead",   # idle connections found closed by peer
+    "evicted_room",   # idle connections closed to make room for other keys
+  )
+
+
+  def __init__(self, max_per_key=8, max_total=64, idle_ttl=60.0,
+               timeout=None, connect=connect_tcp):
+    """
+    :param int max_per_key: maximum number of connections, idle and checked
+      out, per (host, port)
+    :param int max_total: maximum number of connections, idle and checked out,
+      across all keys
+    :param float idle_ttl: idle connections older than this many seconds are
+      closed instead of being reused
+    :param float timeout: default for `acquire`'s timeout
+    :param connect: function of (host, port) that returns a connected socket;
+      defaults to `connect_tcp`
+    """
+    assert max_per_key > 0, max_per_key
+    assert max_total >= max_per_key, (max_total, max_per_key)
+
+    self._max_per_key = max_per_key
+    self._max_total = max_total
+    self._idle_ttl = idle_ttl
+    self._timeout = timeout
+    self._connect = connect
+
+    self._cond = threading.Condition(threading.Lock())
+
+    # (host, port) -> deque of (sock, idle_since) pairs; most recent on the
+    # right
+    self._idle = dict()
+
+    # (host, port) -> number of open connections, idle and checked out
+    self._open_by_key = collections.defaultdict(int)
+    self._open_total = 0
+
+    # Checked out socket -> its (host, port)
+    self._checked_out = dict()
+
+    self._closed = False
+
+    self._counters = dict((name, 0) for name in self._COUNTER_NAMES)
+    self._wait_time = 0.0
+
+
+  def acquire(self, host, port, timeout=_DEFAULT):
+    """Check out a connection to the given host and port, establishing a new
+    one if there are no idle ones and the limits allow it.
+
+    :param host: passed to `connect_tcp`
+    :param port: passed to `connect_tcp`
+    :param float timeout: number of seconds to wait for a connection when the
+      pool is exhausted; 0 to fail fast; None to wait indefinitely. Defaults to
+      the pool's timeout.
+
+    :returns: connected socket, which must be returned via `release`
+    :rtype: socket.socket
+
+    :raises PoolExhaustedError: no connection became available in time
+    :raises socket.gaierror: address resolution error
+    :raises socket.error: socket connection error
+    """
+    if timeout is _DEFAULT:
+      timeout = self._timeout
+
+    key = (host, port)
+    deadline = None
+    wait_start = None
+
+    with self._cond:
+      while True:
+        assert not self._closed, "ConnectionPool is closed"
+
+        sock = self._pop_idle(key)
+        if sock is not None:
+          self._counters["hits"] += 1
+          break
+
+        if self._reserve(key):
+          sock = None
+          break
+
+        # Exhausted
+        if timeout is not None and timeout <= 0:
+          self._counters["exhausted"] += 1
+          raise PoolExhaustedError("No connection to %r available" % (key,))
+
+        now = _now()
+        if wait_start is None:
+          wait_start = now
+          self._counters["waits"] += 1
+          if timeout is not None:
+            deadline = now + timeout
+        elif deadline is not None and now >= deadline:
+          self._wait_time += now - wait_start
+          self._counters["exhausted"] += 1
+          raise PoolExhaustedError(
+            "No connection to %r available within %ss" % (key, timeout))
+
+        self._cond.wait(None if deadline is None else deadline - now)
+
+      if wait_start is not None:
+        self._wait_time += _now() - wait_start
+
+      if sock is not None:
+        self._checked_out[sock] = key
+        self._counters["acquires"] += 1
+        return sock
+
+    # Establish new connection outside the lock
+    try:
+      sock = self._connect(host, port)
+    except Exception:
+      with self._cond:
+        self._counters["connect_errors"] += 1
+        self._unreserve(key)
+      raise
+
+    with self._cond:
+      self._checked_out[sock] = key
+      self._counters["misses"] += 1
+      self._counters["acquires"] += 1
+
+    return sock
+
+
+  def release(self, sock, discard=False):
+    """Return a connection obtained from `acquire` to the pool
+
+    :param socket.socket sock: the connection
+    :param bool discard: close the connection instead of pooling it; pass True
+      if the connection's state is unknown (e.g., after an error)
+    """
+    with self._cond:
+      key = self._checked_out.pop(sock)
+      self._counters["releases"] += 1
+
+      if discard or self._closed:
+        self._unreserve(key)
+      else:
+        self._idle.setdefault(key, collections.deque()).append((sock, _now()))
+        self._cond.notify_all()
+        sock = None
+
+    if sock is not None:
+      sock.close()
+
+
+  @contextlib.contextmanager
+  def connection(self, host, port, timeout=_DEFAULT):
+    """Context manager that acquires a connection and releases it on exit,
+    discarding it if the body raises
+
+    :returns: context manager yielding connected socket
+    """
+    sock = self.acquire(host, port, timeout=timeout)
+    try:
+      yield sock
+    except:
+      self.release(sock, discard=True)
+      raise
+    else:
+      self.release(sock)
+
+
+  def evict_idle(self):
+    """Close idle connections that reached idle_ttl; the pool also does this
+    lazily in `acquire`
+
+    :returns: number of connections closed
+    """
+    expired = []
+    with self._cond:
+      cutoff = _now() - self._idle_ttl
+      for key, idle in list(self._idle.items()):
+        while idle and idle[0][1] <= cutoff:
+          expired.append(idle.popleft()[0])
+          self._unreserve(key)
+          self._counters["evicted_idle"] += 1
+
+    for sock in expired:
+      sock.close()
+
+    return len(expired)
+
+
+  def close(self):
+    """Close the idle connections and disable the pool; connections that are
+    checked out are closed when released
+    """
+    with self._cond:
+      self._closed = True
+      idle = self._idle
+      self._idle = dict()
+      for key, entries in idle.items():
+        for _ in entries:
+          self._unreserve(key)
+
+    for entries in idle.values():
+      for sock, _idle_since in entries:
+        sock.close()
+
+
+  def stats(self):
+    """Get a snapshot of the pool's metrics
+
+    :returns: dict with the counters (see `_COUNTER_NAMES`) plus "wait_time"
+      (total seconds acquire calls spent waiting), "open" (total connections)
+      and "idle" (idle connections)
+    :rtype: dict
+    """
+    with self._cond:
+      stats = dict(self._counters)
+      stats["wait_time"] = self._wait_time
+      stats["open"] = self._open_total
+      stats["idle"] = sum(len(idle) for idle in self._idle.values())
+    return stats
+
+
+  def _pop_idle(self, key):
+    """Pop the most recently used live idle connection for the key, closing
+    expired and dead ones along the way. Must be called under lock.
+
+    :returns: socket or None
+    """
+    idle = self._idle.get(key)
+    if not idle:
+      return None
+
+    cutoff = _now() - self._idle_ttl
+    while idle:
+      sock, idle_since = idle.pop()
+      if idle_since <= cutoff:
+        # NOTE: the entries to the left are older, hence expired as well
+        self._counters["evicted_idle"] += 1 + len(idle)
+        for older, _ in idle:
+          self._unreserve(key)
+          older.close()
+        idle.clear()
+      elif _is_alive(sock):
+        return sock
+      else:
+        self._counters["evicted_dead"] += 1
+
+      self._unreserve(key)
+      sock.close()
+
+    return None
+
+
+  def _reserve(self, key):
+    """Reserve a slot for a new connection to key, closing an idle connection
+    of another key if necessary to stay within max_total. Must be called under
+    lock.
+
+    :returns: True if reserved; False if the limits don't allow it
+    """
+    if self._open_by_key[key] >= self._max_per_key:
+      return False
+
+    if self._open_total >= self._max_total:
+      # Make room by closing the least recently used idle connection
+      victim_key = None
+      oldest = None
+      for other_key, idle in self._idle.items():
+        if idle and (oldest is None or idle[0][1] < oldest):
+          victim_key, oldest = other_key, idle[0][1]
+
+      if victim_key is None:
+        return False
+
+      victim = self._idle[victim_key].popleft()[0]
+      self._unreserve(victim_key)
+      self._counters["evicted_room"] += 1
+      victim.close()
+
+    self._open_by_key[key] += 1
+    self._open_total += 1
+    return True
+
+
+  def _unreserve(self, key):
+    """Account for a closed connection and wake up a waiter. Must be called
+    under lock.
+    """
+    self._open_by_key[key] -= 1
+    if not self._open_by_key[key]:
+      del self._open_by_key[key]
+      self._idle.pop(key, None)
+    self._open_total -= 1
+    self._cond.notify_all()
+
+
+
+def _is_alive(sock):
+  """Cheaply check that an idle connection hasn't been closed by its peer via
+  a non-blocking peek.
+
+  :returns: False if the peer closed or reset the connection, or sent
+    unsolicited data; True otherwise
+  """
+  try:
+    if _MSG_DONTWAIT:
+      data = sock.recv(1, socket.MSG_PEEK | _MSG_DONTWAIT)
+    else:
+      sock.setblocking(False)
+      try:
+        data = sock.recv(1, socket.MSG_PEEK)
+      finally:
+        sock.setblocking(True)
+  except socket.error as exc:
+    # Nothing to read means the connection is idle as expected
+    return exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK)
+
+  g_log.debug("Discarding pooled connection: %s",
+              "unexpected data" if data else "EOF")
+  return False
@@ -2,13 +2,28 @@
 from __future__ import print_function
 
 import array
+import collections
+import copy
 from datetime import datetime
 import errno
 from functools import partial
+import heapq
+import itertools
 import logging
+import math
 import multiprocessing
+import multiprocessing.reduction
 import os
+
+try:
+    import resource
+except ImportError:
+    resource = None # pylint: disable=C0103
+
+import select
+import signal
 import socket
+import ssl
 import struct
 
 try:
@@ -18,10 +33,54 @@ except ImportError:
 
 import sys
 import threading
+import time
 import traceback
 
 
-from inetpy.socket_pair import socket_pair
+from inetpy import bench_server
+from inetpy.forward_shards import SHARD_COUNTER_NAMES, ShardedForwarder
+from inetpy.forward_stats import ForwardObserver, _SharedCounters
+from inetpy.tunnel_codec import StreamCompressor, StreamDecompressor, get_codec
+from inetpy.tunnel_mux import INITIAL_WINDOW, MuxClient, MuxConnection
+
+
+
+# High-resolution timer for instrumentation
+_now = getattr(time, "perf_counter", time.time)
+
+# Session identifiers reported to observers
+_session_ids = itertools.count(1)
+
+# Names of the counters exposed via ForwardServer.stats
+_SERVER_COUNTER_NAMES = (
+    "sessions_accepted",
+    "active_sessions",
+    "refused_fd_budget",
+    "refused_fd_exhausted",
+    "worker_respawns",
+    "handoff_failures",
+    "tunnel_frames",
+    "tunnel_plain_bytes",
+    "tunnel_wire_bytes",
+    "tunnel_codec_usec",
+    "tunnel_hold_usec",
+    "tunnel_bypasses",
+    "coalesce_flushes",
+    "coalesce_chunks",
+    "coalesce_hold_usec",
+    "coalesce_polls",
+    "tls_server_handshakes",
+    "tls_server_handshake_failures",
+    "tls_client_handshakes",
+    "tls_client_resumed",
+    "timeouts_connect",
+    "timeouts_idle",
+    "timeouts_lifetime",
+    "mux_connections",
+    "mux_streams",
+    "mux_window_waits",
+    "mux_resets",
+)
 
 
 
@@ -77,6 +136,12 @@ class ForwardServer(object):  # pylint: disable=R0902
     # Amount of time, in seconds, we're willing to wait for the subprocess
     _SUBPROC_TIMEOUT = 10
 
+    # Tunnel modes
+    TUNNEL_COMPRESS = "compress"
+    TUNNEL_DECOMPRESS = "decompress"
+    TUNNEL_MUX = "mux"
+    TUNNEL_DEMUX = "demux"
+
 
     def __init__(self,  # pylint: disable=R0913
                  remote_addr,
@@ -85,7 +150,25 @@ class ForwardServer(object):  # pylint: disable=R0902
                  server_addr=("127.0.0.1", 0),
                  server_addr_family=socket.AF_INET,
                  server_socket_type=socket.SOCK_STREAM,
-                 local_linger_args=None):
+                 local_linger_args=None,
+                 observer=None,
+                 server_ssl_context=None,
+                 remote_ssl_context=None,
+                 remote_server_hostname=None,
+                 max_open_files=None,
+                 worker_processes=None,
+                 tunnel=None,
+                 tunnel_codec="zlib",
+                 tunnel_latency_budget=0.001,
+                 coalesce_hold_time=None,
+                 coalesce_bytes=64 * 1024,
+                 thread_stack_size=None,
+                 connect_timeout=None,
+                 idle_timeout=None,
+                 session_lifetime=None,
+                 mux_connections=2,
+                 mux_window=256 * 1024,
+                 event_loop_shards=None):
         """
         :param tuple remote_addr: remote server's IP address, whose structure
           depends on remote_addr_family; pair (host-or-ip-addr, port-number).
@@ -107,6 +190,109 @@ class ForwardServer(object):  # pylint: disable=R0902
           None for default, which is to not change the SO_LINGER option.
           Otherwise, its a two-tuple, where the first element is the `l_onoff`
           switch, and the second element is the `l_linger` value, in seconds
+        :param inetpy.forward_stats.ForwardObserver observer: optional
+          observer whose hooks are called on session open/close, upstream
+          connect and each received and sent chunk; e.g.,
+          `inetpy.forward_stats.HistogramObserver`. The hooks run in the
+          forwarding subprocess. None (default) disables instrumentation
+          without adding per-chunk overhead.
+        :param ssl.SSLContext server_ssl_context: when not None, terminate TLS
+          on the accepted local connections using this server-side context,
+          which must have its certificate chain loaded
+        :param ssl.SSLContext remote_ssl_context: when not None, originate TLS
+          to remote_addr using this client-side context. On python 3.6+,
+          TLS sessions are cached and resumed on subsequent upstream
+          connections; older interpreters lack `ssl.SSLSocket.session`, so
+          every upstream handshake is a full one there and
+          "tls_client_resumed" remains 0
+        :param str remote_server_hostname: server hostname for SNI and
+          certificate matching on upstream TLS connections; None to omit
+        :param int max_open_files: when not None, the forwarding subprocess
+          sets its RLIMIT_NOFILE soft limit to this value at startup (capped by
+          the hard limit, unless permitted to raise it). Regardless, new
+          connections are refused (accepted and closed immediately) when the
+          open file descriptors approach the limit, instead of failing in
+          `accept`.
+        :param int worker_processes: when not None, the forwarding subprocess
+          only accepts connections and hands each one off (via SCM_RIGHTS over
+          an AF_UNIX socket) to the least-loaded of this many forwarding worker
+          processes, respawning workers that die. Load is the worker's session
+          count weighted with its recent CPU use. Each worker's sessions count
+          against the max_open_files budget on their own, and connections are
+          refused once no worker has room. None (default) forwards in the
+          accepting subprocess. POSIX only.
+        :param str tunnel: None (default) for plain forwarding.
+          TUNNEL_COMPRESS to compress data toward remote_addr and decompress
+          data coming back from it; remote_addr is expected to be a peer
+          ForwardServer in TUNNEL_DECOMPRESS mode, which does the reverse.
+          TUNNEL_MUX to carry all sessions as streams over `mux_connections`
+          long-lived connections to remote_addr, instead of connecting anew
+          for each session; remote_addr is expected to be a peer
+          ForwardServer in TUNNEL_DEMUX mode, which accepts these connections
+          and forwards each stream to its own remote_addr as a session of its
+          own. Each stream has flow control of its own, so that a session
+          that is slow to take its data doesn't hold up the others, and is
+          half-closed and closed along with its session. The other settings
+          apply to the multiplexed connections on the TUNNEL_MUX side and to
+          the streams' sessions on the TUNNEL_DEMUX side; however, the
+          TUNNEL_DEMUX side's max_open_files budget counts each multiplexed
+          connection as a single session.
+        :param str tunnel_codec: compression codec for the tunnel: "zlib"
+          (default), or "zstd" or "lz4" if the respective module is installed
+          (see `inetpy.tunnel_codec.available_codecs()`). Only the compressing
+          side's choice matters; the peer detects it from the stream.
+        :param float tunnel_latency_budget: maximum time, in seconds, that the
+          tunnel holds back data to compress it together with data that is
+          about to arrive
+        :param float coalesce_hold_time: when not None, enables write
+          coalescing: a received chunk is held for up to this many seconds
+          (e.g., 0.0002) while whatever else the same source sends meanwhile
+          is received, then they are all sent together with one scatter-gather
+          `sendmsg` (or one `sendall` of the joined chunks where `sendmsg`
+          isn't available or with an observer). Saves syscalls and packets
+          with chatty protocols. After a chunk is held in vain, the next few
+          are sent right away, so that request/response traffic seldom pays
+          the hold time. Ignored in tunnel mode, which coalesces on its own.
+        :param int coalesce_bytes: with coalescing, send the held chunks as
+          soon as they add up to this many bytes
+        :param int thread_stack_size: when not None, stack size, in bytes, of
+          the threads created by the forwarding subprocess and its workers
+          (see `threading.stack_size`); at least 32 KiB. Each session runs on
+          one thread in echo mode and two otherwise, so with many sessions a
+          small size (e.g., 256 KiB) bounds the address space reserved for
+          stacks, which is 8 MiB per thread by default on Linux. None keeps
+          the platform default.
+        :param float connect_timeout: when not None, maximum time, in seconds,
+          for connecting to remote_addr, including the TLS handshake when
+          originating TLS; on timeout, the local connection is closed. None
+          (default) waits as long as the OS does.
+        :param float idle_timeout: when not None, a session that receives no
+          data in either direction for this many seconds is reclaimed: its
+          sockets are shut down, which ends its forwarders and frees its
+          threads and descriptors. None (default) never reclaims idle
+          sessions.
+        :param float session_lifetime: when not None, a session is reclaimed
+          this many seconds after it was accepted, regardless of activity.
+          Sessions reclaimed by each of the three timeouts are counted in
+          `stats`.
+        :param int mux_connections: with TUNNEL_MUX, number of connections to
+          the peer to spread the streams over; each new stream goes to the
+          connection with the fewest streams
+        :param int mux_window: with TUNNEL_MUX and TUNNEL_DEMUX, maximum
+          number of bytes of a stream's data that the peer may send ahead of
+          this server forwarding it, per stream; at least 64 KiB. Bounds the
+          memory of streams whose destination is slow.
+        :param int event_loop_shards: when not None, the forwarding subprocess
+          forwards all sessions on this many event-loop threads ("shards")
+          with non-blocking sockets, instead of on two threads per session;
+          the accepting thread assigns each new session to the shard with the
+          fewest sessions. Each shard has its own buffers and counters (see
+          `shard_stats`), so on free-threaded Python builds the shards run in
+          parallel without contending for locks; e.g., one per core. With the
+          GIL, the thread count no longer grows with the number of sessions.
+          Plain forwarding and echo only: not supported together with
+          worker_processes, tunnel, observer, TLS, write coalescing or the
+          timeouts.
         """
         self._logger = logging.getLogger(__name__)
 
@@ -127,6 +313,59 @@ class ForwardServer(object):  # pylint: disable=R0902
 
         self._local_linger_args = local_linger_args
 
+        self._observer = observer
+
+        self._server_ssl_context = server_ssl_context
+        self._remote_ssl_context = remote_ssl_context
+        self._remote_server_hostname = remote_server_hostname
+
+        self._max_open_files = max_open_files
+
+        self._worker_processes = worker_processes
+
+        assert tunnel in (None, self.TUNNEL_COMPRESS, self.TUNNEL_DECOMPRESS,
+                          self.TUNNEL_MUX, self.TUNNEL_DEMUX), tunnel
+        assert tunnel not in (self.TUNNEL_MUX, self.TUNNEL_DEMUX) or \
+            remote_addr is not None, "Multiplexing requires remote_addr"
+        self._tunnel = tunnel
+        # NOTE: raises ValueError if the codec isn't available
+        self._tunnel_codec = get_codec(tunnel_codec)
+        self._tunnel_latency_budget = tunnel_latency_budget
+
+        self._coalesce_hold_time = coalesce_hold_time
+        self._coalesce_bytes = coalesce_bytes
+
+        assert thread_stack_size is None or thread_stack_size >= 32 * 1024, \
+            thread_stack_size
+        self._thread_stack_size = thread_stack_size
+
+        self._connect_timeout = connect_timeout
+        self._idle_timeout = idle_timeout
+        self._session_lifetime = session_lifetime
+
+        assert mux_connections >= 1, mux_connections
+        self._mux_connections = mux_connections
+        assert mux_window >= INITIAL_WINDOW, mux_window
+        self._mux_window = mux_window
+
+        assert event_loop_shards is None or (
+            event_loop_shards >= 1 and
+            worker_processes is None and
+            tunnel is None and
+            observer is None and
+            server_ssl_context is None and
+            remote_ssl_context is None and
+            coalesce_hold_time is None and
+            connect_timeout is None and
+            idle_timeout is None and
+            session_lifetime is None), "Unsupported with event_loop_shards"
+        self._event_loop_shards = event_loop_shards
+
+        # NOTE: allocated here so that the subprocess inherits them
+        self._counters = _SharedCounters(_SERVER_COUNTER_NAMES)
+        self._shard_counters = [_SharedCounters(SHARD_COUNTER_NAMES)
+                                for _ in range(event_loop_shards or 0)]
+
         self._subproc = None
 
 
@@ -135,6 +374,13 @@ class ForwardServer(object):  # pylint: disable=R0902
         """Property: True if ForwardServer is active"""
         return self._subproc is not None
 
+    @property
+    def pid(self):
+        """Property: process id of the forwarding subprocess; None if not
+        running
+        """
+        return self._subproc.pid if self._subproc is not None else None
+
     @property
     def server_address_family(self):
         """Property: Get listening socket's address family
@@ -158,6 +404,52 @@ class ForwardServer(object):  # pylint: disable=R0902
         return self._server_addr
 
 
+    @property
+    def stats(self):
+        """ Property: Get a snapshot of the server's counters accumulated
+        since the ForwardServer instance was created
+
+        :returns: dict of counter name to value; also includes the derived
+          "tls_client_resumed_ratio": fraction of upstream TLS handshakes that
+          resumed a cached session; "tunnel_compression_ratio": tunnel bytes
+          sent on the wire per byte of input of this server's compressing
+          direction; "tunnel_mean_hold_usec": mean latency added by holding
+          data back for compression; and "coalesce_chunks_per_flush": mean
+          number of received chunks sent per coalesced send. The codec CPU
+          time, "tunnel_codec_usec", is the forwarding threads' CPU time
+          where the platform can measure it per thread, and the process's
+          otherwise
+        :rtype: dict
+        """
+        stats = self._counters.snapshot()
+        handshakes = stats["tls_client_handshakes"]
+        stats["tls_client_resumed_ratio"] = (
+            float(stats["tls_client_resumed"]) / handshakes if handshakes
+            else 0.0)
+        stats["tunnel_compression_ratio"] = (
+            float(stats["tunnel_wire_bytes"]) / stats["tunnel_plain_bytes"]
+            if stats["tunnel_plain_bytes"] else 0.0)
+        stats["tunnel_mean_hold_usec"] = (
+            float(stats["tunnel_hold_usec"]) / stats["tunnel_frames"]
+            if stats["tunnel_frames"] else 0.0)
+        stats["coalesce_chunks_per_flush"] = (
+            float(stats["coalesce_chunks"]) / stats["coalesce_flushes"]
+            if stats["coalesce_flushes"] else 0.0)
+        return stats
+
+
+    @property
+    def shard_stats(self):
+        """ Property: Get a snapshot of each shard's counters, with
+        event_loop_shards
+
+        :returns: list of dicts of counter name to value, one per shard; empty
+          without event_loop_shards
+        :rtype: list
+        """
+        return [counters.snapshot() for counters in self._shard_counters]
+
+
     def __enter__(self):
         """ Context manager entry. Starts the forwarding server
 
@@ -193,6 +485,25 @@ class ForwardServer(object):  # pylint: disable=R0902
                 remote_addr=self._remote_addr,
                 remote_addr_family=self._remote_addr_family,
                 remote_socket_type=self._remote_socket_type,
+                observer=self._observer,
+                server_ssl_context=self._server_ssl_context,
+                remote_ssl_context=self._remote_ssl_context,
+                remote_server_hostname=self._remote_server_hostname,
+                max_open_files=self._max_open_files,
+                worker_processes=self._worker_processes,
+                tunnel=self._tunnel,
+                tunnel_codec=self._tunnel_codec,
+                tunnel_latency_budget=self._tunnel_latency_budget,
+                coalesce_hold_time=self._coalesce_hold_time,
+                coalesce_bytes=self._coalesce_bytes,
+                thread_stack_size=self._thread_stack_size,
+                connect_timeout=self._connect_timeout,
+                idle_timeout=self._idle_timeout,
+                session_lifetime=self._session_lifetime,
+                mux_connections=self._mux_connections,
+                mux_window=self._mux_window,
+                counters=self._counters,
+                shard_counters=self._shard_counters,
                 queue=queue))
         self._subproc.daemon = True
         self._subproc.start()
@@ -251,7 +562,13 @@ class ForwardServer(object):  # pylint: disable=R0902
 
 def _run_server(local_addr, local_addr_family, local_socket_type,  # pylint: disable=R0913
                 local_linger_args, remote_addr, remote_addr_family,
-                remote_socket_type, queue):
+                remote_socket_type, observer, server_ssl_context,
+                remote_ssl_context, remote_server_hostname, max_open_files,
+                worker_processes, tunnel, tunnel_codec, tunnel_latency_budget,
+                coalesce_hold_time, coalesce_bytes, thread_stack_size,
+                connect_timeout, idle_timeout, session_lifetime,
+                mux_connections, mux_window, counters, shard_counters,
+                queue):
     """ Run the server; executed in the subprocess
 
     :param local_addr: listening address
@@ -269,10 +586,49 @@ def _run_server(local_addr, local_addr_family, local_socket_type,  # pylint: dis
         one of socket.AF_*
     :param remote_socket_type: socket type for connecting to target server;
         typically socket.SOCK_STREAM
+    :param inetpy.forward_stats.ForwardObserver observer: session observer;
+        None to disable instrumentation
+    :param ssl.SSLContext server_ssl_context: context for terminating TLS on
+        local connections; None for plain TCP
+    :param ssl.SSLContext remote_ssl_context: context for originating TLS to
+        the target server; None for plain TCP
+    :param str remote_server_hostname: hostname for SNI and certificate
+        matching on upstream TLS connections; None to omit
+    :param int max_open_files: RLIMIT_NOFILE soft limit to set at startup; None
+        to keep the inherited limit
+    :param int worker_processes: number of forwarding worker processes to hand
+        accepted connections off to; None to forward in this process
+    :param str tunnel: None or one of the ForwardServer.TUNNEL_* modes
+    :param tunnel_codec: codec from `inetpy.tunnel_codec.get_codec` for the
+        compressing direction of the tunnel
+    :param float tunnel_latency_budget: maximum time, in seconds, to hold back
+        data for compression
+    :param float coalesce_hold_time: maximum time, in seconds, to hold chunks
+        for coalescing into one send; None to disable coalescing
+    :param int coalesce_bytes: send the held chunks once they reach this size
+    :param int thread_stack_size: stack size, in bytes, for the threads
+        created from here on; None to keep the default
+    :param float connect_timeout: maximum time, in seconds, for connecting to
+        the target server; None for no limit
+    :param float idle_timeout: time, in seconds, without data after which a
+        session is reclaimed; None for no limit
+    :param float session_lifetime: time, in seconds, after which a session
+        is reclaimed; None for no limit
+    :param int mux_connections: number of multiplexed connections to the
+        peer in ForwardServer.TUNNEL_MUX mode
+    :param int mux_window: receive window, in bytes, of each multiplexed
+        stream
+    :param _SharedCounters counters: server counters shared with the parent
+    :param shard_counters: sequence of `_SharedCounters`, one per
+        event-loop shard to forward sessions on; empty to run each session
+        on threads of its own
     :param multiprocessing.Queue queue: queue for depositing the forwarding
         server's actual listening socket address family and bound address. The
         parent process waits for this.
     """
+    if thread_stack_size is not None:
+        # NOTE: applies to session threads and is inherited by the workers
+        threading.stack_size(thread_stack_size)
 
     # NOTE: We define _ThreadedTCPServer class as a closure in order to
     # override some of its class members dynamically
@@ -287,22 +643,143 @@ def _run_server(local_addr, local_addr_family, local_socket_type,  # pylint: dis
         address_family = local_addr_family
         socket_type = local_socket_type
         allow_reuse_address = True
+        request_queue_size = socket.SOMAXCONN
 
 
         def __init__(self):
 
-            handler_class_factory = partial(
-                _TCPHandler,
+            self._fd_budget = _FdBudget(
+                fds_per_session=(
+                    2 if remote_addr is not None and
+                    tunnel != ForwardServer.TUNNEL_MUX
+                    else 1),
+                max_open_files=max_open_files)
+
+            config = _SessionConfig(
                 local_linger_args=local_linger_args,
                 remote_addr=remote_addr,
                 remote_addr_family=remote_addr_family,
-                remote_socket_type=remote_socket_type)
+                remote_socket_type=remote_socket_type,
+                observer=observer,
+                server_ssl_context=server_ssl_context,
+                remote_ssl_context=remote_ssl_context,
+                remote_server_hostname=remote_server_hostname,
+                tls_session_cache=(
+                    _TLSSessionCache()
+                    if remote_ssl_context is not None and
+                    remote_addr is not None
+                    else None),
+                tunnel=tunnel,
+                tunnel_codec=tunnel_codec,
+                tunnel_latency_budget=tunnel_latency_budget,
+                coalesce_hold_time=coalesce_hold_time,
+                coalesce_bytes=coalesce_bytes,
+                connect_timeout=connect_timeout,
+                idle_timeout=idle_timeout,
+                reaper=(
+                    _SessionReaper(idle_timeout, session_lifetime, counters)
+                    if idle_timeout is not None or
+                    session_lifetime is not None
+                    else None),
+                mux_window=mux_window,
+                transport=socket,
+                counters=counters)
+            if tunnel == ForwardServer.TUNNEL_MUX:
+                config.mux_client = MuxClient(partial(_open_connection, config),
+                                              mux_connections,
+                                              counters,
+                                              mux_window)
+
+            handler_class_factory = partial(_TCPHandler, config=config)
 
             super(_ThreadedTCPServer, self).__init__(
                 local_addr,
                 handler_class_factory,
                 bind_and_activate=True)
 
+            self._workers = None
+            if worker_processes is not None:
+                self._workers = _WorkerPool(worker_processes,
+                                            handler_class_factory,
+                                            counters,
+                                            self._fd_budget,
+                                            self.socket)
+
+            self._shards = None
+            if shard_counters:
+                self._shards = ShardedForwarder(config,
+                                                shard_counters,
+                                                self._shard_session_ended)
+
+
+        def get_request(self):
+            """Accept a connection, shedding it if out of descriptors"""
+            try:
+                request = super(_ThreadedTCPServer, self).get_request()
+            except socket.error as exc:
+                if exc.errno in (errno.EMFILE, errno.ENFILE):
+                    # NOTE: the pending connection would keep the listening
+                    # socket readable and spin the serve_forever loop
+                    self._fd_budget.shed_pending(self.socket)
+                    counters.add("refused_fd_exhausted")
+                raise
+
+            counters.add("sessions_accepted")
+            counters.add("active_sessions")
+            self._fd_budget.session_started()
+            return request
+
+
+        def verify_request(self, request, client_address):
+            """Refuse the connection if over the descriptor budget, or if
+            every worker is
+            """
+            if self._fd_budget.admit() and (self._workers is None or
+                                            self._workers.admit()):
+                return True
+
+            counters.add("refused_fd_budget")
+            _trace("%s Refused connection from %s: open file descriptors "
+                   "near the limit", datetime.utcnow(), client_address)
+            return False
+
+
+        def process_request(self, request, client_address):
+            """Start the session in a thread or hand it off to a worker or
+            shard
+            """
+            if self._shards is not None:
+                self._shards.assign(request, client_address)
+                return
+
+            if self._workers is None:
+                super(_ThreadedTCPServer, self).process_request(
+                    request, client_address)
+                return
+
+            if not self._workers.dispatch(request, client_address):
+                self.shutdown_request(request)
+                return
+
+            # The worker owns the session now, so just close our descriptor
+            self.close_request(request)
+            self._fd_budget.session_ended()
+
+
+        def _shard_session_ended(self):
+            """Called by the shards once for every session they closed"""
+            self._fd_budget.session_ended()
+            counters.add("active_sessions", -1)
+
+
+        def shutdown_request(self, request):
+            """Called once for every accepted connection when done"""
+            try:
+                super(_ThreadedTCPServer, self).shutdown_request(request)
+            finally:
+                self._fd_budget.session_ended()
+                counters.add("active_sessions", -1)
+
 
     server = _ThreadedTCPServer()
 
@@ -314,28 +791,31 @@ def _run_server(local_addr, local_addr_family, local_socket_type,  # pylint: dis
 
 
 
-# NOTE: we add `object` to the base classes because `StreamRequestHandler` isn't
-# derived from `object`, which prevents `super` from working properly
-class _TCPHandler(SocketServer.StreamRequestHandler, object):
-    """TCP/IP session handler instantiated by TCPServer upon incoming
-    connection. Implements forwarding/echo of the incoming connection.
-    """
-
-    _SOCK_RX_BUF_SIZE = 16 * 1024
-
+class _SessionConfig(object):
+    """Session settings shared by all sessions of a forwarding server"""
 
     def __init__(self,  # pylint: disable=R0913
-                 request,
-                 client_address,
-                 server,
                  local_linger_args,
                  remote_addr,
                  remote_addr_family,
-                 remote_socket_type):
+                 remote_socket_type,
+                 observer,
+                 server_ssl_context,
+                 remote_ssl_context,
+                 remote_server_hostname,
+                 tls_session_cache,
+                 tunnel,
+                 tunnel_codec,
+                 tunnel_latency_budget,
+                 coalesce_hold_time,
+                 coalesce_bytes,
+                 connect_timeout,
+                 idle_timeout,
+                 reaper,
+                 mux_window,
+                 transport,
+                 counters):
         """
-        :param request: for super
-        :param client_address: for super
-        "paarm server:  for super
         :param tuple local_linger_args: SO_LINGER sockoverride for the local
             connection sockets, to be configured after connection is accepted.
             Pass None to not change SO_LINGER. Otherwise, its a two-tuple, where
@@ -347,85 +827,329 @@ class _TCPHandler(SocketServer.StreamRequestHandler, object):
             server; one of socket.AF_*
         :param remote_socket_type: socket type for connecting to target server;
             typically socket.SOCK_STREAM
-        :param **kwargs: kwargs for super class
+        :param inetpy.forward_stats.ForwardObserver observer: session
+            observer; None to disable instrumentation
+        :param ssl.SSLContext server_ssl_context: context for terminating TLS
+            on the local connection; None for plain TCP
+        :param ssl.SSLContext remote_ssl_context: context for originating TLS
+            to the target server; None for plain TCP
+        :param str remote_server_hostname: hostname for SNI and certificate
+            matching on the upstream TLS connection; None to omit
+        :param _TLSSessionCache tls_session_cache: upstream TLS sessions shared
+            by the server's sessions; None when not originating TLS
+        :param str tunnel: None or one of the ForwardServer.TUNNEL_* modes
+        :param tunnel_codec: codec from `inetpy.tunnel_codec.get_codec` for
+            the compressing direction of the tunnel
+        :param float tunnel_latency_budget: maximum time, in seconds, to hold
+            back data for compression
+        :param float coalesce_hold_time: maximum time, in seconds, to hold
+            chunks for coalescing into one send; None to disable coalescing
+        :param int coalesce_bytes: send the held chunks once they reach this
+            size
+        :param float connect_timeout: maximum time, in seconds, for connecting
+            to the target server; None for no limit
+        :param float idle_timeout: time, in seconds, without data after which
+            a session is reclaimed; None for no limit
+        :param _SessionReaper reaper: enforces the idle timeout and session
+            lifetime; None if neither is set
+        :param int mux_window: receive window, in bytes, of each multiplexed
+            stream
+        :param transport: provider of `socket()` for connecting to the target
+            server: the `socket` module, or an `inetpy.simnet.SimNetwork`
+        :param _SharedCounters counters: server counters
         """
-        self._local_linger_args = local_linger_args
-        self._remote_addr = remote_addr
-        self._remote_addr_family = remote_addr_family
-        self._remote_socket_type = remote_socket_type
+        self.local_linger_args = local_linger_args
+        self.remote_addr = remote_addr
+        self.remote_addr_family = remote_addr_family
+        self.remote_socket_type = remote_socket_type
+        self.observer = observer
+        self.server_ssl_context = server_ssl_context
+        self.remote_ssl_context = remote_ssl_context
+        self.remote_server_hostname = remote_server_hostname
+        self.tls_session_cache = tls_session_cache
+        self.tunnel = tunnel
+        self.tunnel_codec = tunnel_codec
+        self.tunnel_latency_budget = tunnel_latency_budget
+        self.coalesce_hold_time = coalesce_hold_time
+        self.coalesce_bytes = coalesce_bytes
+        self.connect_timeout = connect_timeout
+        self.idle_timeout = idle_timeout
+        self.reaper = reaper
+        self.mux_window = mux_window
+        self.transport = transport
+        self.counters = counters
+
+        # `inetpy.tunnel_mux.MuxClient` for opening streams in place of
+        # connecting to the target server in ForwardServer.TUNNEL_MUX mode;
+        # None otherwise
+        self.mux_client = None
+
+
+
+class _TCPHandler(object):
+    """TCP/IP session instantiated by TCPServer upon incoming connection.
+    Implements forwarding/echo of the incoming connection.
+
+    NOTE: there may be many thousands of these at once, so the per-session
+    state is kept to a minimum: settings live in the shared `_SessionConfig`,
+    the instance has no `__dict__`, and unlike `StreamRequestHandler` it
+    doesn't create file objects for the connection.
+    """
+
+    __slots__ = ("_config", "_session_id", "_timeouts", "connection",
+                 "client_address")
+
+    _SOCK_RX_BUF_SIZE = 16 * 1024
+
+
+    def __init__(self, request, client_address, server, config):  # pylint: disable=W0613
+        """ Run the session to completion, like `BaseRequestHandler`
+
+        :param request: the accepted local socket
+        :param client_address: local peer's address
+        :param server: the TCPServer instance; unused
+        :param _SessionConfig config: settings shared by the server's sessions
+        """
+        self._config = config
+        self._session_id = next(_session_ids)
+        self._timeouts = None
+        self.connection = request
+        self.client_address = client_address
 
-        super(_TCPHandler, self).__init__(request=request,
-                                          client_address=client_address,
-                                          server=server)
+        self.handle()
 
 
     def handle(self):  # pylint: disable=R0912
         """Connect to remote and forward data between local and remote"""
         local_sock = self.connection
+        observer = self._config.observer
 
-        if self._local_linger_args is not None:
+        if observer is not None:
+            session_start = _now()
+            observer.session_opened(self._session_id, self.client_address)
+
+        # NOTE: a multiplexed connection is long-lived; the timeouts apply to
+        # the sessions of its streams instead
+        if (self._config.reaper is not None and
+                self._config.tunnel != ForwardServer.TUNNEL_DEMUX):
+            self._timeouts = self._config.reaper.register(local_sock)
+
+        try:
+            self._handle_session(local_sock)
+        finally:
+            self._end_timeouts()
+            if observer is not None:
+                observer.session_closed(self._session_id,
+                                        _now() - session_start)
+
+
+    def _handle_session(self, local_sock):
+        """Set up the session's remote end and forward data until done"""
+        config = self._config
+        if config.local_linger_args is not None:
             # Set SO_LINGER socket options on local socket
-            l_onoff, l_linger = self._local_linger_args
+            l_onoff, l_linger = config.local_linger_args
             local_sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
                                   struct.pack('ii', l_onoff, l_linger))
 
-        if self._remote_addr is not None:
-            # Forwarding set-up
-            remote_dest_sock = remote_src_sock = socket.socket(
-                family=self._remote_addr_family,
-                type=self._remote_socket_type,
-                proto=socket.IPPROTO_IP)
-            remote_dest_sock.connect(self._remote_addr)
-            _trace("%s _TCPHandler connected to remote %s",
-                   datetime.utcnow(), remote_dest_sock.getpeername())
+        if config.server_ssl_context is not None:
+            # TLS termination
+            tls_sock = config.server_ssl_context.wrap_socket(
+                local_sock, server_side=True, do_handshake_on_connect=False)
+            # NOTE: python 3 detaches local_sock, so the reaper needs the TLS
+            # socket in order to interrupt a stalled handshake
+            self._watch(tls_sock)
+            try:
+                tls_sock.do_handshake()
+            except (ssl.SSLError, socket.error) as exc:
+                config.counters.add("tls_server_handshake_failures")
+                _trace("%s TLS handshake with %s failed: %r",
+                       datetime.utcnow(), self.client_address, exc)
+                self._end_timeouts()
+                tls_sock.close()
+                return
+
+            config.counters.add("tls_server_handshakes")
+            local_sock = _TLSSocket(tls_sock)
+
+            try:
+                self._run_forwarders(local_sock)
+            finally:
+                self._end_timeouts()
+                local_sock.close()
         else:
-            # Echo set-up
-            remote_dest_sock, remote_src_sock = socket_pair()
+            self._run_forwarders(local_sock)
+
 
+    def _run_forwarders(self, local_sock):
+        """Set up the remote end and forward data in both directions"""
+        config = self._config
+        if config.remote_addr is None:
+            # Echo: a single loop sends the local peer's data right back
+            self._forward(local_sock, local_sock, None)
+            return
+
+        if config.tunnel == ForwardServer.TUNNEL_DEMUX:
+            self._demultiplex(local_sock)
+            return
+
+        try:
+            remote_sock = self._connect_remote()
+        except socket.timeout:
+            config.counters.add("timeouts_connect")
+            _trace("%s Timed out connecting to remote %s for %s",
+                   datetime.utcnow(), config.remote_addr, self.client_address)
+            return
+
+        self._watch(remote_sock)
         try:
             local_forwarder = threading.Thread(
                 target=self._forward,
-                args=(local_sock, remote_dest_sock,))
+                args=(local_sock, remote_sock,
+                      ForwardObserver.DIRECTION_UPSTREAM))
             local_forwarder.setDaemon(True)
             local_forwarder.start()
 
             try:
-                self._forward(remote_src_sock, local_sock)
+                self._forward(remote_sock, local_sock,
+                              ForwardObserver.DIRECTION_DOWNSTREAM)
             finally:
                 # Wait for local forwarder thread to exit
                 local_forwarder.join()
         finally:
+            # NOTE: before the sockets are closed, so that the reaper can't
+            # shut down a reused descriptor
+            self._end_timeouts()
             try:
-                try:
-                    _safe_shutdown_socket(remote_dest_sock,
-                                          socket.SHUT_RDWR)
-                finally:
-                    if remote_src_sock is not remote_dest_sock:
-                        _safe_shutdown_socket(remote_src_sock,
-                                              socket.SHUT_RDWR)
+                _safe_shutdown_socket(remote_sock, socket.SHUT_RDWR)
             finally:
-                remote_dest_sock.close()
-                if remote_src_sock is not remote_dest_sock:
-                    remote_src_sock.close()
+                if (config.tls_session_cache is not None and
+                        config.mux_client is None):
+                    # NOTE: with TLS 1.3, the resumable session becomes
+                    # available only after the server's session ticket is
+                    # received, so refresh the cache at the end, too
+                    config.tls_session_cache.put(config.remote_addr,
+                                                 remote_sock)
+                remote_sock.close()
+
+
+    def _watch(self, sock):
+        """Have the reaper shut down sock, too, when reclaiming the session"""
+        if self._timeouts is not None:
+            self._config.reaper.watch(self._timeouts, sock)
+
+
+    def _end_timeouts(self):
+        """Stop enforcing the session's timeouts; idempotent"""
+        if self._timeouts is not None:
+            self._config.reaper.unregister(self._timeouts)
+
+
+    def _demultiplex(self, mux_sock):
+        """ Serve a multiplexed connection from a ForwardServer.TUNNEL_MUX
+        peer until it ends, running a session for each of its streams
+        """
+        config = self._config
+        # NOTE: TLS and SO_LINGER apply to the multiplexed connection
+        stream_config = copy.copy(config)
+        stream_config.tunnel = None
+        stream_config.server_ssl_context = None
+        stream_config.local_linger_args = None
+
+        connection = MuxConnection(
+            mux_sock,
+            config.counters,
+            config.mux_window,
+            on_open=partial(_start_stream_session, stream_config))
+        config.counters.add("mux_connections")
+        _trace("%s Demultiplexing connection from %s", datetime.utcnow(),
+               self.client_address)
+        connection.run()
+
+
+    def _connect_remote(self):
+        """ Connect to the remote address, originating TLS if configured; in
+        ForwardServer.TUNNEL_MUX mode, open a stream to the peer instead
+
+        :returns: the connected socket or `inetpy.tunnel_mux.MuxStream`
+        """
+        config = self._config
+        connect_start = _now()
+        if config.mux_client is not None:
+            sock = config.mux_client.open_stream()
+        else:
+            sock = _open_connection(config)
+
+        if config.observer is not None:
+            config.observer.upstream_connected(self._session_id,
+                                               config.remote_addr,
+                                               _now() - connect_start)
+        _trace("%s _TCPHandler connected to remote %s",
+               datetime.utcnow(), sock.getpeername())
+        return sock
 
 
-    def _forward(self, src_sock, dest_sock): # pylint: disable=R0912
-        """Forward from src_sock to dest_sock"""
-        src_peername = src_sock.getpeername()
+    def _forward(self, src_sock, dest_sock, direction): # pylint: disable=R0912,R0914,R0915
+        """Forward from src_sock to dest_sock
+
+        :param str direction: ForwardObserver.DIRECTION_UPSTREAM or
+            ForwardObserver.DIRECTION_DOWNSTREAM; reported to the observer.
+            None in echo mode, where src_sock and dest_sock are the same local
+            socket and the data is reported in both directions.
+        """
+        config = self._config
+        src_peername = _peer_name(src_sock)
+
+        if direction is None:
+            # NOTE: echoed data passes through the stages of both directions
+            directions = (ForwardObserver.DIRECTION_UPSTREAM,
+                          ForwardObserver.DIRECTION_DOWNSTREAM)
+        else:
+            directions = (direction,)
+
+        # NOTE: the I/O callables are bound once up front; they are wrapped
+        # with timing hooks only when there is an observer, which keeps the
+        # per-chunk path free of instrumentation checks otherwise
+        recv_into = src_sock.recv_into
+        sendall = dest_sock.sendall
+        if config.observer is not None:
+            recv_into, sendall = _observed_io(config.observer,
+                                              self._session_id, directions,
+                                              recv_into, sendall)
+        if config.idle_timeout is not None and self._timeouts is not None:
+            recv_into = _activity_tracked(self._timeouts, recv_into)
+
+        # Called in order at EOF to send out data held back by the tunnel
+        # stages, if any
+        flushes = []
+        if config.tunnel in (ForwardServer.TUNNEL_COMPRESS,
+                             ForwardServer.TUNNEL_DECOMPRESS):
+            for stage_direction in reversed(directions):
+                sendall, flush = self._tunnel_stage(stage_direction, src_sock,
+                                                    sendall)
+                flushes.insert(0, flush)
+        elif config.coalesce_hold_time is not None:
+            sendall = self._coalescing_stage(src_sock, dest_sock, recv_into,
+                                             sendall)
 
         _trace("%s forwarding from %s to %s", datetime.utcnow(),
-               src_peername, dest_sock.getpeername())
+               src_peername, _peer_name(dest_sock))
         try:
+            # NOTE: idle sessions may be many, so the receive buffer is
+            # allocated only once there is something to receive
+            while not _wait_readable(src_sock, None):
+                pass
+
             # NOTE: python 2.6 doesn't support bytearray with recv_into, so
             # we use array.array instead; this is only okay as long as the
             # array instance isn't shared across threads. See
             # http://bugs.python.org/issue7827 and
             # groups.google.com/forum/#!topic/comp.lang.python/M6Pqr-KUjQw
-            rx_buf = array.array("B", [0] * self._SOCK_RX_BUF_SIZE)
+            rx_buf = array.array("B", b"\0" * self._SOCK_RX_BUF_SIZE)
 
             while True:
                 try:
-                    nbytes = src_sock.recv_into(rx_buf)
+                    nbytes = recv_into(rx_buf)
                 except socket.error as exc:
                     if exc.errno == errno.EINTR:
                         continue
@@ -434,6 +1158,11 @@ class _TCPHandler(SocketServer.StreamRequestHandler, object):
                         _trace("%s errno.ECONNRESET from %s",
                                datetime.utcnow(), src_peername)
                         break
+                    elif _is_tls_ragged_eof(exc):
+                        # TLS peer closed connection without close_notify
+                        _trace("%s TLS EOF without close_notify from %s",
+                               datetime.utcnow(), src_peername)
+                        break
                     else:
                         _trace("%s Unexpected errno=%s from %s\n%s",
                                datetime.utcnow(), exc.errno, src_peername,
@@ -443,28 +1172,34 @@ class _TCPHandler(SocketServer.StreamRequestHandler, object):
                 if not nbytes:
                     # Source input EOF
                     _trace("%s EOF on %s", datetime.utcnow(), src_peername)
-                    break
+                    if not flushes:
+                        break
 
                 try:
-                    dest_sock.sendall(buffer(rx_buf, 0, nbytes))
+                    if nbytes:
+                        sendall(_head_view(rx_buf, nbytes))
+                    else:
+                        for flush in flushes:
+                            flush()
+                        break
                 except socket.error as exc:
                     if exc.errno == errno.EPIPE:
                         # Destination peer closed its end of the connection
                         _trace("%s Destination peer %s closed its end of "
                                "the connection: errno.EPIPE",
-                               datetime.utcnow(), dest_sock.getpeername())
+                               datetime.utcnow(), _peer_name(dest_sock))
                         break
                     elif exc.errno == errno.ECONNRESET:
                         # Destination peer forcibly closed connection
                         _trace("%s Destination peer %s forcibly closed "
                                "connection: errno.ECONNRESET",
-                               datetime.utcnow(), dest_sock.getpeername())
+                               datetime.utcnow(), _peer_name(dest_sock))
                         break
                     else:
                         _trace(
                             "%s Unexpected errno=%s in sendall to %s\n%s",
                             datetime.utcnow(), exc.errno,
-                            dest_sock.getpeername(),
+                            _peer_name(dest_sock),
                             "".join(traceback.format_stack()))
                         raise
         except:
@@ -481,9 +1216,413 @@ class _TCPHandler(SocketServer.StreamRequestHandler, object):
                 _safe_shutdown_socket(dest_sock, socket.SHUT_WR)
 
 
+    def _tunnel_stage(self, direction, src_sock, sendall):
+        """ Create the compressing or decompressing stage of the tunnel for
+        the given direction
+
+        :returns: two-tuple (send, flush): `send` replaces sendall; `flush`
+            is to be called at EOF
+        """
+        config = self._config
+        upstream = direction == ForwardObserver.DIRECTION_UPSTREAM
+        if upstream == (config.tunnel == ForwardServer.TUNNEL_COMPRESS):
+            stage = StreamCompressor(
+                config.tunnel_codec,
+                sendall,
+                partial(_wait_readable, src_sock),
+                config.counters,
+                latency_budget=config.tunnel_latency_budget)
+        else:
+            stage = StreamDecompressor(sendall, config.counters)
+
+        return stage.send, stage.flush
+
+
+    def _coalescing_stage(self, src_sock, dest_sock, recv_into, sendall):
+        """ Create the write coalescing stage for a direction
+
+        :returns: callable that replaces sendall
+        """
+        config = self._config
+        if (_HAVE_SENDMSG and config.observer is None and
+                isinstance(dest_sock, socket.socket)):
+            send_buffers = partial(_sendmsg_all, dest_sock)
+        else:
+            # NOTE: keeps reporting sends to the observer and works with
+            # _TLSSocket
+            send_buffers = lambda buffers: sendall(b"".join(buffers))
+
+        if _MSG_DONTWAIT and isinstance(src_sock, socket.socket):
+            recv_more = partial(_recv_into_nowait, recv_into)
+        else:
+            # NOTE: _TLSSocket.recv_into doesn't take flags
+            recv_more = lambda buf: (recv_into(buf)
+                                     if _wait_readable(src_sock, 0) else None)
+
+        stage = _CoalescingStage(send_buffers,
+                                 recv_more,
+                                 partial(_wait_readable, src_sock),
+                                 config.counters,
+                                 hold_time=config.coalesce_hold_time,
+                                 max_bytes=config.coalesce_bytes)
+
+        return stage.send
+
+
+
+def _open_connection(config):
+    """ Connect to the target server, originating TLS if configured
+
+    :param _SessionConfig config:
+
+    :returns: the connected socket
+    """
+    sock = config.transport.socket(family=config.remote_addr_family,
+                                   type=config.remote_socket_type,
+                                   proto=socket.IPPROTO_IP)
+    try:
+        # NOTE: also applies to the TLS handshake; _TLSSocket makes the
+        # socket non-blocking afterwards
+        sock.settimeout(config.connect_timeout)
+        sock.connect(config.remote_addr)
+
+        if config.remote_ssl_context is None:
+            sock.settimeout(None)
+        else:
+            sock = _TLSSocket(config.tls_session_cache.wrap_socket(
+                config.remote_ssl_context,
+                sock,
+                config.remote_addr,
+                config.remote_server_hostname))
+            config.counters.add("tls_client_handshakes")
+            if getattr(sock, "session_reused", False):
+                config.counters.add("tls_client_resumed")
+    except:
+        sock.close()
+        raise
+
+    return sock
+
+
+
+def _start_stream_session(config, stream):
+    """ Run the session of a demultiplexed stream in a thread of its own
+
+    :param _SessionConfig config: settings of the streams' sessions
+    :param inetpy.tunnel_mux.MuxStream stream: stream opened by the peer
+    """
+    def run_session():
+        """Run the session and release the stream"""
+        try:
+            _TCPHandler(stream, stream.getpeername(), None, config)
+        except Exception:  # pylint: disable=W0703
+            _trace("%s Session of %s failed\n%s", datetime.utcnow(),
+                   stream.getpeername(), "".join(traceback.format_exc()))
+        finally:
+            stream.close()
+
+    thread = threading.Thread(target=run_session)
+    thread.setDaemon(True)
+    thread.start()
+
+
+
+class _CoalescingStage(object):
+    """ Holds a received chunk for up to the hold time, gathering whatever
+    else the source receives meanwhile, and sends it all together in one go
+    once the held chunks reach the size limit or the hold time is up.
+
+    Waits for the source to become readable, with the end of the hold time as
+    the deadline, so a full batch doesn't wait out the hold time. Not
+    thread-safe.
+    """
+
+    # Maximum number of chunks per send; well within IOV_MAX
+    _MAX_CHUNKS = 64
+
+    # After a chunk is held in vain, this many chunks are sent right away
+    # before holding is tried again
+    _PROBE_INTERVAL = 8
+
+    # Same as the forwarding loop's receive buffer
+    _RX_BUF_SIZE = 16 * 1024
+
+
+    def __init__(self, send_buffers, recv_more, wait_readable, counters,  # pylint: disable=R0913
+                 hold_time, max_bytes):
+        """
+        :param send_buffers: callable of (list of buffers) that sends all of
+            them in order
+        :param recv_more: callable of (buffer) that receives into the buffer
+            without blocking; returns the number of bytes received, 0 at EOF,
+            or None if no data is available
+        :param wait_readable: callable of (timeout) that waits up to timeout
+            seconds for the source to become readable; returns True if it is
+        :param _SharedCounters counters: counters with the "coalesce_*" names
+        :param float hold_time: number of seconds to hold a chunk
+        :param int max_bytes: stop gathering once the held chunks add up to
+            this size
+        """
+        self._send_buffers = send_buffers
+        self._recv_more = recv_more
+        self._wait_readable = wait_readable
+        self._counters = counters
+        self._hold_time = hold_time
+        self._max_bytes = max_bytes
+
+        # Allocated on first use
+        self._rx_buf = None
+
+        # Upper envelope of how late, after a timed-out wait, the held chunks
+        # are sent; waits end this much early, so that the host's timer slack
+        # and the send itself don't stretch holds past the hold time
+        self._wait_overshoot = 0.0
+
+        # Chunks left to send without holding; see _PROBE_INTERVAL. Keeps
+        # request/response traffic from paying the hold time on every chunk
+        self._skip_holds = 0
+
+
+    def send(self, data):
+        """Hold the chunk, then send it together with the data that the
+        source received meanwhile
+        """
+        # NOTE: copy, since the caller reuses its buffer
+        held = [bytes(data)]
+        held_bytes = len(data)
+
+        if self._skip_holds:
+            self._skip_holds -= 1
+            self._send_buffers(held)
+            self._counters.add_many((("coalesce_flushes", 1),
+                                     ("coalesce_chunks", 1)))
+            return
+
+        start = _now()
+        deadline = start + self._hold_time
+        if self._rx_buf is None:
+            self._rx_buf = array.array("B", b"\0" * self._RX_BUF_SIZE)
+
+        # NOTE: each wait counts as one poll; so does a receive that finds
+        # no data. Unless the chunk filled the caller's buffer, the source is
+        # drained, so wait before receiving more
+        polls = 0
+        timed_out_at = None
+        wait = held_bytes < self._RX_BUF_SIZE
+        while held_bytes < self._max_bytes and len(held) < self._MAX_CHUNKS:
+            if wait:
+                now = _now()
+                timeout = deadline - now - self._wait_overshoot
+                if timeout <= 0:
+                    # NOTE: lets the envelope decay after a spike that left
+                    # no time to wait
+                    self._track_overshoot(0.0)
+                    break
+                polls += 1
+                if not self._wait_readable(timeout):
+                    # Hold time is up (or the wait was interrupted)
+                    timed_out_at = now + timeout
+                    break
+
+            try:
+                nbytes = self._recv_more(self._rx_buf)
+            except socket.error:
+                # NOTE: the next regular receive runs into the error, too
+                nbytes = 0
+
+            if nbytes is None:
+                polls += 1
+                wait = True
+                continue
+            if not nbytes:
+                break
+
+            held.append(_array_to_bytes(self._rx_buf[:nbytes]))
+            held_bytes += nbytes
+            wait = nbytes < len(self._rx_buf)
+
+        if len(held) == 1:
+            self._skip_holds = self._PROBE_INTERVAL - 1
+
+        self._send_buffers(held)
+        if timed_out_at is not None:
+            self._track_overshoot(_now() - timed_out_at)
+
+        self._counters.add_many((
+            ("coalesce_flushes", 1),
+            ("coalesce_chunks", len(held)),
+            ("coalesce_polls", polls),
+            ("coalesce_hold_usec", int((_now() - start) * 1e6))))
+
+
+    def _track_overshoot(self, overshoot):
+        """Update the overshoot envelope with a timed-out hold's overshoot;
+        rises quickly and decays slowly, so that it tracks the tail rather
+        than the mean
+        """
+        if overshoot > self._wait_overshoot:
+            self._wait_overshoot += (overshoot - self._wait_overshoot) / 2
+        else:
+            self._wait_overshoot += (overshoot - self._wait_overshoot) / 64
+
+
+
+# Scatter-gather send is available in python 3.3+ on POSIX
+_HAVE_SENDMSG = hasattr(socket.socket, "sendmsg")
+
+# Per-call non-blocking receive flag; POSIX only
+_MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
+
+# array.tostring was renamed to tobytes in python 3
+_array_to_bytes = getattr(array.array, "tobytes", None) or array.array.tostring  # pylint: disable=C0103
+
+
+if sys.version_info[0] >= 3:
+    def _head_view(buf, nbytes):
+        """:returns: zero-copy view of the first nbytes of buf"""
+        return memoryview(buf)[:nbytes]
+else:
+    def _head_view(buf, nbytes):
+        """:returns: zero-copy view of the first nbytes of buf
+
+        NOTE: python 2's `buffer`, since str() of a python 2 memoryview is
+        its repr, not its contents
+        """
+        return buffer(buf, 0, nbytes)  # pylint: disable=E0602
+
+
+
+def _recv_into_nowait(recv_into, buf):
+    """ Receive into buf without blocking
+
+    :param recv_into: socket's recv_into, possibly wrapped by `_observed_io`
+
+    :returns: number of bytes received, 0 at EOF, or None if no data is
+        available
+    """
+    try:
+        return recv_into(buf, 0, _MSG_DONTWAIT)
+    except socket.error as exc:
+        if exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return None
+        raise
+
+
+def _sendmsg_all(sock, buffers):
+    """ Send all of the buffers with as few scatter-gather `sendmsg` calls
+    as the socket allows
+
+    :param socket.socket sock: blocking socket
+    :param list buffers: bytes objects to send in order
+    """
+    while buffers:
+        nbytes = sock.sendmsg(buffers)
+
+        # Drop what was sent and retry with the remainder
+        index = 0
+        while index < len(buffers) and nbytes >= len(buffers[index]):
+            nbytes -= len(buffers[index])
+            index += 1
+        buffers = buffers[index:]
+        if nbytes:
+            buffers[0] = memoryview(buffers[0])[nbytes:]
+
+
+
+# select() can't handle descriptors at or above FD_SETSIZE
+_FD_SETSIZE = 1024
+
+
+def _wait_readable(sock, timeout):
+    """ Wait for the socket to have data (or EOF) to receive
+
+    :param float timeout: maximum time to wait, in seconds; None to wait
+        indefinitely
+
+    :returns: True if readable; False on timeout or EINTR
+    """
+    pending = getattr(sock, "pending", None)
+    if pending is not None and pending():
+        # TLS data already decrypted and buffered
+        return True
+
+    wait_readable = getattr(sock, "wait_readable", None)
+    if wait_readable is not None:
+        # Simulated socket (see inetpy.simnet), which has no descriptor
+        return wait_readable(timeout)
+
+    try:
+        if sock.fileno() < _FD_SETSIZE or not hasattr(select, "poll"):
+            # NOTE: select's timeout has microsecond resolution, which the
+            # coalescing and tunnel stages rely on
+            return bool(select.select([sock], [], [], timeout)[0])
+
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        # NOTE: poll's timeout is in milliseconds; round up so that short
+        # waits don't degrade into busy polling
+        return bool(poller.poll(
+            None if timeout is None else int(math.ceil(timeout * 1000))))
+    except select.error as exc:
+        if exc.args[0] == errno.EINTR:
+            return False
+        raise
+
+
+
+def _observed_io(observer, session_id, directions, recv_into, sendall):
+    """ Wrap a socket's `recv_into` and `sendall` with timing hooks that
+    report each received and each sent chunk to the observer
+
+    :param tuple directions: directions to report the chunks in; both of
+        them in echo mode
+
+    :returns: two-tuple of wrapped (recv_into, sendall)
+    """
+    def observed_recv_into(buf, *args):
+        """recv_into with chunk_received reporting"""
+        start = _now()
+        nbytes = recv_into(buf, *args)
+        if nbytes:
+            elapsed = _now() - start
+            for direction in directions:
+                observer.chunk_received(session_id, direction, nbytes,
+                                        elapsed)
+        return nbytes
+
+    def observed_sendall(data):
+        """sendall with chunk_sent reporting"""
+        start = _now()
+        sendall(data)
+        elapsed = _now() - start
+        for direction in directions:
+            observer.chunk_sent(session_id, direction, len(data), elapsed)
+
+    return observed_recv_into, observed_sendall
+
+
+
+def _activity_tracked(timeouts, recv_into):
+    """ Wrap a socket's `recv_into` so that each receive records session
+    activity for the idle timeout
+
+    :param _SessionTimeouts timeouts: the session's timeouts entry
+
+    :returns: wrapped recv_into
+    """
+    def tracked_recv_into(buf, *args):
+        """recv_into that updates the session's last activity time"""
+        nbytes = recv_into(buf, *args)
+        timeouts.last_active = _now()
+        return nbytes
+
+    return tracked_recv_into
+
+
+
 def echo(port=0):
-    """ This function implements a simple echo server for testing the
-    Forwarder class.
+    """ This function implements an echo server for testing the Forwarder
+    class.
 
     :param int port: port number on which to listen
 
@@ -492,34 +1631,849 @@ def echo(port=0):
     Then, we run telnet and point it at forwarder and see if whatever we
     type gets echoed back to us.
 
-    This function exits when the remote end connects, then closes connection
+    This function serves any number of connections, printing throughput once
+    a second, until interrupted. See `inetpy.bench_server` for the discard
+    and chargen modes and for running it in a subprocess.
     """
-    lsock = socket.socket()
-    lsock.bind(("", port))
-    lsock.listen(1)
-    _trace("Listening on sockname=%s", lsock.getsockname())
+    bench_server.serve(
+        bench_server.MODE_ECHO,
+        ("", port),
+        report_interval=1.0,
+        listening_callback=partial(_trace, "Listening on sockname=%s"))
 
-    sock, remote_addr = lsock.accept()
-    try:
-        _trace("Connection from peer=%s", remote_addr)
-        while True:
+
+
+class _WorkerPool(object):
+    """ Forwarding worker processes that receive accepted connections from
+    the accepting process via SCM_RIGHTS over AF_UNIX sockets.
+
+    Each worker is forked with a duplex `multiprocessing.Pipe`. For each
+    session, the acceptor sends the client address followed by the descriptor;
+    the worker reports its load back on every session start and end and at
+    least every _LOAD_REPORT_INTERVAL seconds. Workers exit when the acceptor
+    goes away. Not thread-safe; used by the acceptor's thread only.
+    """
+
+    # Weight of a worker's recent CPU use, in CPU-seconds per second, relative
+    # to one session; e.g., a worker busy on one core counts as this many
+    # additional sessions
+    _CPU_LOAD_WEIGHT = 10.0
+
+
+    class _Worker(object):
+        """Acceptor's record of a worker process"""
+
+        def __init__(self, pid, conn):
+            self.pid = pid
+            self.conn = conn
+            self.dispatched = 0
+            self.received = 0
+            self.active = 0
+            self.cpu_rate = 0.0
+
+        @property
+        def sessions(self):
+            """Active sessions, including those still in flight"""
+            return self.active + self.dispatched - self.received
+
+
+    def __init__(self, num_workers, handler_factory, counters, fd_budget,
+                 listener):
+        """
+        :param int num_workers: number of worker processes
+        :param handler_factory: callable of (request, client_address, server)
+            that runs a session to completion
+        :param _SharedCounters counters: server counters
+        :param _FdBudget fd_budget: acceptor's descriptor budget, which each
+            worker's sessions are checked against
+        :param socket.socket listener: listening socket to close in workers
+        """
+        assert num_workers > 0, num_workers
+
+        self._handler_factory = handler_factory
+        self._counters = counters
+        self._fd_budget = fd_budget
+        self._listener = listener
+
+        self._workers = []
+        for _ in range(num_workers):
+            self._workers.append(self._spawn())
+
+
+    def admit(self):
+        """ Check whether some worker has room for another session within the
+        descriptor budget
+
+        :rtype: bool
+        """
+        self._poll()
+        return any(self._fd_budget.fits(worker.sessions + 1)
+                   for worker in self._workers)
+
+
+    def dispatch(self, request, client_address):
+        """ Hand the connection off to the least-loaded worker, preferring
+        workers with room in the descriptor budget
+
+        :param socket.socket request: accepted connection; the caller retains
+            and eventually closes its descriptor
+        :param client_address: connection's peer address
+
+        :returns: True if handed off; False if all attempts failed
+        """
+        self._poll()
+
+        for _ in range(len(self._workers) + 1):
+            worker = min(self._workers,
+                         key=lambda w: (
+                             not self._fd_budget.fits(w.sessions + 1),
+                             w.sessions + w.cpu_rate * self._CPU_LOAD_WEIGHT))
             try:
-                data = sock.recv(4 * 1024) # pylint: disable=E1101
-            except socket.error as exc:
-                if exc.errno == errno.EINTR:
-                    continue
-                else:
-                    raise
+                worker.conn.send((client_address, request.family,
+                                  request.type))
+                multiprocessing.reduction.send_handle(worker.conn,
+                                                      request.fileno(),
+                                                      worker.pid)
+            except (IOError, OSError, socket.error) as exc:
+                _trace("%s Hand-off to worker pid=%s failed: %r",
+                       datetime.utcnow(), worker.pid, exc)
+                self._replace(worker)
+                continue
+
+            worker.dispatched += 1
+            return True
+
+        self._counters.add("handoff_failures")
+        return False
+
+
+    def _poll(self):
+        """Process workers' load reports and replace dead workers"""
+        for worker in list(self._workers):
+            try:
+                while worker.conn.poll():
+                    (worker.received, worker.active,
+                     worker.cpu_rate) = worker.conn.recv()
+            except (EOFError, IOError, OSError):
+                self._replace(worker)
+
+
+    def _replace(self, worker):
+        """Reap the given dead or broken worker and spawn a replacement"""
+        _trace("%s Replacing forwarding worker pid=%s with %s sessions",
+               datetime.utcnow(), worker.pid, worker.sessions)
+        worker.conn.close()
+        try:
+            os.kill(worker.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        os.waitpid(worker.pid, 0)
+
+        # The worker's sessions died with it
+        self._counters.add("active_sessions", -worker.sessions)
+        self._counters.add("worker_respawns")
+
+        self._workers[self._workers.index(worker)] = self._spawn()
+
+
+    def _spawn(self):
+        """:returns: record of a newly-forked worker"""
+        parent_conn, child_conn = multiprocessing.Pipe(duplex=True)
+
+        pid = os.fork()
+        if pid == 0:
+            # Worker process
+            exit_code = 0
+            try:
+                parent_conn.close()
+                self._listener.close()
+                for worker in self._workers:
+                    worker.conn.close()
+
+                _run_worker(child_conn, self._handler_factory, self._counters)
+            except:  # pylint: disable=W0702
+                _trace("%s Forwarding worker failed\n%s", datetime.utcnow(),
+                       "".join(traceback.format_exc()))
+                exit_code = 1
+            finally:
+                os._exit(exit_code)  # pylint: disable=W0212
+
+        child_conn.close()
+        return self._Worker(pid, parent_conn)
+
+
+
+# Maximum interval, in seconds, between a worker's load reports
+_LOAD_REPORT_INTERVAL = 0.5
+
+# Descriptors a worker holds in reserve for receiving a hand-off: the
+# descriptor itself and its duplicate made by `socket.fromfd`, plus the
+# connection's duplicate made by python 3's `recv_handle`
+_WORKER_SPARE_FDS = 3
+
+_FD_EXHAUSTED = (errno.EMFILE, errno.ENFILE)
 
-            if not data:
-                break
 
-            sock.sendall(data) # pylint: disable=E1101
-    finally:
+def _run_worker(conn, handler_factory, counters):
+    """ Run sessions handed off by the acceptor until it goes away; executed
+    in a forwarding worker process
+
+    :param multiprocessing.Connection conn: worker's end of the acceptor pipe
+    :param handler_factory: callable of (request, client_address, server)
+        that runs a session to completion
+    :param _SharedCounters counters: server counters
+    """
+    lock = threading.Lock()
+    state = dict(received=0, active=0, cpu=sum(os.times()[:2]), time=_now())
+
+    def report():
+        """Send (received, active, cpu_rate) to the acceptor"""
+        with lock:
+            now = _now()
+            cpu = sum(os.times()[:2])
+            cpu_rate = (cpu - state["cpu"]) / max(now - state["time"], 1e-3)
+            state.update(cpu=cpu, time=now)
+            try:
+                conn.send((state["received"], state["active"], cpu_rate))
+            except (IOError, OSError):
+                pass
+
+    def run_session(sock, client_address):
+        """Run the session and clean up"""
         try:
-            _safe_shutdown_socket(sock, socket.SHUT_RDWR)
+            handler_factory(sock, client_address, None)
+        except Exception:  # pylint: disable=W0703
+            _trace("%s Session from %s failed\n%s", datetime.utcnow(),
+                   client_address, "".join(traceback.format_exc()))
         finally:
+            try:
+                _safe_shutdown_socket(sock, socket.SHUT_WR)
+            except socket.error:
+                pass
+            sock.close()
+            counters.add("active_sessions", -1)
+            with lock:
+                state["active"] -= 1
+            report()
+
+    def report_periodically():
+        """Keep the acceptor's view of our CPU use fresh"""
+        while True:
+            time.sleep(_LOAD_REPORT_INTERVAL)
+            report()
+
+    reporter = threading.Thread(target=report_periodically)
+    reporter.setDaemon(True)
+    reporter.start()
+
+    def drop(sock, client_address, exc):
+        """Close a handed-off connection that there's no room for"""
+        _trace("%s Dropped connection from %s: %r", datetime.utcnow(),
+               client_address, exc)
+        if sock is not None:
             sock.close()
+        counters.add_many([("active_sessions", -1),
+                           ("refused_fd_exhausted", 1)])
+        with lock:
+            state["received"] += 1
+        report()
+
+    # NOTE: released while receiving each hand-off, so that descriptors used
+    # up by sessions can't make the worker fail to receive the next one
+    spares = []
+
+    while True:
+        try:
+            _reserve_fds(spares, _WORKER_SPARE_FDS)
+        except OSError as exc:
+            if exc.errno not in _FD_EXHAUSTED:
+                raise
+
+        try:
+            client_address, family, sock_type = conn.recv()
+        except (EOFError, IOError, OSError):
+            # Acceptor is gone
+            return
+
+        _reserve_fds(spares, 0)
+
+        try:
+            fd = multiprocessing.reduction.recv_handle(conn)
+        except EOFError:
+            # Acceptor is gone
+            return
+        except (IOError, OSError) as exc:
+            if exc.errno not in _FD_EXHAUSTED:
+                # Acceptor is gone
+                return
+            drop(None, client_address, exc)
+            continue
+        except RuntimeError as exc:
+            # NOTE: python 3 reports a descriptor discarded for lack of room
+            # this way
+            drop(None, client_address, exc)
+            continue
+
+        try:
+            sock = socket.fromfd(fd, family, sock_type)
+        except socket.error as exc:
+            if exc.errno not in _FD_EXHAUSTED:
+                raise
+            drop(None, client_address, exc)
+            continue
+        finally:
+            os.close(fd)
+
+        if not isinstance(sock, socket.socket):
+            # NOTE: python 2 returns the low-level socket type, whose makefile
+            # duplicates the descriptor; wrap it the same way `accept` does
+            sock = socket.socket(family, sock_type, _sock=sock)
+
+        try:
+            _reserve_fds(spares, _WORKER_SPARE_FDS)
+        except OSError as exc:
+            if exc.errno not in _FD_EXHAUSTED:
+                raise
+            # The session would leave no room for receiving the next one
+            drop(sock, client_address, exc)
+            continue
+
+        with lock:
+            state["received"] += 1
+            state["active"] += 1
+
+        session = threading.Thread(target=run_session,
+                                   args=(sock, client_address))
+        session.setDaemon(True)
+        session.start()
+
+        report()
+
+
+
+class _FdBudget(object):
+    """ Admission control that keeps the forwarding subprocess below its
+    RLIMIT_NOFILE ceiling. Thread-safe.
+
+    Open descriptors are estimated as the count at start-up plus a fixed
+    number per active session; new sessions are refused when the estimate
+    reaches the limit less a reserve. As a last resort, a spare descriptor is
+    held for shedding a pending connection when `accept` fails with EMFILE.
+    """
+
+    # Descriptors kept free for the listener, logging, subprocess plumbing, etc.
+    _RESERVE = 16
+
+
+    def __init__(self, fds_per_session, max_open_files):
+        """
+        :param int fds_per_session: descriptors used by a session, including
+          the accepted local socket
+        :param int max_open_files: RLIMIT_NOFILE soft limit to set; None to
+          keep the current limit
+        """
+        self._fds_per_session = fds_per_session
+        self._limit = _set_nofile_limit(max_open_files)
+        self._baseline = _count_open_fds()
+        self._lock = threading.Lock()
+        self._sessions = 0
+        self._spare_fd = os.open(os.devnull, os.O_RDONLY)
+
+
+    def admit(self):
+        """ Check whether the most recently started session fits in the
+        budget
+
+        :rtype: bool
+        """
+        with self._lock:
+            sessions = self._sessions
+
+        return self.fits(sessions)
+
+
+    def fits(self, sessions):
+        """ Check whether a process with the given number of sessions stays
+        within the budget; e.g., a forwarding worker, which inherits the
+        acceptor's limit and, approximately, its baseline
+
+        :param int sessions: sessions in the process, including a new one
+
+        :rtype: bool
+        """
+        if self._limit is None:
+            return True
+
+        estimate = self._baseline + sessions * self._fds_per_session
+        return estimate <= self._limit - self._RESERVE
+
+
+    def session_started(self):
+        """Account for an accepted connection"""
+        with self._lock:
+            self._sessions += 1
+
+
+    def session_ended(self):
+        """Account for a closed connection"""
+        with self._lock:
+            self._sessions -= 1
+
+
+    def shed_pending(self, listener):
+        """ Accept and immediately close a pending connection using the spare
+        descriptor; called after `accept` fails for lack of descriptors
+        """
+        os.close(self._spare_fd)
+        try:
+            conn = listener.accept()[0]
+        except socket.error:
+            pass
+        else:
+            conn.close()
+        finally:
+            self._spare_fd = os.open(os.devnull, os.O_RDONLY)
+
+
+
+def _reserve_fds(spares, count):
+    """ Open or close spare descriptors until the given number are held
+
+    :param list spares: the spare descriptors held; updated in place
+    :param int count: number of spare descriptors to hold
+
+    :raises OSError: EMFILE or ENFILE if out of descriptors, holding as many
+      spares as could be opened
+    """
+    while len(spares) > count:
+        os.close(spares.pop())
+    while len(spares) < count:
+        spares.append(os.open(os.devnull, os.O_RDONLY))
+
+
+
+def _set_nofile_limit(max_open_files):
+    """ Set RLIMIT_NOFILE soft limit of the current process, raising the hard
+    limit too if necessary and permitted
+
+    :param int max_open_files: desired soft limit; None to leave as is
+
+    :returns: the effective soft limit; None if unknown or unlimited
+    """
+    if resource is None:
+        return None
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+
+    if max_open_files is not None:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE,
+                               (max_open_files,
+                                max(hard, max_open_files)
+                                if hard != resource.RLIM_INFINITY else hard))
+        except (ValueError, OSError):
+            # Not permitted to raise the hard limit, so go as high as we can
+            capped = (max_open_files if hard == resource.RLIM_INFINITY
+                      else min(max_open_files, hard))
+            resource.setrlimit(resource.RLIMIT_NOFILE, (capped, hard))
+
+        soft = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+    return None if soft == resource.RLIM_INFINITY else soft
+
+
+
+def _count_open_fds():
+    """:returns: number of open descriptors of the current process; 0 if
+    unknown
+    """
+    for fd_dir in ("/proc/self/fd", "/dev/fd"):
+        try:
+            return len(os.listdir(fd_dir))
+        except OSError:
+            continue
+
+    return 0
+
+
+
+class _SessionTimeouts(object):
+    """Timeout state of one session; see `_SessionReaper`"""
+
+    __slots__ = ("socks", "last_active", "active")
+
+    def __init__(self, sock):
+        """
+        :param sock: the session's local socket
+        """
+        self.socks = [sock]
+        self.last_active = _now()
+        self.active = True
+
+
+
+class _SessionReaper(object):
+    """ Reclaims sessions that exceed the idle timeout or maximum lifetime by
+    shutting down their sockets, whereupon the session's forwarders see EOF
+    or an error and finish. Thread-safe.
+
+    Deadlines are kept in a heap served by a single timer thread per process,
+    started on first use. Activity merely updates the session's timestamp;
+    the idle deadline is checked against it, and pushed back, when it comes
+    up. Entries of finished sessions are dropped lazily.
+    """
+
+    _IDLE = "idle"
+    _LIFETIME = "lifetime"
+
+
+    def __init__(self, idle_timeout, session_lifetime, counters):
+        """
+        :param float idle_timeout: seconds without received data after which
+            a session is reclaimed; None for no limit
+        :param float session_lifetime: seconds after registration after which
+            a session is reclaimed; None for no limit
+        :param _SharedCounters counters: counters with the "timeouts_*" names
+        """
+        self._timeouts = dict()
+        if idle_timeout is not None:
+            self._timeouts[self._IDLE] = idle_timeout
+        if session_lifetime is not None:
+            self._timeouts[self._LIFETIME] = session_lifetime
+        self._counters = counters
+
+        # NOTE: the timer thread and its state are per process, since worker
+        # processes inherit the reaper from the acceptor
+        self._init_lock = threading.Lock()
+        self._pid = None
+        self._cond = None
+        self._heap = None
+        self._seq = None
+
+        # Heap entries of sessions that are no longer active
+        self._stale = 0
+
+
+    def register(self, sock):
+        """ Start enforcing the timeouts on a new session
+
+        :param sock: the session's local socket
+
+        :returns: the session's `_SessionTimeouts`, for passing to the other
+            methods
+        """
+        self._start()
+        timeouts = _SessionTimeouts(sock)
+        with self._cond:
+            for kind, timeout in self._timeouts.items():
+                self._push(timeouts.last_active + timeout, kind, timeouts)
+        return timeouts
+
+
+    def watch(self, timeouts, sock):
+        """Shut down sock, too, when reclaiming the session; immediately if
+        the session has been reclaimed already
+        """
+        with self._cond:
+            timeouts.socks.append(sock)
+            if not timeouts.active:
+                _abort_socket(sock)
+
+
+    def unregister(self, timeouts):
+        """ Stop enforcing the timeouts on the session; must be called before
+        the session's sockets are closed. Idempotent.
+        """
+        with self._cond:
+            if timeouts.active:
+                timeouts.active = False
+                self._stale += len(self._timeouts)
+                if self._stale > len(self._heap) // 2:
+                    # NOTE: amortized; keeps the heap from filling up with
+                    # short sessions when deadlines are far off
+                    self._heap = [entry for entry in self._heap
+                                  if entry[3].active]
+                    heapq.heapify(self._heap)
+                    self._stale = 0
+            timeouts.socks = []
+
+
+    def _start(self):
+        """Start the timer thread in this process, unless already running"""
+        if self._pid == os.getpid():
+            return
+
+        with self._init_lock:
+            if self._pid == os.getpid():
+                return
+
+            self._cond = threading.Condition(threading.Lock())
+            self._heap = []
+            self._seq = itertools.count()
+            self._stale = 0
+
+            timer = threading.Thread(target=self._run)
+            timer.setDaemon(True)
+            timer.start()
+
+            self._pid = os.getpid()
+
+
+    def _push(self, deadline, kind, timeouts):
+        """Add a deadline, waking the timer thread if it's the earliest one;
+        the caller holds the lock
+        """
+        heapq.heappush(self._heap, (deadline, next(self._seq), kind, timeouts))
+        if self._heap[0][3] is timeouts:
+            self._cond.notify()
+
+
+    def _run(self):
+        """Timer thread: reclaim sessions as their deadlines come up"""
+        with self._cond:
+            while True:
+                now = _now()
+                while self._heap and self._heap[0][0] <= now:
+                    _, _, kind, timeouts = heapq.heappop(self._heap)
+                    if not timeouts.active:
+                        self._stale -= 1
+                        continue
+
+                    if kind == self._IDLE:
+                        deadline = timeouts.last_active + self._timeouts[kind]
+                        if deadline > now:
+                            self._push(deadline, kind, timeouts)
+                            continue
+
+                    self._reclaim(timeouts, kind)
+
+                self._cond.wait(self._heap[0][0] - now if self._heap else None)
+
+
+    def _reclaim(self, timeouts, kind):
+        """Shut down the session's sockets; the caller holds the lock"""
+        timeouts.active = False
+        # NOTE: the popped entry is gone, but the session's other ones aren't
+        self._stale += len(self._timeouts) - 1
+        self._counters.add("timeouts_" + kind)
+        _trace("%s Reclaiming session: %s timeout", datetime.utcnow(), kind)
+        for sock in timeouts.socks:
+            _abort_socket(sock)
+
+
+
+def _abort_socket(sock):
+    """ Shut down the socket in both directions from any thread, bypassing
+    TLS, and suppressing errors, e.g., from a socket that is already closed
+    """
+    sock = getattr(sock, "_tls_sock", sock)
+    # NOTE: streams of multiplexed connections are thread-safe
+    shutdown = (socket.socket.shutdown if isinstance(sock, socket.socket)
+                else type(sock).shutdown)
+    try:
+        shutdown(sock, socket.SHUT_RDWR)
+    except (socket.error, ValueError):
+        pass
+
+
+
+class _TLSSocket(object):
+    """ Wraps a connected `ssl.SSLSocket` so that one thread may receive
+    while another one sends, as the session's forwarders do.
+
+    An OpenSSL connection object must not be used by two threads at once, so
+    the TLS socket is placed in non-blocking mode and each TLS operation runs
+    under a lock, while waiting for socket readiness happens outside of it.
+
+    Attributes not defined here are delegated to the wrapped `ssl.SSLSocket`.
+    """
+
+    def __init__(self, tls_sock):
+        """
+        :param ssl.SSLSocket tls_sock: TLS socket after handshake
+        """
+        self._tls_sock = tls_sock
+        self._lock = threading.Lock()
+        self._close_notify_sent = False
+        tls_sock.setblocking(False)
+
+
+    def __getattr__(self, name):
+        return getattr(self._tls_sock, name)
+
+
+    def recv_into(self, buf):
+        """Block until data or EOF is available and receive it into buf
+
+        :returns: number of bytes received; 0 on EOF
+        """
+        while True:
+            with self._lock:
+                try:
+                    return self._tls_sock.recv_into(buf)
+                except ssl.SSLError as exc:
+                    if exc.args[0] == ssl.SSL_ERROR_ZERO_RETURN:
+                        # Received peer's close_notify
+                        return 0
+                    elif exc.args[0] == ssl.SSL_ERROR_WANT_READ:
+                        readable = True
+                    elif exc.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                        readable = False
+                    else:
+                        raise
+
+            self._wait(readable)
+
+
+    def sendall(self, data):
+        """Block until all of data is sent"""
+        offset = 0
+        while offset < len(data):
+            readable = False
+            with self._lock:
+                try:
+                    offset += self._tls_sock.send(
+                        data[offset:] if offset else data)
+                    continue
+                except ssl.SSLError as exc:
+                    if exc.args[0] == ssl.SSL_ERROR_WANT_READ:
+                        readable = True
+                    elif exc.args[0] != ssl.SSL_ERROR_WANT_WRITE:
+                        raise
+
+            self._wait(readable)
+
+
+    def shutdown(self, how):
+        """ Shut down the connection in the given direction(s) while
+        preserving half-close semantics: shutting down the sending side sends
+        TLS close_notify without waiting for the peer's, so the opposite
+        direction may continue receiving. `ssl.SSLSocket.shutdown` can't be
+        used, because it discards the TLS state that the opposite direction's
+        forwarder still needs.
+        """
+        if how != socket.SHUT_RD and not self._close_notify_sent:
+            with self._lock:
+                self._close_notify_sent = True
+                try:
+                    self._tls_sock.unwrap()
+                except ssl.SSLError as exc:
+                    # NOTE: SSL_ERROR_WANT_READ is expected, because the
+                    # peer's close_notify has not been received yet
+                    if exc.args[0] != ssl.SSL_ERROR_WANT_READ:
+                        _trace("%s Failed to send TLS close_notify: %r",
+                               datetime.utcnow(), exc)
+
+        socket.socket.shutdown(self._tls_sock, how)
+
+
+    def _wait(self, readable):
+        """Wait for the socket to become readable or writable"""
+        fds = [self._tls_sock.fileno()]
+        while True:
+            try:
+                select.select(fds if readable else [],
+                              [] if readable else fds,
+                              [])
+                return
+            except select.error as exc:
+                if exc.args[0] != errno.EINTR:
+                    raise
+
+
+
+class _TLSSessionCache(object):
+    """ Client-side TLS sessions keyed by remote address, used for resuming
+    sessions on upstream connections. Thread-safe.
+
+    NOTE: session resumption requires `ssl.SSLSocket.session` (python 3.6+);
+    otherwise, the cache holds nothing and every handshake is a full one.
+    """
+
+    SUPPORTED = hasattr(ssl.SSLSocket, "session")
+
+    _MAX_ENTRIES = 64
+
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = collections.OrderedDict()
+
+
+    def wrap_socket(self, context, sock, key, server_hostname):
+        """ Perform client-side TLS handshake on the connected socket,
+        resuming the cached session for the given key, if any
+
+        :param ssl.SSLContext context: client-side context
+        :param socket.socket sock: connected socket
+        :param key: cache key; typically the remote address
+        :param str server_hostname: for SNI and certificate matching; or None
+
+        :returns: the TLS socket
+        :rtype: ssl.SSLSocket
+        """
+        kwargs = dict(server_hostname=server_hostname)
+        if self.SUPPORTED:
+            with self._lock:
+                session = self._sessions.get(key)
+            if session is not None:
+                kwargs["session"] = session
+
+        tls_sock = context.wrap_socket(sock, **kwargs)
+        self.put(key, tls_sock)
+        return tls_sock
+
+
+    def put(self, key, tls_sock):
+        """ Cache the TLS socket's session for the given key, if it may be
+        resumed
+
+        :param key: cache key; typically the remote address
+        :param ssl.SSLSocket tls_sock: TLS socket after handshake
+        """
+        if not self.SUPPORTED:
+            return
+
+        session = tls_sock.session
+        if session is None or not (session.has_ticket or session.id):
+            return
+
+        with self._lock:
+            self._sessions.pop(key, None)
+            self._sessions[key] = session
+            while len(self._sessions) > self._MAX_ENTRIES:
+                self._sessions.popitem(last=False)
+
+
+
+def _is_tls_ragged_eof(exc):
+    """ Check whether the exception reports that a TLS peer closed the TCP
+    connection without sending close_notify, which is how half-close is
+    conveyed over TLS by `_safe_shutdown_socket`. `suppress_ragged_eofs`
+    covers this only with OpenSSL versions prior to 3.0.
+
+    :param socket.error exc:
+    :rtype: bool
+    """
+    if not isinstance(exc, ssl.SSLError):
+        return False
+
+    return (isinstance(exc, getattr(ssl, "SSLEOFError", ())) or
+            "unexpected eof" in str(exc).lower())
+
+
+
+def _peer_name(sock):
+    """ Get the socket's peer address for tracing, even after the
+    connection is gone: e.g., a stream demultiplexed from a tunnel may finish
+    both directions before its downstream forwarder even starts
+
+    :returns: the peer address; None if no longer connected
+    """
+    try:
+        return sock.getpeername()
+    except socket.error:
+        return None
 
 
 
@@ -0,0 +1,444 @@
+"""Event-loop forwarding engine for ForwardServer's `event_loop_shards` mode.
+
+The accepting thread hands each session off to one of a fixed number of
+shard threads, the one with the fewest sessions. Each shard runs a
+level-triggered event loop (see `inetpy.poller`) over the non-blocking
+sockets of all of its sessions, instead of the two threads per session of
+the default engine.
+
+A shard owns its sessions, its pool of buffers and its counters outright, so
+the data path takes no lock that another shard contends for. On free-threaded
+Python builds the shards therefore run in parallel, one per core, in a single
+process; with the GIL, they still bound the thread count regardless of the
+number of sessions.
+"""
+from __future__ import print_function
+
+import collections
+from datetime import datetime
+import errno
+import socket
+import struct
+import sys
+import threading
+
+from inetpy.poller import EVENT_ERROR, EVENT_READ, EVENT_WRITE, create_poller
+from inetpy.socket_pair import WakeupChannel
+
+
+
+# Names of the per-shard counters exposed via ForwardServer.shard_stats
+SHARD_COUNTER_NAMES = (
+    "sessions",
+    "active_sessions",
+    "connect_failures",
+    "bytes_forwarded",
+    "loop_iterations",
+    "wakeups",
+    "buffers_allocated",
+)
+
+# Size of the buffers that hold data in transit
+_BUF_SIZE = 64 * 1024
+
+# Free buffers kept by each shard's pool
+_POOL_MAX_FREE = 64
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+_CONNECTING = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN)
+
+_PEER_GONE = (errno.ECONNRESET, errno.EPIPE, errno.ENOTCONN)
+
+
+
+def _trace(fmt, *args):
+    """Format and output the text to stderr"""
+    print((fmt % args) + "\n", end="", file=sys.stderr)
+
+
+
+class ShardedForwarder(object):
+    """ Runs the shard threads and assigns new sessions to them. `assign`
+    may be called from any one thread.
+    """
+
+    def __init__(self, config, shard_counters, session_ended):
+        """
+        :param config: the server's `_SessionConfig`; the shards use the
+            remote address settings and local_linger_args
+        :param shard_counters: sequence of `_SharedCounters` with the
+            SHARD_COUNTER_NAMES, one per shard
+        :param session_ended: callable of () that a shard calls after
+            closing a session's sockets
+        """
+        self._shards = [_Shard(config, counters, session_ended)
+                        for counters in shard_counters]
+
+        for i, shard in enumerate(self._shards):
+            thread = threading.Thread(target=shard.run,
+                                      name="forward-shard-%d" % (i,))
+            thread.setDaemon(True)
+            thread.start()
+
+
+    def assign(self, sock, client_address):
+        """ Hand the accepted connection off to the shard with the fewest
+        sessions, which owns it from here on
+        """
+        shard = min(self._shards, key=lambda shard: shard.load)
+        shard.assign(sock, client_address)
+
+
+
+class _Flow(object):
+    """One direction of a session"""
+
+    __slots__ = ("src", "dest", "src_fd", "dest_fd", "buf", "start", "end",
+                 "done")
+
+    def __init__(self, src, dest):
+        self.src = src
+        self.dest = dest
+        self.src_fd = src.fileno()
+        self.dest_fd = dest.fileno()
+        # Pooled buffer holding received data not yet sent, from `start` to
+        # `end`; None while there is none
+        self.buf = None
+        self.start = 0
+        self.end = 0
+        self.done = False
+
+
+
+class _ShardSession(object):
+    """State of one session of a shard"""
+
+    __slots__ = ("local", "remote", "client_address", "flows", "connecting")
+
+    def __init__(self, local, client_address):
+        self.local = local
+        self.remote = None
+        self.client_address = client_address
+        self.flows = ()
+        self.connecting = False
+
+
+
+class _Shard(object):
+    """ Event loop forwarding the sessions assigned to it; all of its state
+    but the inbox is confined to its thread
+    """
+
+    def __init__(self, config, counters, session_ended):
+        """
+        :param config: the server's `_SessionConfig`
+        :param _SharedCounters counters: this shard's counters
+        :param session_ended: see `ShardedForwarder`
+        """
+        self._config = config
+        self._counters = counters
+        self._session_ended = session_ended
+
+        self._poller = create_poller()
+        # Sessions by the descriptors of their sockets, and the events
+        # registered for each descriptor; 0 if unregistered, since errors and
+        # hang-ups would be reported regardless
+        self._sessions = dict()
+        self._masks = dict()
+        self._pool = []
+
+        # Connections handed off by the accepting thread
+        self._inbox = collections.deque()
+        self._wakeup = WakeupChannel()
+
+        # NOTE: each is written by one thread only, so neither needs a lock
+        self._assigned = 0
+        self._ended = 0
+
+        self._unpublished = dict((name, 0) for name in SHARD_COUNTER_NAMES)
+
+
+    @property
+    def load(self):
+        """Property: number of sessions assigned and not yet ended; may be
+        slightly out of date when read by the accepting thread
+        """
+        return self._assigned - self._ended
+
+
+    def assign(self, sock, client_address):
+        """Queue the connection for the shard; called by the accepting thread
+        """
+        self._inbox.append((sock, client_address))
+        self._assigned += 1
+        self._wakeup.signal()
+
+
+    def run(self):
+        """Serve the shard's sessions forever"""
+        wakeup_fd = self._wakeup.fileno()
+        self._poller.register(wakeup_fd, EVENT_READ)
+
+        while True:
+            for fd, events in self._poller.poll():
+                if fd == wakeup_fd:
+                    self._take_inbox()
+                    continue
+
+                # NOTE: None if closed while handling an earlier event
+                session = self._sessions.get(fd)
+                if session is not None:
+                    try:
+                        self._on_event(session, fd, events)
+                    except socket.error as exc:
+                        _trace("%s Session from %s failed: %r",
+                               datetime.utcnow(), session.client_address, exc)
+                        self._close(session)
+
+            self._count("loop_iterations")
+            self._publish()
+
+
+    def _count(self, name, amount=1):
+        """Increment a counter locally; published once per loop iteration"""
+        self._unpublished[name] += amount
+
+
+    def _publish(self):
+        """Add the unpublished counts to the shard's shared counters"""
+        amounts = [(name, amount)
+                   for name, amount in self._unpublished.items() if amount]
+        if not amounts:
+            return
+        self._counters.add_many(amounts)
+        for name, _ in amounts:
+            self._unpublished[name] = 0
+
+
+    def _take_inbox(self):
+        """Start the sessions handed off since the last wakeup"""
+        self._count("wakeups")
+        self._wakeup.drain()
+
+        # NOTE: the accepting thread queues before it signals, so everything
+        # signaled so far is in the inbox
+        while self._inbox:
+            sock, client_address = self._inbox.popleft()
+            session = _ShardSession(sock, client_address)
+            self._count("sessions")
+            self._count("active_sessions")
+            try:
+                self._start(session)
+            except socket.error as exc:
+                _trace("%s Failed to start session from %s: %r",
+                       datetime.utcnow(), client_address, exc)
+                self._close(session)
+
+
+    def _start(self, session):
+        """Set the session up, starting with a non-blocking connect"""
+        config = self._config
+        sock = session.local
+        self._watch(session, sock)
+        sock.setblocking(False)
+        if config.local_linger_args is not None:
+            l_onoff, l_linger = config.local_linger_args
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                            struct.pack('ii', l_onoff, l_linger))
+
+        if config.remote_addr is None:
+            # Echo: a single flow sends the local peer's data right back
+            session.flows = (_Flow(sock, sock),)
+            self._update(session)
+            return
+
+        remote = socket.socket(config.remote_addr_family,
+                               config.remote_socket_type)
+        session.remote = remote
+        self._watch(session, remote)
+        remote.setblocking(False)
+        # NOTE: a host name is resolved synchronously
+        err = remote.connect_ex(config.remote_addr)
+        if err and err not in _CONNECTING:
+            self._connect_failed(session, err)
+            return
+
+        session.connecting = True
+        self._update(session)
+
+
+    def _watch(self, session, sock):
+        """Associate the socket with the session; see `_update`"""
+        fd = sock.fileno()
+        self._sessions[fd] = session
+        self._masks[fd] = 0
+
+
+    def _connect_failed(self, session, err):
+        """Close the session whose remote connection failed"""
+        self._count("connect_failures")
+        _trace("%s Connecting to remote %s for %s failed: errno=%s",
+               datetime.utcnow(), self._config.remote_addr,
+               session.client_address, err)
+        self._close(session)
+
+
+    def _on_event(self, session, fd, events):
+        """Make what progress the socket's readiness allows"""
+        if session.connecting:
+            err = session.remote.getsockopt(socket.SOL_SOCKET,
+                                            socket.SO_ERROR)
+            if err:
+                self._connect_failed(session, err)
+                return
+            session.connecting = False
+            session.flows = (_Flow(session.local, session.remote),
+                             _Flow(session.remote, session.local))
+            self._update(session)
+            return
+
+        for flow in session.flows:
+            if flow.done:
+                continue
+            if flow.buf is not None:
+                if flow.dest_fd == fd and events & (EVENT_WRITE | EVENT_ERROR):
+                    self._send(flow)
+            elif flow.src_fd == fd and events & (EVENT_READ | EVENT_ERROR):
+                self._recv(flow)
+
+        if all(flow.done for flow in session.flows):
+            self._close(session)
+        else:
+            self._update(session)
+
+
+    def _recv(self, flow):
+        """Receive into a pooled buffer and send right away"""
+        if self._pool:
+            buf = self._pool.pop()
+        else:
+            buf = memoryview(bytearray(_BUF_SIZE))
+            self._count("buffers_allocated")
+
+        try:
+            nbytes = flow.src.recv_into(buf)
+        except socket.error as exc:
+            if exc.errno in _WOULD_BLOCK or exc.errno == errno.EINTR:
+                self._release(buf)
+                return
+            if exc.errno != errno.ECONNRESET:
+                self._release(buf)
+                raise
+            # Source peer forcibly closed connection
+            nbytes = 0
+
+        if not nbytes:
+            self._release(buf)
+            self._finish(flow)
+            return
+
+        flow.buf = buf
+        flow.start = 0
+        flow.end = nbytes
+        self._count("bytes_forwarded", nbytes)
+        # NOTE: the destination is usually writable, which saves a wait
+        self._send(flow)
+
+
+    def _send(self, flow):
+        """Send as much of the flow's data as the destination takes"""
+        try:
+            flow.start += flow.dest.send(flow.buf[flow.start:flow.end])
+        except socket.error as exc:
+            if exc.errno in _WOULD_BLOCK or exc.errno == errno.EINTR:
+                return
+            if exc.errno not in _PEER_GONE:
+                raise
+            # Destination peer closed or reset its end of the connection
+            self._finish(flow)
+            return
+
+        if flow.start == flow.end:
+            self._release(flow.buf)
+            flow.buf = None
+
+
+    def _release(self, buf):
+        """Return the buffer to the pool"""
+        if len(self._pool) < _POOL_MAX_FREE:
+            self._pool.append(buf)
+
+
+    def _finish(self, flow):
+        """ End the flow the way `_TCPHandler._forward` ends a direction:
+        done receiving from the source, done sending to the destination
+        """
+        flow.done = True
+        if flow.buf is not None:
+            self._release(flow.buf)
+            flow.buf = None
+        for sock, how in ((flow.src, socket.SHUT_RD),
+                          (flow.dest, socket.SHUT_WR)):
+            try:
+                sock.shutdown(how)
+            except socket.error:
+                pass
+
+
+    def _update(self, session):
+        """Register the events that the session's flows are waiting for"""
+        masks = {session.local.fileno(): 0}
+        if session.remote is not None:
+            masks[session.remote.fileno()] = (EVENT_WRITE if session.connecting
+                                              else 0)
+
+        for flow in session.flows:
+            if flow.done:
+                continue
+            if flow.buf is not None:
+                masks[flow.dest_fd] |= EVENT_WRITE
+            else:
+                masks[flow.src_fd] |= EVENT_READ
+
+        for fd, mask in masks.items():
+            registered = self._masks[fd]
+            if mask == registered:
+                continue
+            if not mask:
+                self._poller.unregister(fd)
+            elif not registered:
+                self._poller.register(fd, mask)
+            else:
+                self._poller.modify(fd, mask)
+            self._masks[fd] = mask
+
+
+    def _close(self, session):
+        """Stop serving the session and close its sockets"""
+        for sock in (session.remote, session.local):
+            if sock is None:
+                continue
+            fd = sock.fileno()
+            if self._sessions.pop(fd, None) is not None and self._masks.pop(fd):
+                self._poller.unregister(fd)
+
+        for flow in session.flows:
+            if flow.buf is not None:
+                self._release(flow.buf)
+                flow.buf = None
+
+        if session.remote is not None:
+            try:
+                session.remote.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            session.remote.close()
+        try:
+            session.local.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+        session.local.close()
+        self._count("active_sessions", -1)
+        self._ended += 1
+        self._session_ended()
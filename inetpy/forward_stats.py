@@ -0,0 +1,286 @@
+"""Instrumentation for ForwardServer: session observer interface, built-in
+histogram collector and counters shared with the parent process.
+"""
+
+import ctypes
+import multiprocessing
+
+
+
+class ForwardObserver(object):
+    """ Base class for ForwardServer session observers. Subclass it and
+    override the hooks of interest; the default implementations do nothing.
+
+    NOTE: hooks are called in the forwarding subprocess from the session
+    threads, so implementations must be thread-safe. Results that are to be
+    consumed by the parent process need to be kept in shared memory (see
+    `HistogramObserver`).
+
+    NOTE: `direction` is DIRECTION_UPSTREAM for data flowing from the local
+    peer toward the remote (or echo) end and DIRECTION_DOWNSTREAM for data
+    flowing back to the local peer. In echo mode, where there's no remote
+    end, each chunk is reported in both directions.
+    """
+
+    DIRECTION_UPSTREAM = "upstream"
+    DIRECTION_DOWNSTREAM = "downstream"
+
+
+    def session_opened(self, session_id, client_address):
+        """Called when a local connection is accepted
+
+        :param int session_id: identifier of the session, unique within the
+          forwarding subprocess
+        :param client_address: local peer's address
+        """
+        pass
+
+
+    def upstream_connected(self, session_id, remote_address, elapsed):
+        """Called after the connection to the remote address is established;
+        not called in echo mode.
+
+        :param int session_id: session identifier
+        :param remote_address: remote peer's address
+        :param float elapsed: connection set-up time, in seconds
+        """
+        pass
+
+
+    def chunk_received(self, session_id, direction, nbytes, elapsed):
+        """Called after a chunk of data is received
+
+        :param int session_id: session identifier
+        :param str direction: DIRECTION_UPSTREAM or DIRECTION_DOWNSTREAM
+        :param int nbytes: size of the chunk
+        :param float elapsed: time, in seconds, spent blocked in the receive
+        """
+        pass
+
+
+    def chunk_sent(self, session_id, direction, nbytes, elapsed):
+        """Called after a chunk of data is sent in its entirety
+
+        :param int session_id: session identifier
+        :param str direction: DIRECTION_UPSTREAM or DIRECTION_DOWNSTREAM
+        :param int nbytes: size of the chunk
+        :param float elapsed: time, in seconds, spent blocked in the send;
+          large values indicate a slow receiver
+        """
+        pass
+
+
+    def session_closed(self, session_id, elapsed):
+        """Called when the session's sockets are closed
+
+        :param int session_id: session identifier
+        :param float elapsed: session lifetime, in seconds
+        """
+        pass
+
+
+
+class _SharedCounters(object):
+    """Named integer counters in shared memory; incremented in the forwarding
+    subprocess and read by the parent. Must be created before the subprocess
+    is started.
+    """
+
+    def __init__(self, names, lock=None):
+        """
+        :param names: sequence of counter names
+        :param lock: optional multiprocessing lock to share with other shared
+          objects; a new one is created if None
+        """
+        self._index = dict((name, i) for i, name in enumerate(names))
+        self._lock = lock if lock is not None else multiprocessing.Lock()
+        self._values = multiprocessing.Array(ctypes.c_longlong, len(names),
+                                             lock=False)
+
+
+    def add(self, name, amount=1):
+        """Increment the named counter by the given amount"""
+        index = self._index[name]
+        with self._lock:
+            self._values[index] += amount
+
+
+    def add_many(self, amounts):
+        """Increment several counters at once, taking the lock only once
+
+        :param amounts: sequence of (name, amount) pairs
+        """
+        index = self._index
+        with self._lock:
+            for name, amount in amounts:
+                self._values[index[name]] += amount
+
+
+    def snapshot(self):
+        """:returns: dict of counter name to its current value"""
+        with self._lock:
+            return dict((name, self._values[i])
+                        for name, i in self._index.items())
+
+
+
+class _SharedHistogram(object):
+    """Histogram with power-of-two buckets in shared memory. Bucket `i` counts
+    values `v` such that `int(v).bit_length() == i`, i.e., bucket 0 holds
+    zeros and bucket `i` covers [2**(i-1), 2**i - 1].
+    """
+
+    _NUM_BUCKETS = 48
+
+
+    def __init__(self, lock):
+        """
+        :param lock: multiprocessing lock guarding the histogram
+        """
+        self._lock = lock
+        self._buckets = multiprocessing.Array(ctypes.c_longlong,
+                                              self._NUM_BUCKETS, lock=False)
+        self._total = multiprocessing.Array(ctypes.c_double, 1, lock=False)
+
+
+    def add(self, value):
+        """Record a non-negative integer value"""
+        index = min(int(value).bit_length(), self._NUM_BUCKETS - 1)
+        with self._lock:
+            self._buckets[index] += 1
+            self._total[0] += value
+
+
+    def snapshot(self):
+        """
+        :returns: dict with "count", "sum" and "buckets"; the latter is a list
+          of (upper_bound, count) pairs for the non-empty buckets
+        """
+        with self._lock:
+            buckets = list(self._buckets)
+            total = self._total[0]
+
+        return dict(
+            count=sum(buckets),
+            sum=total,
+            buckets=[((1 << i) - 1, count)
+                     for i, count in enumerate(buckets) if count])
+
+
+
+def histogram_percentile(histogram, percent):
+    """ Estimate a percentile from a histogram snapshot returned by
+    `HistogramObserver.snapshot()`
+
+    :param dict histogram: one of the histograms from the snapshot
+    :param float percent: percentile to estimate, 0..100
+
+    :returns: upper bound of the bucket that contains the percentile; None if
+      the histogram is empty
+    """
+    count = histogram["count"]
+    if not count:
+        return None
+
+    threshold = count * percent / 100.0
+    running = 0
+    for upper_bound, bucket_count in histogram["buckets"]:
+        running += bucket_count
+        if running >= threshold:
+            return upper_bound
+
+    return histogram["buckets"][-1][0]
+
+
+
+class HistogramObserver(ForwardObserver):
+    """ Built-in observer that collects histograms of time blocked in receive
+    and send, chunk sizes, upstream connect time and session lifetime, plus
+    session and stall counters. Times are recorded in microseconds, sizes in
+    bytes.
+
+    The collected data lives in shared memory, so the instance passed to
+    `ForwardServer` may be queried from the parent process via `snapshot()`.
+
+    Example:
+
+        observer = HistogramObserver()
+        with ForwardServer(None, observer=observer) as fwd:
+            ...
+
+        stats = observer.snapshot()
+        p99 = histogram_percentile(stats["send_wait_usec"]["upstream"], 99)
+    """
+
+    _DIRECTIONS = (ForwardObserver.DIRECTION_UPSTREAM,
+                   ForwardObserver.DIRECTION_DOWNSTREAM)
+
+
+    def __init__(self, stall_threshold=0.01):
+        """
+        :param float stall_threshold: a send that blocks for at least this many
+          seconds is counted as a stall caused by a slow receiver
+        """
+        self._stall_threshold = stall_threshold
+
+        lock = multiprocessing.Lock()
+
+        self._recv_wait = dict((d, _SharedHistogram(lock))
+                               for d in self._DIRECTIONS)
+        self._send_wait = dict((d, _SharedHistogram(lock))
+                               for d in self._DIRECTIONS)
+        self._chunk_size = dict((d, _SharedHistogram(lock))
+                                for d in self._DIRECTIONS)
+        self._connect_time = _SharedHistogram(lock)
+        self._session_time = _SharedHistogram(lock)
+
+        self._counters = _SharedCounters(
+            ["sessions_opened", "sessions_closed", "upstream_connects"] +
+            ["stalls_" + d for d in self._DIRECTIONS] +
+            ["bytes_" + d for d in self._DIRECTIONS],
+            lock=lock)
+
+
+    def session_opened(self, session_id, client_address):
+        self._counters.add("sessions_opened")
+
+
+    def upstream_connected(self, session_id, remote_address, elapsed):
+        self._counters.add("upstream_connects")
+        self._connect_time.add(int(elapsed * 1e6))
+
+
+    def chunk_received(self, session_id, direction, nbytes, elapsed):
+        self._recv_wait[direction].add(int(elapsed * 1e6))
+        self._chunk_size[direction].add(nbytes)
+
+
+    def chunk_sent(self, session_id, direction, nbytes, elapsed):
+        self._send_wait[direction].add(int(elapsed * 1e6))
+        self._counters.add("bytes_" + direction, nbytes)
+        if elapsed >= self._stall_threshold:
+            self._counters.add("stalls_" + direction)
+
+
+    def session_closed(self, session_id, elapsed):
+        self._counters.add("sessions_closed")
+        self._session_time.add(int(elapsed * 1e6))
+
+
+    def snapshot(self):
+        """
+        :returns: dict with the counters plus the histograms "recv_wait_usec",
+          "send_wait_usec" and "chunk_size" (each a dict keyed by direction),
+          "connect_usec" and "session_usec"
+        """
+        stats = self._counters.snapshot()
+        stats.update(
+            recv_wait_usec=dict((d, h.snapshot())
+                                for d, h in self._recv_wait.items()),
+            send_wait_usec=dict((d, h.snapshot())
+                                for d, h in self._send_wait.items()),
+            chunk_size=dict((d, h.snapshot())
+                            for d, h in self._chunk_size.items()),
+            connect_usec=self._connect_time.snapshot(),
+            session_usec=self._session_time.snapshot())
+        return stats
@@ -0,0 +1,181 @@
+"""Readiness notification for non-blocking event loops.
+
+`create_poller()` returns the most scalable implementation available on the
+platform: epoll, poll or select. They share one interface, and event masks
+use the values of the poll(2) flags, which epoll shares.
+"""
+
+import errno
+import math
+import select
+
+
+EVENT_READ = 0x001
+EVENT_WRITE = 0x004
+
+# Reported regardless of the registered mask: error and hang-up
+EVENT_ERROR = 0x008 | 0x010
+
+
+
+def create_poller():
+    """:returns: EpollPoller, PollPoller or SelectPoller instance, whichever
+    is the first available on this platform
+    """
+    if hasattr(select, "epoll"):
+        return EpollPoller()
+    elif hasattr(select, "poll"):
+        return PollPoller()
+    else:
+        return SelectPoller()
+
+
+
+def _interrupted(exc):
+    """:returns: True if the exception is from a call interrupted by a
+    signal
+    """
+    return (exc.args[0] if exc.args else None) == errno.EINTR
+
+
+
+class EpollPoller(object):
+    """Poller based on epoll(7). Linux only."""
+
+    def __init__(self):
+        self._epoll = select.epoll()
+
+
+    def register(self, fd, events):
+        """ Start watching the file descriptor
+
+        :param int fd: file descriptor
+        :param int events: bitmask of EVENT_READ and EVENT_WRITE
+        """
+        self._epoll.register(fd, events)
+
+
+    def modify(self, fd, events):
+        """Change the events watched for an already-registered descriptor"""
+        self._epoll.modify(fd, events)
+
+
+    def unregister(self, fd):
+        """Stop watching the descriptor"""
+        self._epoll.unregister(fd)
+
+
+    def poll(self, timeout=None):
+        """ Wait for events
+
+        :param float timeout: maximum time to wait, in seconds; None to wait
+          indefinitely
+
+        :returns: list of (fd, events) pairs; empty on timeout or when
+          interrupted by a signal
+        """
+        try:
+            return self._epoll.poll(-1 if timeout is None else timeout)
+        except (IOError, OSError, select.error) as exc:
+            if _interrupted(exc):
+                return []
+            raise
+
+
+    def close(self):
+        """Release the epoll descriptor"""
+        self._epoll.close()
+
+
+
+class PollPoller(object):
+    """Poller based on poll(2)"""
+
+    def __init__(self):
+        self._poll = select.poll()
+
+
+    def register(self, fd, events):
+        """See `EpollPoller.register`"""
+        self._poll.register(fd, events)
+
+
+    def modify(self, fd, events):
+        """See `EpollPoller.modify`"""
+        self._poll.modify(fd, events)
+
+
+    def unregister(self, fd):
+        """See `EpollPoller.unregister`"""
+        self._poll.unregister(fd)
+
+
+    def poll(self, timeout=None):
+        """See `EpollPoller.poll`"""
+        try:
+            # NOTE: poll's timeout is in milliseconds; round up so that short
+            # waits don't degrade into busy polling
+            return self._poll.poll(
+                None if timeout is None else int(math.ceil(timeout * 1000)))
+        except (IOError, OSError, select.error) as exc:
+            if _interrupted(exc):
+                return []
+            raise
+
+
+    def close(self):
+        """Nothing to release"""
+        pass
+
+
+
+class SelectPoller(object):
+    """Poller based on select(2); limited to descriptors below FD_SETSIZE"""
+
+    def __init__(self):
+        self._readers = set()
+        self._writers = set()
+
+
+    def register(self, fd, events):
+        """See `EpollPoller.register`"""
+        self.modify(fd, events)
+
+
+    def modify(self, fd, events):
+        """See `EpollPoller.modify`"""
+        for watched, event in ((self._readers, EVENT_READ),
+                               (self._writers, EVENT_WRITE)):
+            if events & event:
+                watched.add(fd)
+            else:
+                watched.discard(fd)
+
+
+    def unregister(self, fd):
+        """See `EpollPoller.unregister`"""
+        self._readers.discard(fd)
+        self._writers.discard(fd)
+
+
+    def poll(self, timeout=None):
+        """See `EpollPoller.poll`"""
+        # NOTE: errors and hang-ups are reported as readable; select's
+        # "exceptional condition" set is about out-of-band data
+        try:
+            readable, writable, _ = select.select(
+                self._readers, self._writers, [], timeout)
+        except (IOError, OSError, select.error) as exc:
+            if _interrupted(exc):
+                return []
+            raise
+
+        events = dict((fd, EVENT_READ) for fd in readable)
+        for fd in writable:
+            events[fd] = events.get(fd, 0) | EVENT_WRITE
+        return list(events.items())
+
+
+    def close(self):
+        """Nothing to release"""
+        pass
@@ -0,0 +1,804 @@
+"""In-memory simulated network for fast, deterministic tests.
+
+A `SimNetwork` stands in for the `socket` module: its `socket`,
+`socketpair`, `getaddrinfo` and `create_connection` produce `SimSocket`
+instances, which implement the blocking and non-blocking stream socket API
+(connect, accept, send, recv_into, shutdown and half-close, timeouts,
+MSG_PEEK and MSG_DONTWAIT) without the kernel. Pass the network as the
+`transport` of `inetpy.socket_pair.socket_pair`, `inetpy.connect.connect_tcp`
+or `inetpy.connect.connect_from_addr_infos`, and use `SimForwarder` to run
+the forwarding engine of `inetpy.forward_server` over it.
+
+Time is virtual. Every segment is stamped with its arrival time when it's
+sent, per the link model between the two hosts: serialization delay at the
+link's bandwidth, latency, random jitter and random loss, where a lost
+segment arrives a retransmission timeout later (doubling on each repeated
+loss), in order, like TCP. A receive that would block advances the clock to
+the arrival of the data it waits for, so a run takes no longer in wall time
+than the code it exercises, and the clock can be advanced explicitly with
+`SimNetwork.sleep`. Timeouts expire in virtual time.
+
+Randomness comes from one generator seeded per network, so a run driven
+from a single thread is reproducible exactly. With multiple threads, such as
+the forwarding engine's, the data and its ordering remain exact, but virtual
+timestamps depend on how the threads interleave.
+
+Simplifications: the send buffer is unbounded, so sends never block; any
+host name resolves to itself; and a socket with nothing in flight blocks in
+real time until another thread sends to it or closes it.
+
+:example:
+    net = SimNetwork(seed=1, latency=0.005)
+    listener = net.socket()
+    listener.bind(("server", 80))
+    listener.listen(5)
+
+    client = connect_tcp("server", 80, transport=net)
+    conn, _ = listener.accept()
+    client.sendall(b"ping")
+    assert conn.recv(4) == b"ping"
+    assert net.now >= 0.015  # handshake round trip plus one-way latency
+"""
+
+import array
+import collections
+import errno
+from functools import partial
+import itertools
+import os
+import random
+import socket
+import threading
+
+from inetpy import forward_server
+from inetpy.forward_stats import _SharedCounters
+from inetpy.tunnel_codec import get_codec
+from inetpy.tunnel_mux import MuxClient
+
+
+
+# Re-exported for code that uses the network in place of the socket module
+AF_INET = socket.AF_INET
+SOCK_STREAM = socket.SOCK_STREAM
+IPPROTO_TCP = socket.IPPROTO_TCP
+SHUT_RD = socket.SHUT_RD
+SHUT_WR = socket.SHUT_WR
+SHUT_RDWR = socket.SHUT_RDWR
+MSG_PEEK = socket.MSG_PEEK
+MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0x40)
+error = socket.error  # pylint: disable=C0103
+timeout = socket.timeout  # pylint: disable=C0103
+gaierror = socket.gaierror  # pylint: disable=C0103
+
+# Host of sockets that aren't bound to an address before connecting
+DEFAULT_HOST = "localhost"
+
+# First port assigned to sockets bound to port 0
+_EPHEMERAL_PORT_BASE = 49152
+
+
+
+def _socket_error(code):
+    """:returns: socket.error for the errno value"""
+    return socket.error(code, os.strerror(code))
+
+
+
+class LinkModel(object):
+    """ Behavior of the link in one direction between two hosts
+
+    :param float latency: one-way propagation delay, in seconds
+    :param float jitter: upper bound of the uniformly distributed random
+        delay added to each segment, in seconds
+    :param float bandwidth: bytes per second; None for unlimited
+    :param float loss: probability that a segment is lost and retransmitted
+    :param float rto: initial retransmission timeout, in seconds
+    :param int mss: segment size, for the loss and jitter models
+    """
+
+    __slots__ = ("latency", "jitter", "bandwidth", "loss", "rto", "mss")
+
+    def __init__(self, latency=0.0, jitter=0.0, bandwidth=None, loss=0.0,  # pylint: disable=R0913
+                 rto=0.2, mss=1460):
+        assert latency >= 0 and jitter >= 0, (latency, jitter)
+        assert bandwidth is None or bandwidth > 0, bandwidth
+        assert 0 <= loss < 1, loss
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.loss = loss
+        self.rto = rto
+        self.mss = mss
+
+
+
+class _Stream(object):
+    """One direction of a simulated connection: segments in flight or
+    waiting to be received, each a [arrival time, data] pair; data is None
+    for the FIN
+    """
+
+    __slots__ = ("src_host", "dst_host", "segments", "offset", "last_arrival",
+                 "fin_sent", "reader_closed", "reset")
+
+    def __init__(self, src_host, dst_host):
+        self.src_host = src_host
+        self.dst_host = dst_host
+        self.segments = collections.deque()
+        # Bytes of the first segment already received
+        self.offset = 0
+        self.last_arrival = 0.0
+        self.fin_sent = False
+        self.reader_closed = False
+        self.reset = False
+
+
+    def next_arrival(self):
+        """:returns: arrival time of the first segment; None if none"""
+        return self.segments[0][0] if self.segments else None
+
+
+    def read(self, now, nbytes, peek):
+        """ Take up to nbytes of the data that arrived by now
+
+        :returns: bytes; empty at EOF; None if nothing has arrived
+        """
+        chunks = []
+        total = 0
+        offset = self.offset
+        for arrival, data in self.segments:
+            if arrival > now or total >= nbytes:
+                break
+            if data is None:
+                if not chunks:
+                    return b""
+                break
+            chunk = data[offset:offset + nbytes - total]
+            chunks.append(chunk)
+            total += len(chunk)
+            offset = 0 if offset + len(chunk) == len(data) else (
+                offset + len(chunk))
+            if offset:
+                break
+
+        if not chunks:
+            return None
+
+        if not peek:
+            remaining = total
+            while remaining:
+                data = self.segments[0][1]
+                available = len(data) - self.offset
+                if remaining >= available:
+                    self.segments.popleft()
+                    self.offset = 0
+                    remaining -= available
+                else:
+                    self.offset += remaining
+                    remaining = 0
+
+        return b"".join(chunks)
+
+
+
+class SimNetwork(object):
+    """ Simulated network of hosts connected by modeled links. Thread-safe.
+
+    Provides the subset of the `socket` module API used by inetpy, so that it
+    can be passed where a `transport` is accepted.
+    """
+
+    def __init__(self, seed=0, latency=0.0, jitter=0.0, bandwidth=None,  # pylint: disable=R0913
+                 loss=0.0, rto=0.2, mss=1460):
+        """
+        :param seed: seed of the random generator of the jitter and loss
+            models
+        :param float latency: the remaining arguments make up the
+            `LinkModel` of the links between any two hosts, unless overridden
+            with `set_link`
+        """
+        self._cond = threading.Condition(threading.Lock())
+        self._random = random.Random(seed)
+        self._now = 0.0
+
+        self._default_model = LinkModel(latency=latency, jitter=jitter,
+                                         bandwidth=bandwidth, loss=loss,
+                                         rto=rto, mss=mss)
+        # (src host, dst host) -> LinkModel
+        self._models = dict()
+        # (src host, dst host) -> time the link finishes sending what it has
+        self._link_busy_until = dict()
+
+        # (host, port) -> listening SimSocket
+        self._listeners = dict()
+        self._ports = itertools.count(_EPHEMERAL_PORT_BASE)
+
+        self._stats = dict(connections=0, segments=0, retransmits=0,
+                           bytes=0)
+
+
+    @property
+    def now(self):
+        """Property: the virtual time, in seconds since the network was
+        created
+        """
+        return self._now
+
+
+    @property
+    def stats(self):
+        """ Property: snapshot of the network's counters: "connections"
+        established, "segments" sent, "retransmits" of lost segments and
+        payload "bytes" sent
+
+        :rtype: dict
+        """
+        with self._cond:
+            return dict(self._stats)
+
+
+    def set_link(self, host_a, host_b, **model):
+        """ Set the link model between two hosts, in both directions
+
+        :param model: `LinkModel` arguments
+        """
+        with self._cond:
+            self._models[(host_a, host_b)] = LinkModel(**model)
+            self._models[(host_b, host_a)] = LinkModel(**model)
+
+
+    def sleep(self, seconds):
+        """Advance the virtual clock"""
+        with self._cond:
+            self._advance_to(self._now + seconds)
+
+
+    def socket(self, family=AF_INET, type=SOCK_STREAM, proto=0):  # pylint: disable=W0622
+        """:returns: new unconnected SimSocket, like `socket.socket`"""
+        assert type == SOCK_STREAM, type
+        return SimSocket(self, family, type, proto)
+
+
+    def socketpair(self, family=AF_INET, type=SOCK_STREAM, proto=0):  # pylint: disable=W0622
+        """:returns: pair of connected SimSockets, like `socket.socketpair`"""
+        sock1 = self.socket(family, type, proto)
+        sock2 = self.socket(family, type, proto)
+        with self._cond:
+            sock1._local = (DEFAULT_HOST, next(self._ports))  # pylint: disable=W0212
+            sock2._local = (DEFAULT_HOST, next(self._ports))  # pylint: disable=W0212
+            sock1._attach(sock2)  # pylint: disable=W0212
+            self._stats["connections"] += 1
+        return sock1, sock2
+
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):  # pylint: disable=R0913,W0613,W0622
+        """Resolve like `socket.getaddrinfo`; every host name resolves to
+        itself
+        """
+        if port is None:
+            raise socket.gaierror(socket.EAI_NONAME, "Port required")
+        return [(AF_INET, SOCK_STREAM, IPPROTO_TCP, "",
+                 (DEFAULT_HOST if host is None else host, int(port)))]
+
+
+    def create_connection(self, address, timeout=None):  # pylint: disable=W0621
+        """:returns: SimSocket connected to address, like
+        `socket.create_connection`
+        """
+        sock = self.socket()
+        sock.settimeout(timeout)
+        try:
+            sock.connect(address)
+        except:
+            sock.close()
+            raise
+        return sock
+
+
+    def _advance_to(self, when):
+        """Move the clock forward to when; the caller holds the lock"""
+        if when > self._now:
+            self._now = when
+            self._cond.notify_all()
+
+
+    def _transmit(self, stream, data):
+        """ Schedule the arrival of data, or FIN if None, on the stream per
+        the link model; the caller holds the lock
+        """
+        key = (stream.src_host, stream.dst_host)
+        model = self._models.get(key, self._default_model)
+        size = 0 if data is None else len(data)
+
+        if data is None or not (model.loss or model.jitter):
+            segments = [data]
+        else:
+            segments = [data[offset:offset + model.mss]
+                        for offset in range(0, size, model.mss)]
+
+        busy_until = max(self._now, self._link_busy_until.get(key, 0.0))
+        for segment in segments:
+            if model.bandwidth is not None and segment:
+                busy_until += len(segment) / float(model.bandwidth)
+            arrival = busy_until + model.latency
+            if model.jitter:
+                arrival += self._random.random() * model.jitter
+            rto = model.rto
+            while model.loss and self._random.random() < model.loss:
+                arrival += rto
+                rto *= 2
+                self._stats["retransmits"] += 1
+
+            # NOTE: in order, like TCP: a late segment holds up later ones
+            arrival = max(arrival, stream.last_arrival)
+            stream.last_arrival = arrival
+            stream.segments.append([arrival, segment])
+            self._stats["segments"] += 1
+
+        self._link_busy_until[key] = busy_until
+        self._stats["bytes"] += size
+        self._cond.notify_all()
+
+
+    def _handshake_delay(self, src_host, dst_host):
+        """:returns: round-trip time of the connection handshake"""
+        return (self._models.get((src_host, dst_host),
+                                 self._default_model).latency +
+                self._models.get((dst_host, src_host),
+                                 self._default_model).latency)
+
+
+
+class SimSocket(object):
+    """ Stream socket of a `SimNetwork`; behaves like a blocking
+    `socket.socket` unless given a timeout or set non-blocking
+    """
+
+    def __init__(self, network, family, sock_type, proto):
+        self._network = network
+        self.family = family
+        self.type = sock_type
+        self.proto = proto
+
+        self._timeout = None
+        self._options = dict()
+
+        self._local = None
+        self._peer = None
+        self._rx = None
+        self._tx = None
+        self._shut_rd = False
+        self._closed = False
+
+        # Listener state: deque of (arrival time, accepted SimSocket)
+        self._backlog = None
+        self._backlog_size = 0
+
+
+    def __repr__(self):
+        return "<SimSocket local=%r peer=%r>" % (self._local, self._peer)
+
+
+    def settimeout(self, value):
+        """Set the timeout, in virtual seconds; None for blocking"""
+        self._timeout = value
+
+
+    def gettimeout(self):
+        """:returns: the timeout"""
+        return self._timeout
+
+
+    def setblocking(self, flag):
+        """Same as settimeout(None) or settimeout(0.0)"""
+        self._timeout = None if flag else 0.0
+
+
+    def setsockopt(self, level, optname, value):
+        """Record the option; it has no effect"""
+        self._options[(level, optname)] = value
+
+
+    def getsockopt(self, level, optname, buflen=None):  # pylint: disable=W0613
+        """:returns: the value set with setsockopt; 0 if none"""
+        return self._options.get((level, optname), 0)
+
+
+    def getsockname(self):
+        """:returns: (host, port)"""
+        if self._local is None:
+            return ("0.0.0.0", 0)
+        return self._local
+
+
+    def getpeername(self):
+        """:returns: (host, port) of the peer
+
+        :raises socket.error: ENOTCONN
+        """
+        if self._peer is None:
+            raise _socket_error(errno.ENOTCONN)
+        return self._peer
+
+
+    def bind(self, address):
+        """Bind to (host, port); port 0 picks a free port"""
+        network = self._network
+        with network._cond:  # pylint: disable=W0212
+            host, port = address
+            host = host or DEFAULT_HOST
+            if not port:
+                port = next(network._ports)  # pylint: disable=W0212
+            elif (host, port) in network._listeners:  # pylint: disable=W0212
+                raise _socket_error(errno.EADDRINUSE)
+            self._local = (host, port)
+
+
+    def listen(self, backlog=socket.SOMAXCONN):
+        """Start accepting connections on the bound address"""
+        network = self._network
+        with network._cond:  # pylint: disable=W0212
+            if self._local is None:
+                self._local = (DEFAULT_HOST, next(network._ports))  # pylint: disable=W0212
+            if self._local in network._listeners:  # pylint: disable=W0212
+                raise _socket_error(errno.EADDRINUSE)
+            network._listeners[self._local] = self  # pylint: disable=W0212
+            self._backlog = collections.deque()
+            self._backlog_size = max(backlog, 1)
+
+
+    def accept(self):
+        """:returns: (SimSocket, peer address) of the next connection"""
+        network = self._network
+        with network._cond:  # pylint: disable=W0212
+            deadline = self._deadline(self._timeout)
+            while True:
+                if self._closed or self._backlog is None:
+                    raise _socket_error(errno.EINVAL)
+                arrival = self._backlog[0][0] if self._backlog else None
+                if arrival is not None and arrival <= network.now:
+                    sock = self._backlog.popleft()[1]
+                    network._cond.notify_all()  # pylint: disable=W0212
+                    return sock, sock.getpeername()
+                self._wait(arrival, deadline)
+
+
+    def connect(self, address):
+        """ Connect to a listening SimSocket at (host, port)
+
+        :raises socket.error: ECONNREFUSED if nothing listens there
+        :raises socket.timeout: the listener's backlog stayed full
+        """
+        network = self._network
+        with network._cond:  # pylint: disable=W0212
+            if self._peer is not None:
+                raise _socket_error(errno.EISCONN)
+            if self._local is None:
+                self._local = (DEFAULT_HOST, next(network._ports))  # pylint: disable=W0212
+
+            address = tuple(address)
+            rtt = network._handshake_delay(self._local[0], address[0])  # pylint: disable=W0212
+            deadline = self._deadline(self._timeout)
+            while True:
+                listener = network._listeners.get(address)  # pylint: disable=W0212
+                if listener is None:
+                    network._advance_to(network.now + rtt)  # pylint: disable=W0212
+                    raise _socket_error(errno.ECONNREFUSED)
+                if len(listener._backlog) < listener._backlog_size:  # pylint: disable=W0212
+                    break
+                # NOTE: like Linux, SYNs to a full backlog go unanswered
+                self._wait(None, deadline)
+
+            accepted = SimSocket(network, self.family, self.type, self.proto)
+            accepted._local = address  # pylint: disable=W0212
+            self._attach(accepted)
+            listener._backlog.append(  # pylint: disable=W0212
+                (network.now + rtt / 2.0, accepted))
+            network._stats["connections"] += 1  # pylint: disable=W0212
+            network._cond.notify_all()  # pylint: disable=W0212
+
+            if self._timeout == 0.0:
+                raise _socket_error(errno.EINPROGRESS)
+            network._advance_to(network.now + rtt)  # pylint: disable=W0212
+
+
+    def connect_ex(self, address):
+        """:returns: 0 on success, otherwise the errno value"""
+        try:
+            self.connect(address)
+        except socket.error as exc:
+            return exc.errno
+        return 0
+
+
+    def send(self, data, flags=0):  # pylint: disable=W0613
+        """:returns: number of bytes sent; always all of them"""
+        network = self._network
+        with network._cond:  # pylint: disable=W0212
+            self._check_connected()
+            if self._tx.fin_sent or self._tx.reader_closed:
+                raise _socket_error(errno.EPIPE)
+            data = bytes(data)
+            if data:
+                network._transmit(self._tx, data)  # pylint: disable=W0212
+            return len(data)
+
+
+    sendall = send
+
+
+    def recv(self, nbytes, flags=0):
+        """:returns: up to nbytes; empty at EOF"""
+        return self._receive(nbytes, flags, self._timeout)
+
+
+    def recv_into(self, buf, nbytes=0, flags=0):
+        """:returns: number of bytes received into buf; 0 at EOF"""
+        data = self._receive(nbytes or len(buf), flags, self._timeout)
+        if isinstance(buf, array.array):
+            # NOTE: python 2 arrays don't support memoryview
+            buf[:len(data)] = array.array("B", data)
+        else:
+            memoryview(buf)[:len(data)] = data
+        return len(data)
+
+
+    def wait_readable(self, timeout):  # pylint: disable=W0621
+        """ Wait for data or EOF to become available to receive, the way
+        `inetpy.forward_server` waits for readiness of real sockets
+
+        :param float timeout: in virtual seconds; None to wait indefinitely
+
+        :returns: True if readable; False on timeout
+        """
+        try:
+            self._receive(1, MSG_PEEK, timeout)
+        except socket.timeout:
+            return False
+        except socket.error as exc:
+            # NOTE: like select, report errors as readability
+            return exc.errno != errno.EAGAIN
+        return True
+
+
+    def shutdown(self, how):
+        """Shut down receiving, sending or both; sending FIN to the peer"""
+        network = self._network
+        with network._cond:  # pylint: disable=W0212
+            self._check_connected()
+            if how in (SHUT_RD, SHUT_RDWR):
+                self._shut_rd = True
+                network._cond.notify_all()  # pylint: disable=W0212
+            if how in (SHUT_WR, SHUT_RDWR) and not self._tx.fin_sent:
+                self._tx.fin_sent = True
+                network._transmit(self._tx, None)  # pylint: disable=W0212
+
+
+    def close(self):
+        """Close the socket; the peer gets EOF, and EPIPE if it sends"""
+        network = self._network
+        with network._cond:  # pylint: disable=W0212
+            if self._closed:
+                return
+            self._closed = True
+
+            if self._backlog is not None:
+                if network._listeners.get(self._local) is self:  # pylint: disable=W0212
+                    del network._listeners[self._local]  # pylint: disable=W0212
+                # Reset the connections that were never accepted
+                for _, sock in self._backlog:
+                    sock._tx.reset = True  # pylint: disable=W0212
+                    sock._rx.reader_closed = True  # pylint: disable=W0212
+                self._backlog.clear()
+
+            if self._tx is not None:
+                self._rx.reader_closed = True
+                if not self._tx.fin_sent:
+                    self._tx.fin_sent = True
+                    network._transmit(self._tx, None)  # pylint: disable=W0212
+
+            network._cond.notify_all()  # pylint: disable=W0212
+
+
+    def _attach(self, peer):
+        """Connect this socket and peer with a pair of streams; the caller
+        holds the lock
+        """
+        self._peer = peer._local  # pylint: disable=W0212
+        peer._peer = self._local  # pylint: disable=W0212
+        self._tx = peer._rx = _Stream(self._local[0], peer._local[0])  # pylint: disable=W0212
+        self._rx = peer._tx = _Stream(peer._local[0], self._local[0])  # pylint: disable=W0212
+
+
+    def _check_connected(self):
+        """:raises socket.error: closed or not connected"""
+        if self._closed:
+            raise _socket_error(errno.EBADF)
+        if self._tx is None:
+            raise _socket_error(errno.ENOTCONN)
+
+
+    def _deadline(self, timeout):  # pylint: disable=W0621
+        """:returns: virtual time at which a call with the given timeout
+        times out; None if blocking
+        """
+        if timeout is None:
+            return None
+        return self._network.now + timeout
+
+
+    def _receive(self, nbytes, flags, timeout):  # pylint: disable=W0621
+        """:returns: up to nbytes of received data; empty at EOF"""
+        network = self._network
+        with network._cond:  # pylint: disable=W0212
+            self._check_connected()
+            deadline = self._deadline(timeout)
+            while True:
+                if self._rx.reset:
+                    raise _socket_error(errno.ECONNRESET)
+                if self._shut_rd:
+                    return b""
+                data = self._rx.read(network.now, nbytes, flags & MSG_PEEK)
+                if data is not None:
+                    return data
+                self._wait(self._rx.next_arrival(), deadline,
+                           nonblocking=timeout == 0 or flags & MSG_DONTWAIT)
+
+
+    def _wait(self, arrival, deadline, nonblocking=None):
+        """ Wait for the arrival time, advancing the virtual clock, or for
+        another thread's action if arrival is None; the caller holds the lock
+        and re-checks its condition afterwards
+
+        :param bool nonblocking: fail instead of waiting; defaults to the
+            socket's mode
+
+        :raises socket.error: EAGAIN if non-blocking
+        :raises socket.timeout: the deadline would pass first
+        """
+        network = self._network
+        if nonblocking is None:
+            nonblocking = self._timeout == 0
+        if nonblocking:
+            raise _socket_error(errno.EAGAIN)
+
+        if deadline is not None and (arrival is None or arrival > deadline):
+            network._advance_to(deadline)  # pylint: disable=W0212
+            raise socket.timeout("timed out")
+
+        if arrival is None:
+            network._cond.wait()  # pylint: disable=W0212
+        else:
+            network._advance_to(arrival)  # pylint: disable=W0212
+
+
+
+class SimForwarder(object):
+    """ Runs the forwarding engine of `inetpy.forward_server.ForwardServer`
+    in this process over a `SimNetwork`: each accepted connection is served
+    by the same session code, on its own threads.
+
+    TLS, worker processes, write coalescing and the session timeouts, which
+    rely on real descriptors or real time, aren't supported.
+    """
+
+    def __init__(self, network, remote_addr, server_addr=("forwarder", 0),  # pylint: disable=R0913
+                 observer=None, tunnel=None, tunnel_codec="zlib",
+                 tunnel_latency_budget=0.001, connect_timeout=None,
+                 mux_connections=2, mux_window=256 * 1024):
+        """
+        :param SimNetwork network: network to listen and connect on
+        :param tuple remote_addr: (host, port) to forward to; None to echo
+        :param tuple server_addr: (host, port) to listen on
+        :param observer: see `ForwardServer`
+        :param str tunnel: see `ForwardServer`
+        :param str tunnel_codec: see `ForwardServer`
+        :param float tunnel_latency_budget: see `ForwardServer`; in virtual
+            seconds
+        :param float connect_timeout: see `ForwardServer`; in virtual seconds
+        :param int mux_connections: see `ForwardServer`
+        :param int mux_window: see `ForwardServer`
+        """
+        self._network = network
+        self._counters = _SharedCounters(
+            forward_server._SERVER_COUNTER_NAMES)  # pylint: disable=W0212
+        self._handler_factory = forward_server._TCPHandler  # pylint: disable=W0212
+        self._config = forward_server._SessionConfig(  # pylint: disable=W0212
+            local_linger_args=None,
+            remote_addr=remote_addr,
+            remote_addr_family=AF_INET,
+            remote_socket_type=SOCK_STREAM,
+            observer=observer,
+            server_ssl_context=None,
+            remote_ssl_context=None,
+            remote_server_hostname=None,
+            tls_session_cache=None,
+            tunnel=tunnel,
+            tunnel_codec=get_codec(tunnel_codec),
+            tunnel_latency_budget=tunnel_latency_budget,
+            coalesce_hold_time=None,
+            coalesce_bytes=0,
+            connect_timeout=connect_timeout,
+            idle_timeout=None,
+            reaper=None,
+            mux_window=mux_window,
+            transport=network,
+            counters=self._counters)
+        if tunnel == forward_server.ForwardServer.TUNNEL_MUX:
+            self._config.mux_client = MuxClient(
+                partial(forward_server._open_connection,  # pylint: disable=W0212
+                        self._config),
+                mux_connections,
+                self._counters,
+                mux_window)
+
+        self._listener = network.socket()
+        self._listener.bind(server_addr)
+        self._listener.listen(socket.SOMAXCONN)
+        self._acceptor = None
+
+
+    @property
+    def server_address(self):
+        """Property: (host, port) the forwarder listens on"""
+        return self._listener.getsockname()
+
+
+    @property
+    def stats(self):
+        """Property: snapshot of the counters, as `ForwardServer.stats`"""
+        return self._counters.snapshot()
+
+
+    def __enter__(self):
+        return self.start()
+
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+    def start(self):
+        """Start accepting connections
+
+        :returns: self
+        """
+        self._acceptor = threading.Thread(target=self._accept_forever)
+        self._acceptor.setDaemon(True)
+        self._acceptor.start()
+        return self
+
+
+    def stop(self):
+        """Stop accepting connections; sessions run until their peers close
+        """
+        self._listener.close()
+        if self._acceptor is not None:
+            self._acceptor.join()
+            self._acceptor = None
+
+
+    def _accept_forever(self):
+        """Accept connections and start a session for each"""
+        while True:
+            try:
+                sock, client_address = self._listener.accept()
+            except socket.error:
+                # Closed by stop()
+                return
+
+            self._counters.add("sessions_accepted")
+            self._counters.add("active_sessions")
+            session = threading.Thread(target=self._run_session,
+                                       args=(sock, client_address))
+            session.setDaemon(True)
+            session.start()
+
+
+    def _run_session(self, sock, client_address):
+        """Run the session to completion and clean up"""
+        try:
+            self._handler_factory(sock, client_address, None, self._config)
+        finally:
+            sock.close()
+            self._counters.add("active_sessions", -1)
@@ -1,17 +1,22 @@
 """socket.socketpair substitute with support for Windows"""
 
+import errno
 import socket
 import threading
 
 
 def socket_pair(family=None, sock_type=socket.SOCK_STREAM,
-                proto=socket.IPPROTO_IP):
+                proto=socket.IPPROTO_IP, transport=socket):
     """ socket.socketpair abstraction with support for Windows
 
     :param family: address family; e.g., socket.AF_UNIX, socket.AF_INET, etc.;
       defaults to socket.AF_UNIX if available, with fallback to socket.AF_INET.
+      Without `socketpair()`, only socket.AF_INET and socket.AF_INET6 are
+      supported, and the default is socket.AF_INET.
     :param sock_type: socket type; defaults to socket.SOCK_STREAM
     :param proto: protocol; defaults to socket.IPPROTO_IP
+    :param transport: provider of `socketpair()`: the `socket` module
+      (default), or an `inetpy.simnet.SimNetwork` for simulated sockets
 
     :returns: connected socket pair (sock1, sock2)
 
@@ -26,44 +31,245 @@ def socket_pair(family=None, sock_type=socket.SOCK_STREAM,
         sock2.sendall("1234")
         assert sock1.recv(4) == "1234"
     """
+    return socket_pairs(1, family, sock_type, proto, transport=transport)[0]
+
+
+
+def socket_pairs(count, family=None, sock_type=socket.SOCK_STREAM,
+                 proto=socket.IPPROTO_IP, sndbuf=None, rcvbuf=None,
+                 blocking=True, transport=socket):
+    """Create several connected socket pairs at once
+
+    Without `socketpair()`, a single listener serves the whole batch, and
+    connects are issued without blocking, so no helper thread is needed.
+
+    :param int count: number of pairs to create
+    :param family: see `socket_pair`
+    :param sock_type: see `socket_pair`
+    :param proto: see `socket_pair`
+    :param int sndbuf: SO_SNDBUF to set on every socket; None for the system
+      default
+    :param int rcvbuf: SO_RCVBUF to set on every socket; None for the system
+      default
+    :param bool blocking: False to put every socket in non-blocking mode
+    :param transport: see `socket_pair`
+
+    :returns: list of connected socket pairs [(sock1, sock2), ...]
+
+    :raises ValueError: family unsupported without `socketpair()`
+    """
+    socketpair = getattr(transport, "socketpair", None)
+
     if family is None:
-        family = getattr(socket, "AF_UNIX", None)
+        family = (getattr(socket, "AF_UNIX", None)
+                  if socketpair is not None else None)
         if family is None:
             family = socket.AF_INET
+    elif socketpair is None and family not in _LOOPBACK_ADDRESSES:
+        raise ValueError("Without socketpair(), only AF_INET and AF_INET6 "
+                         "pairs can be created, not family %r" % (family,))
+
+    pairs = []
+    try:
+        if socketpair is not None:
+            for _ in range(count):
+                pairs.append(socketpair(family, sock_type, proto))
+        else:
+            # Probably running on Windows where socket.socketpair isn't
+            # supported
+            _connect_pairs(count, family, sock_type, proto, pairs)
+
+        for pair in pairs:
+            for sock in pair:
+                if sndbuf is not None:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                                    sndbuf)
+                if rcvbuf is not None:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                    rcvbuf)
+                sock.setblocking(blocking)
+    except Exception:
+        for pair in pairs:
+            for sock in pair:
+                sock.close()
+        raise
+
+    return pairs
+
 
-    socketpair = getattr(socket, "socketpair", None)
-    if socketpair is not None:
-        socket1, socket2 = socketpair(family, sock_type, proto)
-    else:
-        # Probably running on Windows where socket.socketpair isn't supported
 
-        # Work around lack of socket.socketpair()
+# Addresses of the listener connecting pairs without socketpair(), by family
+_LOOPBACK_ADDRESSES = {
+    socket.AF_INET: ("127.0.0.1", 0),
+    socket.AF_INET6: ("::1", 0),
+}
 
-        socket1 = socket2 = None
 
-        listener = socket(family, sock_type, proto)
+
+def _connect_pairs(count, family, sock_type, proto, pairs):
+    """Work around lack of socket.socketpair(): connect count pairs over
+    loopback via one listener, appending each to pairs as it's accepted
+    """
+    listener = socket.socket(family, sock_type, proto)
+    try:
         listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(_LOOPBACK_ADDRESSES[family])
+        listener.listen(count)
+        listener_address = listener.getsockname()
+
+        for _ in range(count):
+            socket1 = socket.socket(family, sock_type, proto)
+            try:
+                # NOTE: the listener completes the handshake on its own, so
+                # the connect needn't wait for the accept
+                socket1.setblocking(False)
+                socket1.connect_ex(listener_address)
+                socket2 = listener.accept()[0]
+                socket1.setblocking(True)
+            except Exception:
+                socket1.close()
+                raise
+            pairs.append((socket1, socket2))
+    finally:
+        listener.close()
+
+
+
+class SocketPairPool(object):
+    """Thread-safe source of pre-created socket pairs
+
+    Pairs are created in batches of `batch_size` via `socket_pairs`, the
+    first when the pool is constructed, and handed out once each; the pool is
+    refilled with another batch when it runs out.
+
+    :example:
+        pool = SocketPairPool(batch_size=64, blocking=False)
+
+        sock1, sock2 = pool.acquire()
+        ...
+
+        pool.close()
+    """
+
+    def __init__(self, batch_size=16, **pair_options):
+        """
+        :param int batch_size: number of pairs to create at a time
+        :param pair_options: keyword args for `socket_pairs`; e.g., family,
+          sndbuf, rcvbuf, blocking, transport
+        """
+        assert batch_size > 0, batch_size
 
-        listener.bind(("localhost", 0))
-        listener.listen(1)
-        listener_port = listener.getsockname()[1]
+        self._batch_size = batch_size
+        self._pair_options = pair_options
+        self._lock = threading.Lock()
+        self._pairs = socket_pairs(batch_size, **pair_options)
+        self._closed = False
 
-        socket1 = socket(family, sock_type, proto)
 
-        # Use thread to connect in background, while foreground issues the
-        # blocking accept()
-        conn_thread = threading.Thread(
-            target=socket1.connect,
-            args=(('localhost', listener_port),))
-        conn_thread.setDaemon(1)
-        conn_thread.start()
+    def __len__(self):
+        """:returns: number of pairs ready to be handed out"""
+        return len(self._pairs)
 
+
+    def acquire(self):
+        """:returns: a connected socket pair (sock1, sock2), now owned by the
+        caller
+        """
+        with self._lock:
+            assert not self._closed, "SocketPairPool is closed"
+            if not self._pairs:
+                self._pairs = socket_pairs(self._batch_size,
+                                           **self._pair_options)
+            return self._pairs.pop()
+
+
+    def close(self):
+        """Close the pairs that haven't been handed out"""
+        with self._lock:
+            self._closed = True
+            pairs, self._pairs = self._pairs, []
+
+        for pair in pairs:
+            for sock in pair:
+                sock.close()
+
+
+
+class WakeupChannel(object):
+    """Wakes a thread blocked in select/poll on `fileno()`
+
+    Repeated `signal` calls between two `drain` calls write a single byte, so
+    a heavily signaled loop neither floods the socket pair nor drains more
+    than one byte per wakeup.
+
+    Whoever signals must publish the work before calling `signal`, and the
+    woken thread must call `drain` before it collects the work.
+
+    :example:
+        channel = WakeupChannel()
+
+        # Producer thread
+        inbox.append(item)
+        channel.signal()
+
+        # Event loop thread, once fileno() polls readable
+        channel.drain()
+        while inbox:
+            handle(inbox.popleft())
+    """
+
+    def __init__(self, transport=socket):
+        """
+        :param transport: see `socket_pair`
+        """
+        self._rx, self._tx = socket_pair(transport=transport)
+        self._rx.setblocking(False)
+        self._tx.setblocking(False)
+        self._pending = False
+
+
+    def fileno(self):
+        """:returns: descriptor that polls readable once signaled"""
+        return self._rx.fileno()
+
+
+    def signal(self):
+        """Wake the thread waiting on `fileno()`; may be called from any
+        thread
+
+        :returns: True if a byte was written; False if coalesced with an
+          earlier signal that hasn't been drained yet
+        """
+        if self._pending:
+            return False
+        self._pending = True
+
+        try:
+            self._tx.send(b"\0")
+        except socket.error as exc:
+            # NOTE: a full pipe already has the waiter's attention
+            if exc.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        return True
+
+
+    def drain(self):
+        """Consume the pending wakeup, if any, so that `fileno()` no longer
+        polls readable until the next `signal`
+        """
         try:
-            socket2 = listener.accept()[0]
-        finally:
-            listener.close()
+            while self._rx.recv(64):
+                pass
+        except socket.error as exc:
+            if exc.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+        # NOTE: cleared only after draining, so a signal that arrives
+        # meanwhile either finds the work published or writes a fresh byte
+        self._pending = False
 
-            # Join/reap background thread
-            conn_thread.join(timeout=10)
 
-    return (socket1, socket2)
+    def close(self):
+        """Close the underlying socket pair"""
+        self._rx.close()
+        self._tx.close()
@@ -0,0 +1,406 @@
+"""Framed stream compression for tunnels between two ForwardServers.
+
+The compressing side starts the stream with a preamble that identifies the
+codec, followed by frames, each with a 5-byte header: frame type (RAW or
+COMPRESSED) and payload length. Compressed frames form one continuous
+compression stream, flushed at the end of each frame, so the decompressing
+side needs no configuration beyond having the codec available. Data that
+turns out not to compress is sent in RAW frames for a while, bypassing the
+codec.
+"""
+
+import os
+import struct
+import sys
+import zlib
+
+try:
+    import resource
+except ImportError:
+    resource = None # pylint: disable=C0103
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None # pylint: disable=C0103
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None # pylint: disable=C0103
+
+import time
+
+
+def _cpu_clock():
+    """:returns: function of () returning the calling thread's CPU time, in
+    seconds: `time.thread_time` (python 3.7+), else getrusage(RUSAGE_THREAD)
+    on Linux, else, as the last resort, the process's CPU time
+    """
+    thread_time = getattr(time, "thread_time", None)
+    if thread_time is not None:
+        return thread_time
+
+    if resource is not None and sys.platform.startswith("linux"):
+        # NOTE: python 2 lacks the constant
+        who = getattr(resource, "RUSAGE_THREAD", 1)
+
+        def rusage_thread_time():
+            """:returns: the calling thread's CPU time, in seconds"""
+            usage = resource.getrusage(who)
+            return usage.ru_utime + usage.ru_stime
+
+        try:
+            rusage_thread_time()
+        except (ValueError, resource.error):
+            pass
+        else:
+            return rusage_thread_time
+
+    return lambda: sum(os.times()[:2])
+
+
+# For accounting the cost of the codec
+_cpu_now = _cpu_clock()
+
+_now = getattr(time, "perf_counter", time.time)
+
+
+_PREAMBLE_MAGIC = b"IPZ1"
+
+_FRAME_HEADER = struct.Struct("!BI")
+
+FRAME_RAW = 0
+FRAME_COMPRESSED = 1
+
+
+
+class _ZlibCodec(object):
+    """zlib stream; frames end with Z_SYNC_FLUSH"""
+
+    codec_id = 1
+
+    def __init__(self, level=1):
+        self._level = level
+
+    def compressor(self):
+        """:returns: callable of (data) returning the flushed compressed
+        data; the compression state carries over between calls
+        """
+        compressobj = zlib.compressobj(self._level)
+
+        def compress(data):
+            return (compressobj.compress(data) +
+                    compressobj.flush(zlib.Z_SYNC_FLUSH))
+
+        return compress
+
+    @staticmethod
+    def decompressor():
+        """:returns: callable of (data) returning decompressed data"""
+        return zlib.decompressobj().decompress
+
+
+
+class _ZstdCodec(object):
+    """zstandard stream; frames end with a block flush"""
+
+    codec_id = 2
+
+    def __init__(self, level=3):
+        self._level = level
+
+    def compressor(self):
+        """:returns: callable of (data) returning the flushed compressed
+        data; the compression state carries over between calls
+        """
+        compressobj = zstandard.ZstdCompressor(level=self._level).compressobj()
+
+        def compress(data):
+            return (compressobj.compress(data) +
+                    compressobj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK))
+
+        return compress
+
+    @staticmethod
+    def decompressor():
+        """:returns: callable of (data) returning decompressed data"""
+        return zstandard.ZstdDecompressor().decompressobj().decompress
+
+
+
+class _Lz4Codec(object):
+    """Independent lz4 frames; fastest, but without cross-frame history"""
+
+    codec_id = 3
+
+    @staticmethod
+    def compressor():
+        """:returns: callable of (data) returning compressed data"""
+        return lz4_frame.compress
+
+    @staticmethod
+    def decompressor():
+        """:returns: callable of (data) returning decompressed data"""
+        return lz4_frame.decompress
+
+
+
+_CODECS = dict(zlib=_ZlibCodec, zstd=_ZstdCodec, lz4=_Lz4Codec)
+
+_CODEC_MODULES = dict(zlib=zlib, zstd=zstandard, lz4=lz4_frame)
+
+
+def available_codecs():
+    """:returns: names of the codecs usable in this interpreter"""
+    return sorted(name for name, module in _CODEC_MODULES.items()
+                  if module is not None)
+
+
+
+def get_codec(name):
+    """
+    :param str name: "zlib", "zstd" or "lz4"
+
+    :returns: codec instance
+
+    :raises ValueError: unknown codec or its module isn't installed
+    """
+    if name not in available_codecs():
+        raise ValueError("Tunnel codec %r is not available; available: %r"
+                         % (name, available_codecs()))
+
+    return _CODECS[name]()
+
+
+
+class StreamCompressor(object):
+    """ Compresses a byte stream into frames and sends them.
+
+    Data passed to `send` is held back and coalesced into a single frame while
+    more data is readily available from the source, as long as the latency
+    budget and byte threshold allow. Not thread-safe.
+    """
+
+    # Compressed/raw size ratio above which a frame counts as incompressible
+    _POOR_RATIO = 0.9
+
+    # Consecutive incompressible frames that trigger bypass
+    _POOR_FRAMES_TO_BYPASS = 3
+
+    # Initial and maximum number of bytes to send uncompressed when bypassing
+    _MIN_BYPASS_BYTES = 1024 * 1024
+    _MAX_BYPASS_BYTES = 64 * 1024 * 1024
+
+
+    def __init__(self, codec, sendall, source_readable, counters,  # pylint: disable=R0913
+                 latency_budget=0.001, flush_bytes=64 * 1024):
+        """
+        :param codec: from `get_codec`
+        :param sendall: callable of (data) that sends to the peer
+        :param source_readable: callable of (timeout) that returns True if
+            more source data becomes available within timeout seconds
+        :param _SharedCounters counters: counters with the "tunnel_*" names
+        :param float latency_budget: maximum number of seconds to hold back
+            data waiting for more
+        :param int flush_bytes: send the frame once this many bytes are held
+        """
+        self._compress = codec.compressor()
+        self._sendall = sendall
+        self._source_readable = source_readable
+        self._counters = counters
+        self._latency_budget = latency_budget
+        self._flush_bytes = flush_bytes
+
+        self._held = []
+        self._held_bytes = 0
+        self._held_since = None
+
+        self._poor_frames = 0
+        self._bypass_bytes = 0
+        self._next_bypass_bytes = self._MIN_BYPASS_BYTES
+
+        # Sent with the first frame
+        self._preamble = _PREAMBLE_MAGIC + struct.pack("!B", codec.codec_id)
+
+
+    def send(self, data):
+        """Hold the data for the next frame; send the frame when the latency
+        budget or byte threshold is reached or no more data is forthcoming
+        """
+        now = _now()
+        if self._held_since is None:
+            self._held_since = now
+
+        # NOTE: copy, since the caller reuses its buffer
+        self._held.append(bytes(data))
+        self._held_bytes += len(data)
+
+        if self._held_bytes < self._flush_bytes:
+            remaining = self._latency_budget - (now - self._held_since)
+            if remaining > 0 and self._source_readable(remaining):
+                return
+
+        self.flush()
+
+
+    def flush(self):
+        """Send the held data, if any, as a frame"""
+        if not self._held_bytes:
+            return
+
+        data = b"".join(self._held)
+        self._held = []
+        self._held_bytes = 0
+
+        # NOTE: published together, taking the counters' lock once per frame
+        amounts = [("tunnel_frames", 1),
+                   ("tunnel_plain_bytes", len(data))]
+
+        if self._bypass_bytes > 0:
+            self._bypass_bytes -= len(data)
+            frame_type = FRAME_RAW
+            payload = data
+        else:
+            payload = _timed(self._compress, data, amounts)
+            frame_type = FRAME_COMPRESSED
+            if self._check_ratio(len(data), len(payload)):
+                amounts.append(("tunnel_bypasses", 1))
+
+        header = _FRAME_HEADER.pack(frame_type, len(payload))
+        if self._preamble:
+            header = self._preamble + header
+            self._preamble = None
+        self._sendall(header + payload)
+
+        amounts.extend([
+            ("tunnel_wire_bytes", _FRAME_HEADER.size + len(payload)),
+            ("tunnel_hold_usec", int((_now() - self._held_since) * 1e6))])
+        self._counters.add_many(amounts)
+        self._held_since = None
+
+
+    def _check_ratio(self, plain_size, compressed_size):
+        """Enter bypass after a streak of poorly-compressed frames
+
+        :returns: True if bypass was entered
+        """
+        if compressed_size <= plain_size * self._POOR_RATIO:
+            self._poor_frames = 0
+            self._next_bypass_bytes = self._MIN_BYPASS_BYTES
+            return False
+
+        self._poor_frames += 1
+        if self._poor_frames < self._POOR_FRAMES_TO_BYPASS:
+            return False
+
+        self._poor_frames = 0
+        self._bypass_bytes = self._next_bypass_bytes
+        # Back off exponentially while the data remains incompressible
+        self._next_bypass_bytes = min(self._next_bypass_bytes * 2,
+                                      self._MAX_BYPASS_BYTES)
+        return True
+
+
+
+class StreamDecompressor(object):
+    """ Parses frames produced by `StreamCompressor` and sends the decoded
+    stream. Not thread-safe.
+    """
+
+    def __init__(self, sendall, counters):
+        """
+        :param sendall: callable of (data) that sends the decoded data
+        :param _SharedCounters counters: counters with the "tunnel_*" names
+        """
+        self._sendall = sendall
+        self._counters = counters
+        self._decompress = None
+        self._pending = b""
+
+
+    def send(self, data):
+        """Consume wire data, sending the payloads of the complete frames
+
+        :raises ValueError: malformed stream or unavailable codec
+        """
+        self._pending += bytes(data)
+
+        if self._decompress is None:
+            preamble_size = len(_PREAMBLE_MAGIC) + 1
+            if len(self._pending) < preamble_size:
+                return
+            if not self._pending.startswith(_PREAMBLE_MAGIC):
+                raise ValueError("Not a compressed tunnel stream: %r"
+                                 % (self._pending[:preamble_size],))
+            codec_id = struct.unpack("!B", self._pending[preamble_size - 1:
+                                                         preamble_size])[0]
+            self._decompress = _codec_by_id(codec_id).decompressor()
+            self._pending = self._pending[preamble_size:]
+
+        # NOTE: published once per call, rather than per frame
+        amounts = []
+        offset = 0
+        while len(self._pending) - offset >= _FRAME_HEADER.size:
+            frame_type, length = _FRAME_HEADER.unpack_from(self._pending,
+                                                           offset)
+            end = offset + _FRAME_HEADER.size + length
+            if end > len(self._pending):
+                break
+
+            payload = self._pending[offset + _FRAME_HEADER.size:end]
+            offset = end
+
+            if frame_type == FRAME_COMPRESSED:
+                payload = _timed(self._decompress, payload, amounts)
+            elif frame_type != FRAME_RAW:
+                raise ValueError("Unexpected tunnel frame type %r"
+                                 % (frame_type,))
+
+            if payload:
+                self._sendall(payload)
+
+        self._pending = self._pending[offset:]
+        if amounts:
+            self._counters.add_many(amounts)
+
+
+    def flush(self):
+        """Called at EOF of the wire stream
+
+        :raises ValueError: stream ended mid-frame
+        """
+        if self._pending:
+            raise ValueError("Compressed tunnel stream truncated with %d "
+                             "bytes of incomplete frame"
+                             % (len(self._pending),))
+
+
+
+def _timed(codec_call, data, amounts):
+    """ Run the codec on the data, accounting its CPU time as a
+    "tunnel_codec_usec" amount
+
+    :param codec_call: compressor or decompressor
+    :param data: input to the codec
+    :param list amounts: (name, amount) pairs to append the CPU time to
+
+    :returns: the codec's output
+    """
+    cpu_start = _cpu_now()
+    result = codec_call(data)
+    amounts.append(("tunnel_codec_usec", int((_cpu_now() - cpu_start) * 1e6)))
+    return result
+
+
+
+def _codec_by_id(codec_id):
+    """:returns: codec instance for the codec id from a preamble
+
+    :raises ValueError: unknown or unavailable codec
+    """
+    for name, codec_class in _CODECS.items():
+        if codec_class.codec_id == codec_id:
+            return get_codec(name)
+
+    raise ValueError("Unknown tunnel codec id %r" % (codec_id,))
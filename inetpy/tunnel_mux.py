@@ -0,0 +1,583 @@
+"""Multiplexing of many sessions over a few connections, for tunnels between
+two ForwardServers.
+
+Each frame has a 9-byte header: frame type, stream id and payload length.
+The multiplexing side opens a stream per session with an OPEN frame; both
+sides then send DATA frames, a FIN frame when they have no more data for the
+stream (half-close), and a RESET frame to abort it.
+
+Flow control is per stream and direction, so that a stream whose receiver is
+slow doesn't hold up the other streams on the connection: a sender may have
+up to the receiver's window of data in flight or buffered at the receiver,
+and the receiver grants more with WINDOW frames as its data is consumed.
+Every window starts at `INITIAL_WINDOW`; a side with a larger one grants the
+difference with a WINDOW frame right after OPEN.
+
+The thread that reads frames never sends any, which rules out the deadlock
+of both sides blocking in send while neither one reads.
+"""
+from __future__ import print_function
+
+import array
+import collections
+from datetime import datetime
+import errno
+import itertools
+import os
+import socket
+import struct
+import sys
+import threading
+
+
+
+_FRAME_HEADER = struct.Struct("!BII")
+
+FRAME_OPEN = 1
+FRAME_DATA = 2
+FRAME_FIN = 3
+FRAME_WINDOW = 4
+FRAME_RESET = 5
+
+_WINDOW_PAYLOAD = struct.Struct("!I")
+
+# Window that both sides assume for each new stream
+INITIAL_WINDOW = 64 * 1024
+
+# Maximum DATA frame payload
+_MAX_DATA_FRAME = 64 * 1024
+
+_SOCK_RX_BUF_SIZE = 256 * 1024
+
+
+
+def _trace(fmt, *args):
+    """Format and output the text to stderr"""
+    print((fmt % args) + "\n", end="", file=sys.stderr)
+
+
+
+def _socket_error(code):
+    """:returns: socket.error for the errno value"""
+    return socket.error(code, os.strerror(code))
+
+
+
+class MuxConnection(object):
+    """ One connection between the multiplexing and demultiplexing sides,
+    carrying any number of streams. Thread-safe.
+
+    `run` reads and dispatches frames until the connection fails or is closed
+    by the peer, whereupon all of its streams are reset.
+    """
+
+    def __init__(self, sock, counters, window, on_open=None):
+        """
+        :param sock: connected socket; `socket.socket` or socket-like, with
+            blocking `recv_into` and `sendall`
+        :param _SharedCounters counters: counters with the "mux_*" names
+        :param int window: receive window of each stream, in bytes; at least
+            INITIAL_WINDOW
+        :param on_open: on the demultiplexing side, callable of (MuxStream)
+            called by `run` for each stream opened by the peer; it must not
+            block. None on the multiplexing side.
+        """
+        assert window >= INITIAL_WINDOW, window
+        self._sock = sock
+        self._counters = counters
+        self._window = window
+        self._on_open = on_open
+
+        # Guards the streams' state; their conditions share it
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._streams = dict()
+        self._stream_ids = itertools.count(1)
+        self._closed = False
+
+
+    @property
+    def closed(self):
+        """Property: True once the connection failed or was closed"""
+        return self._closed
+
+
+    @property
+    def stream_count(self):
+        """Property: number of open streams"""
+        return len(self._streams)
+
+
+    def open_stream(self):
+        """ Open a new stream to the peer
+
+        :returns: MuxStream
+
+        :raises socket.error: the connection is closed
+        """
+        with self._lock:
+            if self._closed:
+                raise _socket_error(errno.EPIPE)
+            stream = MuxStream(self, next(self._stream_ids))
+            self._streams[stream.stream_id] = stream
+
+        self._counters.add("mux_streams")
+        self.send_frame(FRAME_OPEN, stream.stream_id)
+        self._grant_initial_window(stream)
+        return stream
+
+
+    def run(self):
+        """Read and dispatch frames until the connection ends"""
+        rx_buf = bytearray(_SOCK_RX_BUF_SIZE)
+        rx_view = memoryview(rx_buf)
+        buf = bytearray()
+        try:
+            while True:
+                # NOTE: recv_into, since that is all that the forwarding
+                # engine's TLS socket wrapper provides
+                nbytes = self._sock.recv_into(rx_buf)
+                if not nbytes:
+                    break
+                buf += rx_view[:nbytes]
+
+                offset = 0
+                while len(buf) - offset >= _FRAME_HEADER.size:
+                    frame_type, stream_id, length = _FRAME_HEADER.unpack_from(
+                        buf, offset)
+                    end = offset + _FRAME_HEADER.size + length
+                    if end > len(buf):
+                        break
+                    self._dispatch(frame_type, stream_id,
+                                   bytes(buf[offset + _FRAME_HEADER.size:end]))
+                    offset = end
+
+                del buf[:offset]
+        except (socket.error, ValueError) as exc:
+            # NOTE: once closing, `close` may close the socket under a
+            # pending receive, which is how it ends rather than a failure
+            if not (self._closed and getattr(exc, "errno", None) in
+                    (errno.EBADF, errno.ENOTSOCK)):
+                _trace("%s Multiplexed connection failed: %r",
+                       datetime.utcnow(), exc)
+        finally:
+            self.close()
+
+
+    def close(self):
+        """Close the connection and reset its streams"""
+        with self._lock:
+            if self._closed:
+                return
+            # NOTE: before the socket is closed, so that `run` recognizes the
+            # errors of receiving from it as the end of the connection
+            self._closed = True
+            streams = list(self._streams.values())
+            self._streams.clear()
+            for stream in streams:
+                stream._on_reset()  # pylint: disable=W0212
+
+        try:
+            # NOTE: also fails any sendall in progress
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        # NOTE: not while another thread sends, lest the descriptor be reused
+        # under it
+        with self._send_lock:
+            self._sock.close()
+
+
+    def send_frame(self, frame_type, stream_id, payload=b""):
+        """ Send a frame; may be called from any thread
+
+        :param bytes payload:
+
+        :raises socket.error: EPIPE if the connection is closed
+        """
+        frame = _FRAME_HEADER.pack(frame_type, stream_id, len(payload))
+        if payload:
+            frame += payload
+        with self._send_lock:
+            if self._closed:
+                raise _socket_error(errno.EPIPE)
+            try:
+                self._sock.sendall(frame)
+            except socket.error:
+                # NOTE: the reader notices, too, and resets the streams
+                raise _socket_error(errno.EPIPE)
+
+
+    def _grant_initial_window(self, stream):
+        """Grant the part of our window beyond INITIAL_WINDOW"""
+        if self._window > INITIAL_WINDOW:
+            stream._grant(self._window - INITIAL_WINDOW)  # pylint: disable=W0212
+
+
+    def _dispatch(self, frame_type, stream_id, payload):
+        """Handle a received frame; called by `run`
+
+        :raises ValueError: protocol violation
+        """
+        if frame_type == FRAME_OPEN:
+            if self._on_open is None:
+                raise ValueError("Unexpected OPEN of stream %d" % (stream_id,))
+            with self._lock:
+                if stream_id in self._streams:
+                    raise ValueError("Duplicate OPEN of stream %d"
+                                     % (stream_id,))
+                # NOTE: the stream grants the rest of our window once it is
+                # first received from, since this thread mustn't send
+                stream = MuxStream(self, stream_id,
+                                   ungranted=self._window - INITIAL_WINDOW)
+                self._streams[stream_id] = stream
+            self._counters.add("mux_streams")
+            self._on_open(stream)
+            return
+
+        with self._lock:
+            stream = self._streams.get(stream_id)
+            if stream is None:
+                # NOTE: frames may cross with our RESET or close
+                return
+
+            if frame_type == FRAME_DATA:
+                stream._on_data(payload)  # pylint: disable=W0212
+            elif frame_type == FRAME_WINDOW:
+                stream._on_window(  # pylint: disable=W0212
+                    _WINDOW_PAYLOAD.unpack(payload)[0])
+            elif frame_type == FRAME_FIN:
+                stream._on_fin()  # pylint: disable=W0212
+            elif frame_type == FRAME_RESET:
+                self._counters.add("mux_resets")
+                stream._on_reset()  # pylint: disable=W0212
+            else:
+                raise ValueError("Unexpected frame type %r" % (frame_type,))
+
+
+    def _forget(self, stream):
+        """Remove the stream from the connection; the caller holds the lock
+        """
+        if self._streams.get(stream.stream_id) is stream:
+            del self._streams[stream.stream_id]
+
+
+
+class MuxStream(object):
+    """ One session's stream on a `MuxConnection`. Socket-like, so that
+    `inetpy.forward_server` forwards to and from it as it does with sockets:
+    `recv_into` returns 0 at the peer's FIN and `shutdown(SHUT_WR)` sends
+    FIN. A stream that is reset, or whose connection fails, raises
+    ECONNRESET from `recv_into` and EPIPE from `sendall`.
+
+    One thread may receive while another one sends.
+    """
+
+    def __init__(self, connection, stream_id, ungranted=0):
+        """
+        :param MuxConnection connection:
+        :param int stream_id:
+        :param int ungranted: window to grant the peer with the first grant
+        """
+        self._connection = connection
+        self.stream_id = stream_id
+
+        # NOTE: share the connection's lock, which guards the state below
+        self._readable = threading.Condition(connection._lock)  # pylint: disable=W0212
+        self._writable = threading.Condition(connection._lock)  # pylint: disable=W0212
+
+        self._inbound = collections.deque()
+        self._inbound_offset = 0
+        # Window consumed but not yet granted back to the peer
+        self._ungranted = ungranted
+        self._credit = INITIAL_WINDOW
+
+        self._fin_received = False
+        self._fin_sent = False
+        self._read_shut = False
+        self._reset = False
+        self._closed = False
+
+
+    def getpeername(self):
+        """:returns: pseudo address identifying the stream"""
+        return ("mux-stream", self.stream_id)
+
+
+    def setsockopt(self, *args):
+        """Socket options don't apply to streams"""
+        pass
+
+
+    def recv_into(self, buf, nbytes=0, flags=0):  # pylint: disable=W0613
+        """ Block until data, FIN or reset, and receive data into buf
+
+        :returns: number of bytes received; 0 after the peer's FIN
+
+        :raises socket.error: ECONNRESET if the stream was reset
+        """
+        nbytes = nbytes or len(buf)
+        with self._readable:
+            while True:
+                if self._inbound:
+                    break
+                if self._reset:
+                    raise _socket_error(errno.ECONNRESET)
+                if self._fin_received or self._read_shut:
+                    return 0
+                self._readable.wait()
+
+            chunk = self._inbound[0]
+            data = chunk[self._inbound_offset:self._inbound_offset + nbytes]
+            self._inbound_offset += len(data)
+            if self._inbound_offset == len(chunk):
+                self._inbound.popleft()
+                self._inbound_offset = 0
+
+            self._ungranted += len(data)
+            grant = 0
+            if self._ungranted >= self._connection._window // 4:  # pylint: disable=W0212
+                grant = self._ungranted
+                self._ungranted = 0
+
+        if isinstance(buf, array.array):
+            # NOTE: python 2 arrays don't support memoryview
+            buf[:len(data)] = array.array("B", data)
+        else:
+            memoryview(buf)[:len(data)] = data
+
+        if grant:
+            self._grant(grant)
+        return len(data)
+
+
+    def wait_readable(self, timeout):
+        """ Wait for data, FIN or reset, the way `inetpy.forward_server`
+        waits for readiness of sockets
+
+        :param float timeout: seconds; None to wait indefinitely
+
+        :returns: True if readable; False on timeout
+        """
+        with self._readable:
+            if not self._is_readable() and timeout != 0:
+                self._readable.wait(timeout)
+            return self._is_readable()
+
+
+    def sendall(self, data):
+        """ Send all of data, blocking while the peer's window is full
+
+        :raises socket.error: EPIPE if shut down for sending, reset or the
+            connection is closed
+        """
+        connection = self._connection
+        data = bytes(data)
+        offset = 0
+        while offset < len(data):
+            with self._writable:
+                if not self._credit and not self._send_failed():
+                    connection._counters.add("mux_window_waits")  # pylint: disable=W0212
+                    while not self._credit and not self._send_failed():
+                        self._writable.wait()
+                if self._send_failed():
+                    raise _socket_error(errno.EPIPE)
+                size = min(self._credit, len(data) - offset, _MAX_DATA_FRAME)
+                self._credit -= size
+
+            connection.send_frame(FRAME_DATA, self.stream_id,
+                                  data[offset:offset + size])
+            offset += size
+
+
+    def shutdown(self, how):
+        """ SHUT_WR sends FIN. SHUT_RD before the peer's FIN resets the
+        stream, since its data can't be delivered anymore.
+        """
+        with self._readable:
+            if self._reset or self._closed:
+                return
+            send_fin = how != socket.SHUT_RD and not self._fin_sent
+            self._fin_sent = self._fin_sent or send_fin
+            reset = (how != socket.SHUT_WR and not self._fin_received and
+                     not self._read_shut)
+            self._read_shut = self._read_shut or how != socket.SHUT_WR
+            self._readable.notify_all()
+
+        try:
+            if reset:
+                self._send_reset()
+            elif send_fin:
+                self._connection.send_frame(FRAME_FIN, self.stream_id)
+        except socket.error:
+            pass
+
+
+    def close(self):
+        """Release the stream, resetting it unless it ended with FIN in both
+        directions
+        """
+        with self._readable:
+            if self._closed:
+                return
+            self._closed = True
+            clean = self._reset or (self._fin_sent and self._fin_received)
+            self._connection._forget(self)  # pylint: disable=W0212
+            self._readable.notify_all()
+            self._writable.notify_all()
+
+        if not clean:
+            try:
+                self._send_reset()
+            except socket.error:
+                pass
+
+
+    def _is_readable(self):
+        """The caller holds the lock"""
+        return bool(self._inbound or self._reset or self._fin_received or
+                    self._read_shut)
+
+
+    def _send_failed(self):
+        """The caller holds the lock"""
+        return self._reset or self._closed or self._fin_sent
+
+
+    def _send_reset(self):
+        """Reset the stream and tell the peer"""
+        with self._readable:
+            self._on_reset()
+        self._connection._counters.add("mux_resets")  # pylint: disable=W0212
+        self._connection.send_frame(FRAME_RESET, self.stream_id)
+
+
+    def _grant(self, size):
+        """Grant the peer more window"""
+        try:
+            self._connection.send_frame(FRAME_WINDOW, self.stream_id,
+                                        _WINDOW_PAYLOAD.pack(size))
+        except socket.error:
+            pass
+
+
+    def _on_data(self, payload):
+        """DATA frame received; the caller holds the lock"""
+        if self._read_shut or self._reset:
+            return
+        self._inbound.append(payload)
+        self._readable.notify()
+
+
+    def _on_window(self, size):
+        """WINDOW frame received; the caller holds the lock"""
+        self._credit += size
+        self._writable.notify()
+
+
+    def _on_fin(self):
+        """FIN frame received; the caller holds the lock"""
+        self._fin_received = True
+        self._readable.notify_all()
+
+
+    def _on_reset(self):
+        """RESET frame received or connection closed; the caller holds the
+        lock
+        """
+        self._reset = True
+        self._inbound.clear()
+        self._readable.notify_all()
+        self._writable.notify_all()
+
+
+
+class MuxClient(object):
+    """ The multiplexing side's fixed set of long-lived connections to the
+    peer, connected on demand and replaced when they fail. New streams go to
+    the connection with the fewest streams. Thread-safe.
+    """
+
+    def __init__(self, connect, connections, counters, window):
+        """
+        :param connect: callable that returns a new connected socket to the
+            demultiplexing peer
+        :param int connections: number of connections to spread streams over
+        :param _SharedCounters counters: counters with the "mux_*" names
+        :param int window: receive window of each stream, in bytes
+        """
+        assert connections >= 1, connections
+        self._connect = connect
+        self._size = connections
+        self._counters = counters
+        self._window = window
+
+        self._lock = threading.Lock()
+        # Notified when a slot is done connecting
+        self._connected = threading.Condition(self._lock)
+        self._pid = None
+        self._connections = None
+        # Indexes of the slots being connected
+        self._connecting = None
+
+
+    def open_stream(self):
+        """ Open a stream on one of the connections, connecting it first if
+        necessary
+
+        :returns: MuxStream
+
+        :raises socket.error: failed to connect to the peer
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                # NOTE: worker processes inherit the client, but not the
+                # connections' reader threads
+                self._pid = os.getpid()
+                self._connections = [None] * self._size
+                self._connecting = set()
+
+            while True:
+                # NOTE: prefers connecting another slot to waiting for one
+                # that is being connected
+                index = min(range(self._size), key=lambda i: (
+                    self._load(i), i in self._connecting))
+                if index not in self._connecting:
+                    break
+                self._connected.wait()
+
+            connection = self._connections[index]
+            if connection is None or connection.closed:
+                connection = None
+                self._connecting.add(index)
+
+        if connection is None:
+            # NOTE: connect without the lock, so that a slow or failing peer
+            # doesn't hold up the streams opened on the other connections;
+            # streams bound for this slot wait for it instead of connecting
+            # it a second time
+            try:
+                connection = MuxConnection(self._connect(), self._counters,
+                                           self._window)
+                self._counters.add("mux_connections")
+                reader = threading.Thread(target=connection.run)
+                reader.setDaemon(True)
+                reader.start()
+            finally:
+                with self._lock:
+                    if connection is not None:
+                        self._connections[index] = connection
+                    self._connecting.discard(index)
+                    self._connected.notify_all()
+
+        return connection.open_stream()
+
+
+    def _load(self, index):
+        """:returns: number of streams of the connection at the index; 0 if
+        it needs to be connected
+        """
+        connection = self._connections[index]
+        if connection is None or connection.closed:
+            return 0
+        return connection.stream_count
@@ -0,0 +1,171 @@
+"""Test for bench_server module"""
+
+# Supress pylint messages concerning missing class docstring
+# pylint: disable=C0111
+
+import multiprocessing
+import os
+import resource
+import socket
+import time
+import unittest
+
+from inetpy import bench_server
+from inetpy.bench_server import BenchServer
+from inetpy.forward_stats import _SharedCounters
+
+
+
+def _recv_exactly(sock, size):
+    """:returns: size bytes received from sock"""
+    chunks = []
+    while size:
+        data = sock.recv(size)
+        if not data:
+            break
+        chunks.append(data)
+        size -= len(data)
+    return b"".join(chunks)
+
+
+
+def _serve_with_few_fds(spare_fds, counters, queue):
+    """Run an echo loop with room for only a few more descriptors"""
+    highest_fd = max(int(fd) for fd in os.listdir("/proc/self/fd"))
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE,
+                       (highest_fd + 1 + spare_fds, hard))
+    bench_server.serve(BenchServer.MODE_ECHO, ("127.0.0.1", 0),
+                       counters=counters, listening_callback=queue.put)
+
+
+
+def _cpu_seconds(pid):
+    """:returns: CPU time used by the process so far, from /proc"""
+    with open("/proc/%d/stat" % (pid,)) as stat_file:
+        fields = stat_file.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(
+        os.sysconf("SC_CLK_TCK"))
+
+
+
+class BenchServerTestCase(unittest.TestCase):
+
+    def _connect(self, server):
+        sock = socket.create_connection(server.server_address)
+        sock.settimeout(5)
+        self.addCleanup(sock.close)
+        return sock
+
+
+    def _wait_for_stats(self, server, name, value):
+        """:returns: stats once the counter reaches the value"""
+        deadline = time.time() + 5
+        while True:
+            stats = server.stats
+            if stats[name] >= value or time.time() > deadline:
+                return stats
+            time.sleep(0.01)
+
+
+    def test_echo_serves_concurrent_connections(self):
+        with BenchServer(BenchServer.MODE_ECHO) as server:
+            socks = [self._connect(server) for _ in range(5)]
+
+            payload = b"x" * (1024 * 1024)
+            for index, sock in enumerate(socks):
+                sock.sendall(payload[:100 + index])
+            for index, sock in enumerate(socks):
+                self.assertEqual(_recv_exactly(sock, 100 + index),
+                                 payload[:100 + index])
+
+            # NOTE: larger than the socket buffers, so that the server has
+            # to hold on to unsent data until the client reads it
+            sock = socks[0]
+            sock.sendall(payload)
+            sock.shutdown(socket.SHUT_WR)
+            self.assertEqual(_recv_exactly(sock, len(payload) + 1), payload)
+
+            stats = self._wait_for_stats(server, "connections_accepted", 5)
+            self.assertEqual(stats["connections_accepted"], 5)
+
+
+    def test_discard_counts_received_bytes(self):
+        with BenchServer(BenchServer.MODE_DISCARD) as server:
+            sock = self._connect(server)
+            sock.sendall(b"d" * 100000)
+            sock.shutdown(socket.SHUT_WR)
+            self.assertEqual(sock.recv(1), b"")
+
+            stats = self._wait_for_stats(server, "bytes_received", 100000)
+            self.assertEqual(stats["bytes_received"], 100000)
+            self.assertEqual(stats["bytes_sent"], 0)
+
+
+    def test_chargen_sends_rfc864_pattern(self):
+        with BenchServer(BenchServer.MODE_CHARGEN) as server:
+            sock = self._connect(server)
+            data = _recv_exactly(sock, 3 * 74)
+
+        self.assertEqual(data[:74], bench_server._chargen_pattern()[:74])  # pylint: disable=W0212
+        lines = data.split(b"\r\n")
+        self.assertEqual(lines[0][1:], lines[1][:-1])
+        self.assertEqual(lines[1][1:], lines[2][:-1])
+
+
+    @unittest.skipUnless(os.path.isdir("/proc/self/fd"), "needs /proc")
+    def test_sheds_connections_when_out_of_descriptors(self):  # pylint: disable=C0103
+        counters = _SharedCounters(bench_server._COUNTER_NAMES)  # pylint: disable=W0212
+        queue = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=_serve_with_few_fds,
+                                       args=(8, counters, queue))
+        proc.daemon = True
+        proc.start()
+        self.addCleanup(proc.join)
+        self.addCleanup(proc.terminate)
+        address = queue.get(timeout=10)
+
+        socks = []
+        for _ in range(20):
+            sock = socket.create_connection(address)
+            sock.settimeout(5)
+            self.addCleanup(sock.close)
+            socks.append(sock)
+
+        # The loop idles instead of spinning on connections it can't accept
+        cpu_start = _cpu_seconds(proc.pid)
+        time.sleep(0.5)
+        self.assertLess(_cpu_seconds(proc.pid) - cpu_start, 0.25)
+
+        served = shed = 0
+        for sock in socks:
+            try:
+                sock.sendall(b"x")
+                data = sock.recv(1)
+            except socket.error:
+                data = b""
+            if data == b"x":
+                served += 1
+            else:
+                shed += 1
+
+        self.assertGreater(served, 0)
+        self.assertGreater(shed, 0)
+        self.assertEqual(served + shed, 20)
+        self.assertEqual(counters.snapshot()["connections_shed"], shed)
+
+
+    def test_stop_closes_listening_socket(self):
+        server = BenchServer(BenchServer.MODE_ECHO)
+        server.start()
+        address = server.server_address
+        server.stop()
+        self.assertFalse(server.running)
+
+        self.assertRaises(socket.error, socket.create_connection, address)
+
+
+
+
+if __name__ == '__main__':
+    unittest.main()
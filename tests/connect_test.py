@@ -0,0 +1,191 @@
+"""Test for connect.ConnectionPool"""
+
+# Supress pylint messages concerning missing class docstring
+# pylint: disable=C0111
+
+import socket
+import threading
+import time
+import unittest
+
+from inetpy import connect
+
+
+
+class _Listener(object):
+    """Accepts connections in a background thread and holds on to them"""
+
+    def __init__(self):
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(50)
+        self.port = self.sock.getsockname()[1]
+        self.accepted = []
+
+        thread = threading.Thread(target=self._accept_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _accept_forever(self):
+        while True:
+            try:
+                self.accepted.append(self.sock.accept()[0])
+            except socket.error:
+                return
+
+    def close(self):
+        for sock in self.accepted:
+            sock.close()
+        self.sock.close()
+
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = _Listener()
+        self.addCleanup(self.listener.close)
+
+
+    def _pool(self, **kwargs):
+        pool = connect.ConnectionPool(**kwargs)
+        self.addCleanup(pool.close)
+        return pool
+
+
+    def test_released_connection_is_reused(self):
+        pool = self._pool()
+
+        sock1 = pool.acquire("127.0.0.1", self.listener.port)
+        pool.release(sock1)
+        sock2 = pool.acquire("127.0.0.1", self.listener.port)
+        self.assertIs(sock2, sock1)
+        pool.release(sock2)
+
+        stats = pool.stats()
+        self.assertEqual(stats["acquires"], 2)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["releases"], 2)
+        self.assertEqual(stats["open"], 1)
+        self.assertEqual(stats["idle"], 1)
+
+
+    def test_discarded_connection_is_closed(self):
+        pool = self._pool()
+
+        with self.assertRaises(ValueError):
+            with pool.connection("127.0.0.1", self.listener.port):
+                raise ValueError("simulated protocol failure")
+
+        self.assertEqual(pool.stats()["open"], 0)
+
+
+    def test_exhausted_pool_fails_fast(self):
+        pool = self._pool(max_per_key=2)
+
+        socks = [pool.acquire("127.0.0.1", self.listener.port, timeout=0)
+                 for _ in range(2)]
+
+        with self.assertRaises(connect.PoolExhaustedError):
+            pool.acquire("127.0.0.1", self.listener.port, timeout=0)
+
+        with self.assertRaises(connect.PoolExhaustedError):
+            pool.acquire("127.0.0.1", self.listener.port, timeout=0.05)
+
+        self.assertEqual(pool.stats()["exhausted"], 2)
+        self.assertEqual(pool.stats()["waits"], 1)
+
+        for sock in socks:
+            pool.release(sock)
+
+
+    def test_exhausted_pool_blocks_until_release(self):
+        pool = self._pool(max_per_key=1)
+
+        sock = pool.acquire("127.0.0.1", self.listener.port)
+        timer = threading.Timer(0.1, pool.release, args=(sock,))
+        timer.start()
+        self.addCleanup(timer.join)
+
+        self.assertIs(pool.acquire("127.0.0.1", self.listener.port, timeout=10),
+                      sock)
+        stats = pool.stats()
+        self.assertEqual(stats["waits"], 1)
+        self.assertGreater(stats["wait_time"], 0.05)
+
+
+    def test_global_limit_evicts_idle_connection_of_other_key(self):  # pylint: disable=C0103
+        other_listener = _Listener()
+        self.addCleanup(other_listener.close)
+
+        pool = self._pool(max_per_key=1, max_total=1)
+
+        sock1 = pool.acquire("127.0.0.1", self.listener.port)
+
+        with self.assertRaises(connect.PoolExhaustedError):
+            pool.acquire("127.0.0.1", other_listener.port, timeout=0)
+
+        pool.release(sock1)
+        sock2 = pool.acquire("127.0.0.1", other_listener.port, timeout=0)
+        self.assertIsNot(sock2, sock1)
+        self.assertEqual(pool.stats()["evicted_room"], 1)
+        self.assertEqual(pool.stats()["open"], 1)
+        pool.release(sock2)
+
+
+    def test_idle_ttl_eviction(self):
+        pool = self._pool(idle_ttl=0.05)
+
+        sock1 = pool.acquire("127.0.0.1", self.listener.port)
+        pool.release(sock1)
+        time.sleep(0.1)
+
+        sock2 = pool.acquire("127.0.0.1", self.listener.port)
+        self.assertIsNot(sock2, sock1)
+        pool.release(sock2)
+        self.assertEqual(pool.stats()["evicted_idle"], 1)
+
+        time.sleep(0.1)
+        self.assertEqual(pool.evict_idle(), 1)
+        self.assertEqual(pool.stats()["open"], 0)
+
+
+    def test_connection_closed_by_peer_is_not_reused(self):  # pylint: disable=C0103
+        pool = self._pool()
+
+        sock1 = pool.acquire("127.0.0.1", self.listener.port)
+        pool.release(sock1)
+
+        # Close the server side of the connection
+        for _ in range(100):
+            if self.listener.accepted:
+                break
+            time.sleep(0.01)
+        self.listener.accepted[0].close()
+        time.sleep(0.05)
+
+        sock2 = pool.acquire("127.0.0.1", self.listener.port)
+        self.assertIsNot(sock2, sock1)
+        pool.release(sock2)
+        self.assertEqual(pool.stats()["evicted_dead"], 1)
+
+
+    def test_connect_error_frees_slot(self):
+        def fail_connect(host, port):
+            raise socket.error("simulated connect failure to %s:%s"
+                               % (host, port))
+
+        pool = self._pool(max_per_key=1, connect=fail_connect)
+
+        for _ in range(2):
+            with self.assertRaises(socket.error):
+                pool.acquire("127.0.0.1", self.listener.port, timeout=0)
+
+        self.assertEqual(pool.stats()["connect_errors"], 2)
+        self.assertEqual(pool.stats()["open"], 0)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
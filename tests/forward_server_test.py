@@ -1,6 +1,6 @@
 """Test for forward_server.ForwardServer class
 
-TODO multi-connection tests
+NOTE: see benchmarks/scale_bench.py for tests with thousands of connections
 """
 
 # Supress pylint messages concerning missing class docstring
@@ -8,10 +8,32 @@ TODO multi-connection tests
 
 import errno
 import multiprocessing
+import os
+import shutil
+import signal
 import socket
+import ssl
+import subprocess
+import tempfile
+import time
 import unittest
 
 from inetpy import forward_server
+from inetpy import forward_stats
+
+
+
+def _settled_shard_stats(server):
+    """:returns: the server's shard_stats once its shards have published
+    the end of all of their sessions
+    """
+    deadline = time.time() + 10
+    while True:
+        shard_stats = server.shard_stats
+        if (all(stats["active_sessions"] == 0 for stats in shard_stats) or
+                time.time() > deadline):
+            return shard_stats
+        time.sleep(0.01)
 
 
 
@@ -43,6 +65,34 @@ class ForwardServerTestCase(unittest.TestCase):
         self.assertFalse(fwd.running)
 
 
+    def test_forwarding_engines_carry_bytes(self):
+        """Each forwarding engine carries binary data intact and half-closes;
+        written with bytes only, so that it runs on python 2 and 3 alike
+        """
+        data = bytes(bytearray(range(256))) * 1000
+        with forward_server.ForwardServer(remote_addr=None) as echo:
+            for engine_kwargs in (dict(),
+                                  dict(worker_processes=1),
+                                  dict(event_loop_shards=1)):
+                with forward_server.ForwardServer(
+                        remote_addr=echo.server_address,
+                        **engine_kwargs) as fwd:
+                    sock = socket.socket()
+                    self.addCleanup(sock.close)
+                    sock.connect(fwd.server_address)
+                    sock.settimeout(10)
+                    sock.sendall(data)
+                    sock.shutdown(socket.SHUT_WR)
+
+                    chunks = []
+                    while True:
+                        chunk = sock.recv(65536)
+                        if not chunk:
+                            break
+                        chunks.append(chunk)
+                    self.assertEqual(b"".join(chunks), data, engine_kwargs)
+
+
     def test_basic_forwarding(self):
         """Basic forwarding test"""
 
@@ -247,5 +297,689 @@ class ForwardServerTestCase(unittest.TestCase):
             self.assertFalse(producer_process.is_alive())
             self.assertEqual(producer_process.exitcode, 0)
 
+
+    def test_multiple_concurrent_echo_sessions(self):
+        """Concurrent sessions are served independently"""
+        with forward_server.ForwardServer(remote_addr=None) as fwd:
+            socks = []
+            for i in range(20):
+                sock = socket.socket()
+                self.addCleanup(sock.close)
+                sock.connect(fwd.server_address)
+                sock.settimeout(10)
+                socks.append((sock, "msg%d" % (i,)))
+
+            for sock, msg in reversed(socks):
+                sock.sendall(msg)
+                self.assertEqual(sock.recv(10), msg)
+
+            for sock, _msg in socks:
+                sock.shutdown(socket.SHUT_WR)
+                self.assertEqual(sock.recv(10), "")
+
+        self.assertEqual(fwd.stats["sessions_accepted"], 20)
+
+
+    def test_fd_budget_refuses_connections_near_limit(self):  # pylint: disable=C0103
+        """Connections beyond the file descriptor budget are refused without
+        disrupting the server
+        """
+        with forward_server.ForwardServer(remote_addr=None,
+                                          max_open_files=64) as fwd:
+            admitted = []
+            refused = 0
+            for _ in range(80):
+                sock = socket.socket()
+                self.addCleanup(sock.close)
+                sock.connect(fwd.server_address)
+                sock.settimeout(10)
+                try:
+                    sock.sendall("x")
+                    data = sock.recv(10)
+                except socket.error:
+                    data = ""
+
+                if data == "x":
+                    admitted.append(sock)
+                else:
+                    refused += 1
+                    sock.close()
+
+            self.assertGreater(len(admitted), 0)
+            self.assertGreater(refused, 0)
+            self.assertEqual(fwd.stats["refused_fd_budget"], refused)
+
+            # Closing sessions makes room for new ones
+            for sock in admitted:
+                sock.close()
+
+            sock = socket.socket()
+            self.addCleanup(sock.close)
+            sock.settimeout(10)
+            for _ in range(100):
+                if fwd.stats["active_sessions"] == 0:
+                    break
+                time.sleep(0.05)
+            sock.connect(fwd.server_address)
+            sock.sendall("y")
+            self.assertEqual(sock.recv(10), "y")
+
+
+    def test_fd_budget_with_worker_processes(self):  # pylint: disable=C0103
+        """Connections beyond a worker's file descriptor budget are refused
+        by the acceptor, and the sessions already in the worker survive
+        """
+        with forward_server.ForwardServer(remote_addr=None,
+                                          worker_processes=1,
+                                          max_open_files=64) as fwd:
+            admitted = []
+            refused = 0
+            for i in range(100):
+                sock = socket.socket()
+                self.addCleanup(sock.close)
+                sock.connect(fwd.server_address)
+                sock.settimeout(10)
+                try:
+                    sock.sendall("%d" % (i,))
+                    data = sock.recv(10)
+                except socket.error:
+                    data = ""
+
+                if data == "%d" % (i,):
+                    admitted.append(sock)
+                else:
+                    refused += 1
+                    sock.close()
+
+            self.assertGreater(len(admitted), 0)
+            self.assertGreater(refused, 0)
+
+            # The admitted sessions are all still served
+            for i, sock in enumerate(admitted):
+                sock.sendall("again %d" % (i,))
+                self.assertEqual(sock.recv(20), "again %d" % (i,))
+
+            stats = fwd.stats
+            self.assertEqual(stats["worker_respawns"], 0)
+            self.assertEqual(stats["refused_fd_budget"] +
+                             stats["refused_fd_exhausted"], refused)
+            self.assertEqual(stats["active_sessions"], len(admitted))
+
+
+    def test_forwarding_with_small_thread_stacks(self):
+        """Sessions run fine on threads with a small stack size"""
+        with forward_server.ForwardServer(remote_addr=None) as echo:
+            with forward_server.ForwardServer(
+                    remote_addr=echo.server_address,
+                    thread_stack_size=128 * 1024) as fwd:
+                socks = []
+                for _ in range(10):
+                    sock = socket.socket()
+                    self.addCleanup(sock.close)
+                    sock.connect(fwd.server_address)
+                    sock.settimeout(10)
+                    socks.append(sock)
+
+                for i, sock in enumerate(socks):
+                    sock.sendall("session %d" % (i,))
+                    sock.shutdown(socket.SHUT_WR)
+                    self.assertEqual(sock.makefile().read(),
+                                     "session %d" % (i,))
+
+
+    def test_idle_timeout_reclaims_idle_session(self):
+        """An idle session is reclaimed while a busy one is not"""
+        with forward_server.ForwardServer(remote_addr=None) as echo:
+            with forward_server.ForwardServer(
+                    remote_addr=echo.server_address,
+                    idle_timeout=0.3) as fwd:
+                idle_sock = socket.socket()
+                self.addCleanup(idle_sock.close)
+                idle_sock.connect(fwd.server_address)
+                idle_sock.settimeout(10)
+
+                busy_sock = socket.socket()
+                self.addCleanup(busy_sock.close)
+                busy_sock.connect(fwd.server_address)
+                busy_sock.settimeout(10)
+
+                start = time.time()
+                idle_sock.sendall("12345")
+                self.assertEqual(idle_sock.recv(5), "12345")
+
+                # Keep the busy session active past the idle timeout
+                for _ in range(10):
+                    busy_sock.sendall("abc")
+                    self.assertEqual(busy_sock.recv(3), "abc")
+                    time.sleep(0.1)
+
+                # The idle session was shut down
+                self.assertEqual(idle_sock.recv(1), "")
+                self.assertGreaterEqual(time.time() - start, 0.3)
+
+                busy_sock.shutdown(socket.SHUT_WR)
+                self.assertEqual(busy_sock.recv(1), "")
+
+                self.assertEqual(fwd.stats["timeouts_idle"], 1)
+                self.assertEqual(fwd.stats["timeouts_lifetime"], 0)
+
+
+    def test_session_lifetime_reclaims_busy_session(self):
+        """A session is reclaimed at the end of its lifetime despite
+        activity
+        """
+        with forward_server.ForwardServer(remote_addr=None,
+                                          session_lifetime=0.3) as fwd:
+            sock = socket.socket()
+            self.addCleanup(sock.close)
+            sock.connect(fwd.server_address)
+            sock.settimeout(10)
+
+            start = time.time()
+            received = "x"
+            while received and time.time() - start < 5:
+                try:
+                    sock.sendall("abc")
+                    received = sock.recv(3)
+                except socket.error as exc:
+                    self.assertIn(exc.errno, (errno.EPIPE, errno.ECONNRESET))
+                    break
+                time.sleep(0.05)
+
+            self.assertGreaterEqual(time.time() - start, 0.3)
+            self.assertLess(time.time() - start, 5)
+            self.assertEqual(fwd.stats["timeouts_lifetime"], 1)
+            self.assertEqual(fwd.stats["timeouts_idle"], 0)
+
+            # The forwarder remains usable
+            sock = socket.socket()
+            self.addCleanup(sock.close)
+            sock.connect(fwd.server_address)
+            sock.settimeout(10)
+            sock.sendall("12345")
+            sock.shutdown(socket.SHUT_WR)
+            self.assertEqual(sock.makefile().read(), "12345")
+
+
+    def test_connect_timeout_closes_local_connection(self):
+        """The local connection is closed when connecting to the remote times
+        out
+        """
+        # A listener whose accept queue is full drops further connection
+        # attempts, so that connecting to it hangs
+        remote_listener_sock = socket.socket()
+        self.addCleanup(remote_listener_sock.close)
+        remote_listener_sock.bind(("localhost", 0))
+        remote_listener_sock.listen(0)
+        for _ in range(3):
+            filler = socket.socket()
+            self.addCleanup(filler.close)
+            filler.setblocking(False)
+            try:
+                filler.connect(remote_listener_sock.getsockname())
+            except socket.error as exc:
+                self.assertEqual(exc.errno, errno.EINPROGRESS)
+
+        with forward_server.ForwardServer(
+                remote_addr=remote_listener_sock.getsockname(),
+                connect_timeout=0.2) as fwd:
+            sock = socket.socket()
+            self.addCleanup(sock.close)
+            sock.connect(fwd.server_address)
+            sock.settimeout(10)
+
+            start = time.time()
+            self.assertEqual(sock.recv(1), "")
+            self.assertLess(time.time() - start, 5)
+            self.assertEqual(fwd.stats["timeouts_connect"], 1)
+
+
+    def test_echo_with_worker_processes(self):
+        """Sessions handed off to worker processes are echoed, and a dead
+        worker is replaced
+        """
+        with forward_server.ForwardServer(remote_addr=None,
+                                          worker_processes=2) as fwd:
+            def echo_round_trip(msg):
+                sock = socket.socket()
+                self.addCleanup(sock.close)
+                sock.connect(fwd.server_address)
+                sock.settimeout(10)
+                sock.sendall(msg)
+                self.assertEqual(sock.recv(10), msg)
+                return sock
+
+            socks = [echo_round_trip("msg%d" % (i,)) for i in range(6)]
+
+            children_path = "/proc/%d/task/%d/children" % (fwd.pid, fwd.pid)
+            if os.path.exists(children_path):
+                with open(children_path) as children_file:
+                    worker_pids = [int(pid) for pid in
+                                   children_file.read().split()]
+                self.assertEqual(len(worker_pids), 2)
+
+                os.kill(worker_pids[0], signal.SIGKILL)
+                time.sleep(0.1)
+
+                for i in range(4):
+                    echo_round_trip("new%d" % (i,))
+
+                self.assertEqual(fwd.stats["worker_respawns"], 1)
+
+            for sock in socks:
+                sock.close()
+
+        self.assertEqual(fwd.stats["handoff_failures"], 0)
+
+
+    def test_compressed_tunnel(self):
+        """Data forwarded through a compress/decompress ForwardServer pair
+        arrives intact, compressed on the wire between them
+        """
+        with forward_server.ForwardServer(
+                remote_addr=None,
+                tunnel=forward_server.ForwardServer.TUNNEL_DECOMPRESS) as peer:
+            with forward_server.ForwardServer(
+                    remote_addr=peer.server_address,
+                    tunnel=forward_server.ForwardServer.TUNNEL_COMPRESS) as fwd:
+                sock = socket.socket()
+                self.addCleanup(sock.close)
+                sock.connect(fwd.server_address)
+                sock.settimeout(10)
+
+                tx_data = "".join("line %d of compressible text\n" % (i,)
+                                  for i in range(100000))
+
+                def produce_and_shut(sock, data):
+                    sock.sendall(data)
+                    sock.shutdown(socket.SHUT_WR)
+
+                producer_process = multiprocessing.Process(
+                    target=produce_and_shut,
+                    args=(sock, tx_data,))
+                producer_process.daemon = True
+                producer_process.start()
+                self.addCleanup(
+                    lambda: ((producer_process.terminate() or
+                              producer_process.join())
+                             if producer_process.exitcode is None else None))
+
+                rx_data = sock.makefile().read()
+                self.assertEqual(len(rx_data), len(tx_data))
+                self.assertEqual(rx_data, tx_data)
+
+                producer_process.join(timeout=10)
+                self.assertEqual(producer_process.exitcode, 0)
+
+        for server in (fwd, peer):
+            stats = server.stats
+            self.assertEqual(stats["tunnel_plain_bytes"], len(tx_data))
+            self.assertLess(stats["tunnel_compression_ratio"], 0.2)
+            self.assertGreater(stats["tunnel_codec_usec"], 0)
+
+
+    def test_multiplexed_tunnel(self):
+        """Sessions through a mux/demux ForwardServer pair share its few
+        connections, half-close as usual, and a session that doesn't read
+        doesn't hold up the others
+        """
+        with forward_server.ForwardServer(remote_addr=None) as echo:
+            with forward_server.ForwardServer(
+                    remote_addr=echo.server_address,
+                    tunnel=forward_server.ForwardServer.TUNNEL_DEMUX) as peer:
+                with forward_server.ForwardServer(
+                        remote_addr=peer.server_address,
+                        tunnel=forward_server.ForwardServer.TUNNEL_MUX,
+                        mux_connections=2) as fwd:
+                    # Sends more than fits in the windows and socket buffers,
+                    # but never reads its echo
+                    stalled = socket.socket()
+                    self.addCleanup(stalled.close)
+                    stalled.connect(fwd.server_address)
+                    stalled.setblocking(False)
+                    sent = 0
+                    try:
+                        while sent < 16 * 1024 * 1024:
+                            sent += stalled.send("x" * 65536)
+                    except socket.error as exc:
+                        self.assertEqual(exc.errno, errno.EAGAIN)
+
+                    socks = []
+                    for i in range(20):
+                        sock = socket.socket()
+                        self.addCleanup(sock.close)
+                        sock.connect(fwd.server_address)
+                        sock.settimeout(10)
+                        sock.sendall("session %d\n" % (i,) * 1000)
+                        sock.shutdown(socket.SHUT_WR)
+                        socks.append(sock)
+
+                    for i, sock in enumerate(socks):
+                        self.assertEqual(sock.makefile().read(),
+                                         "session %d\n" % (i,) * 1000)
+                        sock.close()
+
+                    stats = fwd.stats
+
+        self.assertEqual(stats["mux_connections"], 2)
+        self.assertEqual(stats["mux_streams"], 21)
+        self.assertGreater(stats["mux_window_waits"], 0)
+        self.assertEqual(peer.stats["sessions_accepted"], 2)
+        self.assertEqual(peer.stats["mux_streams"], 21)
+        self.assertEqual(echo.stats["sessions_accepted"], 21)
+
+
+    def test_event_loop_shards(self):
+        """Sessions forwarded by event-loop shards half-close as usual and
+        are spread evenly over the shards
+        """
+        with forward_server.ForwardServer(remote_addr=None,
+                                          event_loop_shards=2) as echo:
+            with forward_server.ForwardServer(
+                    remote_addr=echo.server_address,
+                    event_loop_shards=3) as fwd:
+                socks = []
+                for i in range(30):
+                    sock = socket.socket()
+                    self.addCleanup(sock.close)
+                    sock.connect(fwd.server_address)
+                    sock.settimeout(10)
+                    socks.append(sock)
+
+                # Let the forwarder accept them all before any session ends
+                deadline = time.time() + 10
+                while fwd.stats["sessions_accepted"] < len(socks):
+                    if time.time() > deadline:
+                        self.fail("Forwarder didn't accept all %d sessions: "
+                                  "%r" % (len(socks), fwd.stats))
+                    time.sleep(0.01)
+
+                for i, sock in enumerate(socks):
+                    sock.sendall("session %d\n" % (i,) * 1000)
+                    sock.shutdown(socket.SHUT_WR)
+
+                for i, sock in enumerate(socks):
+                    self.assertEqual(sock.makefile().read(),
+                                     "session %d\n" % (i,) * 1000)
+                    sock.close()
+
+                shard_stats = _settled_shard_stats(fwd)
+                echo_shard_stats = _settled_shard_stats(echo)
+
+        self.assertEqual([stats["sessions"] for stats in shard_stats],
+                         [10, 10, 10])
+        self.assertEqual(sum(stats["bytes_forwarded"]
+                             for stats in shard_stats),
+                         2 * sum(len("session %d\n" % (i,) * 1000)
+                                 for i in range(30)))
+        # NOTE: the echo server's split depends on how connects interleave
+        # with sessions ending, so only its total is deterministic
+        self.assertEqual(sum(stats["sessions"] for stats in echo_shard_stats),
+                         30)
+        self.assertEqual(fwd.stats["sessions_accepted"], 30)
+        self.assertEqual(forward_server.ForwardServer(None).shard_stats, [])
+
+
+    def test_event_loop_shard_closes_session_if_connect_fails(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        # Nothing listens on the address once the socket is closed
+        refusing_address = listener.getsockname()
+        listener.close()
+
+        with forward_server.ForwardServer(remote_addr=refusing_address,
+                                          event_loop_shards=1) as fwd:
+            sock = socket.socket()
+            self.addCleanup(sock.close)
+            sock.connect(fwd.server_address)
+            sock.settimeout(10)
+            self.assertEqual(sock.recv(10), "")
+
+            shard_stats = _settled_shard_stats(fwd)
+
+        self.assertEqual(shard_stats[0]["connect_failures"], 1)
+        self.assertEqual(shard_stats[0]["active_sessions"], 0)
+
+
+    def test_forward_with_write_coalescing(self):
+        """Small messages are delivered intact and in order through a
+        coalescing forwarder, and a lone message isn't held past the hold time
+        """
+        with forward_server.ForwardServer(remote_addr=None) as echo:
+            with forward_server.ForwardServer(
+                    remote_addr=echo.server_address,
+                    coalesce_hold_time=0.0002) as fwd:
+                sock = socket.socket()
+                self.addCleanup(sock.close)
+                sock.connect(fwd.server_address)
+                sock.settimeout(10)
+
+                # A lone message is flushed once the hold time expires
+                sock.sendall("ping")
+                self.assertEqual(sock.recv(10), "ping")
+
+                tx_data = ["message %d\n" % (i,) for i in range(2000)]
+
+                def produce_and_shut(sock, messages):
+                    for message in messages:
+                        sock.send(message)
+                    sock.shutdown(socket.SHUT_WR)
+
+                producer_process = multiprocessing.Process(
+                    target=produce_and_shut,
+                    args=(sock, tx_data,))
+                producer_process.daemon = True
+                producer_process.start()
+                self.addCleanup(
+                    lambda: ((producer_process.terminate() or
+                              producer_process.join())
+                             if producer_process.exitcode is None else None))
+
+                rx_data = sock.makefile().read()
+                self.assertEqual(rx_data, "".join(tx_data))
+
+                producer_process.join(timeout=10)
+                self.assertEqual(producer_process.exitcode, 0)
+
+        stats = fwd.stats
+        self.assertGreater(stats["coalesce_flushes"], 0)
+        self.assertGreaterEqual(stats["coalesce_chunks"],
+                                stats["coalesce_flushes"])
+        self.assertGreaterEqual(stats["coalesce_chunks_per_flush"], 1.0)
+        self.assertEqual(echo.stats["coalesce_flushes"], 0)
+
+
+    def test_write_coalescing_flushes_full_batch_before_hold_time(self):
+        """Held chunks are sent as soon as they reach coalesce_bytes rather
+        than when the hold time is up
+        """
+        hold_time = 30
+        with forward_server.ForwardServer(remote_addr=None) as echo:
+            with forward_server.ForwardServer(
+                    remote_addr=echo.server_address,
+                    coalesce_hold_time=hold_time,
+                    coalesce_bytes=1000) as fwd:
+                sock = socket.socket()
+                self.addCleanup(sock.close)
+                sock.connect(fwd.server_address)
+                sock.settimeout(hold_time / 2)
+
+                start = time.time()
+                for _ in range(10):
+                    sock.sendall(b"m" * 100)
+                    time.sleep(0.01)
+
+                rx_data = b""
+                while len(rx_data) < 1000:
+                    data = sock.recv(1000)
+                    self.assertTrue(data)
+                    rx_data += data
+                elapsed = time.time() - start
+
+        self.assertEqual(rx_data, b"m" * 1000)
+        self.assertLess(elapsed, hold_time / 2)
+        # One flush per direction
+        self.assertEqual(fwd.stats["coalesce_flushes"], 2)
+
+
+    def test_echo_with_histogram_observer(self):
+        """Observer hooks are called for the session and its chunks"""
+        observer = forward_stats.HistogramObserver()
+
+        with forward_server.ForwardServer(remote_addr=None,
+                                          observer=observer) as fwd:
+            sock = socket.socket()
+            self.addCleanup(sock.close)
+            sock.connect(fwd.server_address)
+            sock.settimeout(10)
+
+            sock.sendall("abcd")
+            self.assertEqual(sock.recv(10), "abcd")
+
+            sock.shutdown(socket.SHUT_WR)
+            self.assertEqual(sock.recv(10), "")
+
+        stats = observer.snapshot()
+        self.assertEqual(stats["sessions_opened"], 1)
+        self.assertEqual(stats["upstream_connects"], 0)
+        self.assertEqual(stats["bytes_upstream"], 4)
+        self.assertEqual(stats["bytes_downstream"], 4)
+        self.assertEqual(
+            stats["chunk_size"][observer.DIRECTION_UPSTREAM]["count"], 1)
+
+
+
+class ForwardServerTLSTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """Generate a self-signed certificate for the test server"""
+        cls.cert_dir = tempfile.mkdtemp()
+        cls.cert_file = os.path.join(cls.cert_dir, "cert.pem")
+        cls.key_file = os.path.join(cls.cert_dir, "key.pem")
+
+        try:
+            subprocess.check_call(
+                ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+                 "-days", "1", "-subj", "/CN=localhost",
+                 "-keyout", cls.key_file, "-out", cls.cert_file],
+                stdout=open(os.devnull, "w"),
+                stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError):
+            shutil.rmtree(cls.cert_dir)
+            raise unittest.SkipTest("openssl is required to generate "
+                                    "test certificates")
+
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.cert_dir)
+
+
+    def _server_context(self):
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.load_cert_chain(self.cert_file, self.key_file)
+        return context
+
+
+    def _client_context(self):
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.check_hostname = True
+        context.load_verify_locations(self.cert_file)
+        if hasattr(ssl, "OP_NO_TLSv1_3"):
+            # Make resumable sessions available right after the handshake
+            context.options |= ssl.OP_NO_TLSv1_3
+        return context
+
+
+    def _echo_round_trip(self, server_address, wrap_context=None):
+        sock = socket.socket()
+        self.addCleanup(sock.close)
+        sock.connect(server_address)
+        sock.settimeout(10)
+        if wrap_context is not None:
+            sock = wrap_context.wrap_socket(sock, server_hostname="localhost")
+            self.addCleanup(sock.close)
+
+        # NOTE: we expect the small message to fit into a single record
+        sock.sendall(b"abcd")
+        self.assertEqual(sock.recv(10), b"abcd")
+        sock.close()
+
+
+    def test_tls_terminating_echo(self):
+        """Echo over a TLS connection terminated by the forwarder"""
+        with forward_server.ForwardServer(
+                remote_addr=None,
+                server_ssl_context=self._server_context()) as fwd:
+            self._echo_round_trip(fwd.server_address,
+                                  wrap_context=self._client_context())
+
+        self.assertEqual(fwd.stats["tls_server_handshakes"], 1)
+        self.assertEqual(fwd.stats["tls_server_handshake_failures"], 0)
+
+
+    def test_tls_terminating_rejects_plain_tcp(self):
+        """A plain TCP client fails the TLS handshake and is counted"""
+        with forward_server.ForwardServer(
+                remote_addr=None,
+                server_ssl_context=self._server_context()) as fwd:
+            sock = socket.socket()
+            self.addCleanup(sock.close)
+            sock.connect(fwd.server_address)
+            sock.settimeout(10)
+            sock.sendall(b"GET / HTTP/1.0\r\n\r\n")
+            try:
+                self.assertEqual(sock.recv(100), b"")
+            except socket.error:
+                pass
+
+        self.assertEqual(fwd.stats["tls_server_handshakes"], 0)
+        self.assertEqual(fwd.stats["tls_server_handshake_failures"], 1)
+
+
+    def test_tls_originating_forwarding(self):
+        """Plain TCP client forwarded over upstream TLS to a TLS echo server"""
+        with forward_server.ForwardServer(
+                remote_addr=None,
+                server_ssl_context=self._server_context()) as tls_echo:
+            with forward_server.ForwardServer(
+                    remote_addr=tls_echo.server_address,
+                    remote_ssl_context=self._client_context(),
+                    remote_server_hostname="localhost") as fwd:
+                for _ in range(3):
+                    self._echo_round_trip(fwd.server_address)
+
+        stats = fwd.stats
+        self.assertEqual(stats["tls_client_handshakes"], 3)
+        self.assertEqual(tls_echo.stats["tls_server_handshakes"], 3)
+        if not forward_server._TLSSessionCache.SUPPORTED:  # pylint: disable=W0212
+            self.assertEqual(stats["tls_client_resumed"], 0)
+            self.assertEqual(stats["tls_client_resumed_ratio"], 0.0)
+
+
+    @unittest.skipUnless(
+        forward_server._TLSSessionCache.SUPPORTED,  # pylint: disable=W0212
+        "TLS session resumption requires ssl.SSLSocket.session (python 3.6+)")
+    def test_tls_originating_resumes_sessions(self):
+        """Upstream TLS connections after the first resume its session"""
+        with forward_server.ForwardServer(
+                remote_addr=None,
+                server_ssl_context=self._server_context()) as tls_echo:
+            with forward_server.ForwardServer(
+                    remote_addr=tls_echo.server_address,
+                    remote_ssl_context=self._client_context(),
+                    remote_server_hostname="localhost") as fwd:
+                for _ in range(3):
+                    self._echo_round_trip(fwd.server_address)
+
+        stats = fwd.stats
+        self.assertEqual(stats["tls_client_handshakes"], 3)
+        self.assertEqual(stats["tls_client_resumed"], 2)
+        self.assertAlmostEqual(stats["tls_client_resumed_ratio"], 2 / 3.0)
+
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,68 @@
+"""Test for forward_stats module"""
+
+# Supress pylint messages concerning missing class docstring
+# pylint: disable=C0111
+
+import multiprocessing
+import unittest
+
+from inetpy import forward_stats
+
+
+
+class HistogramObserverTestCase(unittest.TestCase):
+
+    def test_snapshot_reflects_hooks(self):
+        """Hook calls are reflected in the snapshot"""
+        observer = forward_stats.HistogramObserver(stall_threshold=0.5)
+        upstream = observer.DIRECTION_UPSTREAM
+
+        observer.session_opened(1, ("127.0.0.1", 1234))
+        observer.chunk_received(1, upstream, 100, 0.000010)
+        observer.chunk_sent(1, upstream, 100, 0.000020)
+        observer.chunk_sent(1, upstream, 50, 1.0)
+        observer.session_closed(1, 2.0)
+
+        stats = observer.snapshot()
+        self.assertEqual(stats["sessions_opened"], 1)
+        self.assertEqual(stats["sessions_closed"], 1)
+        self.assertEqual(stats["bytes_upstream"], 150)
+        self.assertEqual(stats["bytes_downstream"], 0)
+        self.assertEqual(stats["stalls_upstream"], 1)
+        self.assertEqual(stats["chunk_size"][upstream]["count"], 1)
+        self.assertEqual(stats["chunk_size"][upstream]["buckets"], [(127, 1)])
+        self.assertEqual(stats["send_wait_usec"][upstream]["count"], 2)
+        self.assertEqual(stats["session_usec"]["count"], 1)
+
+
+    def test_snapshot_visible_across_processes(self):
+        """Data collected in a subprocess is visible to the parent"""
+        observer = forward_stats.HistogramObserver()
+
+        def record(obs):
+            for _ in range(10):
+                obs.chunk_received(1, obs.DIRECTION_DOWNSTREAM, 4096, 0.001)
+
+        proc = multiprocessing.Process(target=record, args=(observer,))
+        proc.start()
+        proc.join(timeout=10)
+        self.assertEqual(proc.exitcode, 0)
+
+        hist = observer.snapshot()["chunk_size"][
+            observer.DIRECTION_DOWNSTREAM]
+        self.assertEqual(hist["count"], 10)
+        self.assertEqual(hist["sum"], 40960)
+
+
+    def test_histogram_percentile(self):
+        hist = dict(count=100, sum=0, buckets=[(1, 90), (7, 9), (1023, 1)])
+        self.assertEqual(forward_stats.histogram_percentile(hist, 50), 1)
+        self.assertEqual(forward_stats.histogram_percentile(hist, 99), 7)
+        self.assertEqual(forward_stats.histogram_percentile(hist, 100), 1023)
+        self.assertIsNone(forward_stats.histogram_percentile(
+            dict(count=0, sum=0, buckets=[]), 50))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+"""Test for poller module"""
+
+# Supress pylint messages concerning missing class docstring
+# pylint: disable=C0111
+
+import select
+import unittest
+
+from inetpy import poller
+from inetpy.socket_pair import socket_pair
+
+
+
+class _PollerTests(object):
+    """Tests shared by the poller implementations"""
+
+    POLLER_CLASS = None
+
+    def setUp(self):
+        self.poller = self.POLLER_CLASS()  # pylint: disable=E1102
+        self.addCleanup(self.poller.close)
+
+        self.sock1, self.sock2 = socket_pair()
+        self.addCleanup(self.sock1.close)
+        self.addCleanup(self.sock2.close)
+
+
+    def test_times_out_without_events(self):
+        self.poller.register(self.sock1.fileno(), poller.EVENT_READ)
+        self.assertEqual(self.poller.poll(0.01), [])
+
+
+    def test_reports_readable(self):
+        fd = self.sock1.fileno()
+        self.poller.register(fd, poller.EVENT_READ)
+        self.sock2.sendall(b"abcd")
+
+        events = self.poller.poll(1)
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0][0], fd)
+        self.assertTrue(events[0][1] & poller.EVENT_READ)
+
+
+    def test_modify_and_unregister(self):
+        fd = self.sock1.fileno()
+        self.poller.register(fd, poller.EVENT_READ)
+        self.assertEqual(self.poller.poll(0), [])
+
+        self.poller.modify(fd, poller.EVENT_READ | poller.EVENT_WRITE)
+        events = dict(self.poller.poll(1))
+        self.assertTrue(events[fd] & poller.EVENT_WRITE)
+        self.assertFalse(events[fd] & poller.EVENT_READ)
+
+        self.poller.unregister(fd)
+        self.assertEqual(self.poller.poll(0), [])
+
+
+    def test_reports_hang_up_as_readable(self):
+        fd = self.sock1.fileno()
+        self.poller.register(fd, poller.EVENT_READ)
+        self.sock2.close()
+
+        events = dict(self.poller.poll(1))
+        self.assertTrue(events[fd] & (poller.EVENT_READ | poller.EVENT_ERROR))
+
+
+
+@unittest.skipUnless(hasattr(select, "epoll"), "epoll not available")
+class EpollPollerTestCase(_PollerTests, unittest.TestCase):
+    POLLER_CLASS = poller.EpollPoller
+
+
+
+@unittest.skipUnless(hasattr(select, "poll"), "poll not available")
+class PollPollerTestCase(_PollerTests, unittest.TestCase):
+    POLLER_CLASS = poller.PollPoller
+
+
+
+class SelectPollerTestCase(_PollerTests, unittest.TestCase):
+    POLLER_CLASS = poller.SelectPoller
+
+
+
+
+if __name__ == '__main__':
+    unittest.main()
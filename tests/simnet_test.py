@@ -0,0 +1,271 @@
+"""Test for simnet module"""
+
+# Supress pylint messages concerning missing class docstring
+# pylint: disable=C0111
+
+from functools import partial
+import errno
+import socket
+import time
+import unittest
+
+from inetpy import simnet
+from inetpy.connect import ConnectionPool, connect_tcp
+from inetpy.forward_server import ForwardServer
+from inetpy.socket_pair import socket_pair
+
+
+
+def _listen(net, address=("server", 80)):
+    listener = net.socket()
+    listener.bind(address)
+    listener.listen(socket.SOMAXCONN)
+    return listener
+
+
+
+def _recv_all(sock):
+    chunks = []
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            return b"".join(chunks)
+        chunks.append(data)
+
+
+
+def _transfer(net, size):
+    """Send size bytes from a client to a server and receive them all"""
+    listener = _listen(net)
+    client = connect_tcp("server", 80, transport=net)
+    conn, _ = listener.accept()
+    client.sendall(b"x" * size)
+    client.shutdown(socket.SHUT_WR)
+    return _recv_all(conn)
+
+
+
+class SimNetworkTestCase(unittest.TestCase):
+
+    def test_connect_accept_and_exchange(self):
+        net = simnet.SimNetwork(latency=0.005)
+        listener = _listen(net)
+
+        client = net.socket()
+        client.connect(("server", 80))
+        self.assertAlmostEqual(net.now, 0.010)
+
+        conn, address = listener.accept()
+        self.assertEqual(address, client.getsockname())
+        self.assertEqual(conn.getpeername(), client.getsockname())
+        self.assertEqual(client.getpeername(), ("server", 80))
+
+        client.sendall(b"ping")
+        self.assertEqual(conn.recv(4), b"ping")
+        self.assertAlmostEqual(net.now, 0.015)
+
+        conn.sendall(b"pong")
+        buf = bytearray(8)
+        self.assertEqual(client.recv_into(buf), 4)
+        self.assertEqual(bytes(buf[:4]), b"pong")
+        self.assertAlmostEqual(net.now, 0.020)
+
+
+    def test_half_close(self):
+        net = simnet.SimNetwork()
+        sock1, sock2 = socket_pair(transport=net)
+
+        sock1.sendall(b"abc")
+        sock1.shutdown(socket.SHUT_WR)
+        self.assertEqual(_recv_all(sock2), b"abc")
+        self.assertRaises(socket.error, sock1.sendall, b"more")
+
+        # The opposite direction remains open
+        sock2.sendall(b"123")
+        sock2.close()
+        self.assertEqual(_recv_all(sock1), b"123")
+
+
+    def test_timeouts_and_nonblocking_receive(self):
+        net = simnet.SimNetwork(latency=0.1)
+        sock1, sock2 = net.socketpair()
+
+        sock2.settimeout(0.5)
+        self.assertRaises(socket.timeout, sock2.recv, 1)
+        self.assertAlmostEqual(net.now, 0.5)
+
+        sock1.sendall(b"abc")
+        sock2.setblocking(False)
+        try:
+            sock2.recv(1)
+        except socket.error as exc:
+            self.assertEqual(exc.errno, errno.EAGAIN)
+        else:
+            self.fail("Expected EAGAIN")
+
+        net.sleep(0.1)
+        self.assertEqual(sock2.recv(1, socket.MSG_PEEK), b"a")
+        self.assertEqual(sock2.recv(3), b"abc")
+
+
+    def test_connection_refused(self):
+        net = simnet.SimNetwork()
+        try:
+            connect_tcp("nowhere", 80, transport=net)
+        except socket.error as exc:
+            self.assertEqual(exc.errno, errno.ECONNREFUSED)
+        else:
+            self.fail("Expected ECONNREFUSED")
+
+
+    def test_bandwidth_limits_transfer_time(self):
+        net = simnet.SimNetwork(latency=0.01, bandwidth=1000000)
+        data = _transfer(net, 1000000)
+        self.assertEqual(len(data), 1000000)
+        # Handshake, then 1 second of serialization plus latency
+        self.assertAlmostEqual(net.now, 0.02 + 1.0 + 0.01, places=6)
+
+
+    def test_lossy_transfer_is_reproducible(self):
+        results = []
+        for seed in (7, 7, 8):
+            net = simnet.SimNetwork(seed=seed, latency=0.01, jitter=0.005,
+                                    loss=0.05)
+            self.assertEqual(len(_transfer(net, 500000)), 500000)
+            results.append((net.now, net.stats["retransmits"]))
+
+        self.assertEqual(results[0], results[1])
+        self.assertNotEqual(results[0], results[2])
+        self.assertGreater(results[0][1], 0)
+        # Retransmissions take at least one RTO each
+        self.assertGreater(results[0][0], 0.2)
+
+
+    def test_thousands_of_connections(self):
+        net = simnet.SimNetwork(latency=0.001)
+        listener = _listen(net)
+
+        start = time.time()
+        for i in range(2000):
+            client = connect_tcp("server", 80, transport=net)
+            conn, _ = listener.accept()
+            client.sendall(b"request %d" % (i,))
+            self.assertEqual(conn.recv(64), b"request %d" % (i,))
+            client.close()
+            self.assertEqual(conn.recv(1), b"")
+            conn.close()
+
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(net.stats["connections"], 2000)
+        self.assertAlmostEqual(net.now, 2000 * 0.004)
+
+
+    def test_connection_pool_reuses_simulated_connections(self):
+        net = simnet.SimNetwork()
+        listener = _listen(net)
+        pool = ConnectionPool(connect=partial(connect_tcp, transport=net))
+
+        sock = pool.acquire("server", 80)
+        conn, _ = listener.accept()
+        pool.release(sock)
+        self.assertIs(pool.acquire("server", 80), sock)
+        pool.release(sock)
+
+        # A connection closed by the peer is evicted rather than reused
+        conn.close()
+        net.sleep(0.001)
+        pool.acquire("server", 80)
+        stats = pool.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["evicted_dead"], 1)
+        self.assertEqual(stats["misses"], 2)
+
+
+
+class SimForwarderTestCase(unittest.TestCase):
+
+    def test_forwarding_over_simulated_network(self):
+        net = simnet.SimNetwork(latency=0.002)
+        with simnet.SimForwarder(net, None, ("echo", 7)) as echo:
+            with simnet.SimForwarder(net, echo.server_address) as fwd:
+                socks = [connect_tcp(*fwd.server_address, transport=net)
+                         for _ in range(10)]
+                for i, sock in enumerate(socks):
+                    sock.sendall(b"session %d " % (i,) * 1000)
+                    sock.shutdown(socket.SHUT_WR)
+                for i, sock in enumerate(socks):
+                    self.assertEqual(_recv_all(sock),
+                                     b"session %d " % (i,) * 1000)
+                    sock.close()
+
+            self.assertEqual(fwd.stats["sessions_accepted"], 10)
+            self.assertEqual(echo.stats["sessions_accepted"], 10)
+
+
+    def test_compressed_tunnel_over_simulated_network(self):
+        net = simnet.SimNetwork(latency=0.002)
+        data = b"".join(b"line %d of the log\n" % (i,) for i in range(5000))
+        with simnet.SimForwarder(
+                net, None, ("echo", 7),
+                tunnel=ForwardServer.TUNNEL_DECOMPRESS) as echo:
+            with simnet.SimForwarder(
+                    net, echo.server_address,
+                    tunnel=ForwardServer.TUNNEL_COMPRESS) as fwd:
+                sock = connect_tcp(*fwd.server_address, transport=net)
+                sock.sendall(data)
+                sock.shutdown(socket.SHUT_WR)
+                self.assertEqual(_recv_all(sock), data)
+                sock.close()
+
+        stats = fwd.stats
+        self.assertGreater(stats["tunnel_frames"], 0)
+        self.assertLess(stats["tunnel_wire_bytes"], len(data) // 2)
+
+
+    def test_multiplexed_tunnel_over_simulated_network(self):
+        net = simnet.SimNetwork(latency=0.002)
+        with simnet.SimForwarder(net, None, ("echo", 7)) as echo:
+            with simnet.SimForwarder(
+                    net, echo.server_address, ("demux", 0),
+                    tunnel=ForwardServer.TUNNEL_DEMUX) as peer:
+                with simnet.SimForwarder(
+                        net, peer.server_address,
+                        tunnel=ForwardServer.TUNNEL_MUX,
+                        mux_connections=1) as fwd:
+                    socks = [connect_tcp(*fwd.server_address, transport=net)
+                             for _ in range(5)]
+                    for i, sock in enumerate(socks):
+                        sock.sendall(b"session %d " % (i,) * 10000)
+                        sock.shutdown(socket.SHUT_WR)
+                    for i, sock in enumerate(socks):
+                        self.assertEqual(_recv_all(sock),
+                                         b"session %d " % (i,) * 10000)
+                        sock.close()
+
+        self.assertEqual(fwd.stats["mux_connections"], 1)
+        self.assertEqual(fwd.stats["mux_streams"], 5)
+        self.assertEqual(peer.stats["sessions_accepted"], 1)
+        self.assertEqual(echo.stats["sessions_accepted"], 5)
+
+
+    def test_connect_timeout_in_virtual_time(self):
+        net = simnet.SimNetwork()
+        listener = net.socket()
+        listener.bind(("busy", 80))
+        listener.listen(1)
+        # Fill the backlog
+        connect_tcp("busy", 80, transport=net)
+
+        with simnet.SimForwarder(net, ("busy", 80),
+                                 connect_timeout=5.0) as fwd:
+            sock = connect_tcp(*fwd.server_address, transport=net)
+            self.assertEqual(_recv_all(sock), b"")
+
+        self.assertEqual(fwd.stats["timeouts_connect"], 1)
+        self.assertGreaterEqual(net.now, 5.0)
+
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,12 @@
 """Test for socket_pair.socket_pair()"""
 
+import errno
+import select
 import socket
 import unittest
 
-from inetpy.socket_pair import socket_pair
+from inetpy.socket_pair import (SocketPairPool, WakeupChannel, socket_pair,
+                                socket_pairs)
 
 
 
@@ -30,6 +33,107 @@ class SocketPairTestCase(unittest.TestCase):
         self.assertEqual(sock1.recv(4), "1234")
 
 
+    def testFallbackSocketPairs(self):
+        """socket_pairs() connects pairs over loopback when the transport
+        lacks socketpair()
+        """
+        pairs = socket_pairs(3, family=socket.AF_INET, transport=object())
+        for sock1, sock2 in pairs:
+            self.addCleanup(sock1.close)
+            self.addCleanup(sock2.close)
+            self.assertEqual(sock1.getsockname(), sock2.getpeername())
+
+        for i, (sock1, sock2) in enumerate(pairs):
+            sock1.sendall("pair %d" % (i,))
+            self.assertEqual(sock2.recv(10), "pair %d" % (i,))
+
+        # Defaults to AF_INET, since AF_UNIX can't be bound to loopback
+        sock1, sock2 = socket_pair(transport=object())
+        self.addCleanup(sock1.close)
+        self.addCleanup(sock2.close)
+        self.assertEqual(sock1.family, socket.AF_INET)
+
+        self.assertRaises(ValueError, socket_pairs, 1,
+                          family=socket.AF_UNIX, transport=object())
+
+
+    def testSocketPairsOptions(self):
+        """socket_pairs() applies buffer sizes and non-blocking mode"""
+        pairs = socket_pairs(2, sndbuf=8192, rcvbuf=16384, blocking=False)
+        for sock1, sock2 in pairs:
+            self.addCleanup(sock1.close)
+            self.addCleanup(sock2.close)
+
+        default_sock = socket.socket()
+        self.addCleanup(default_sock.close)
+        default_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 8192)
+        expected_sndbuf = default_sock.getsockopt(socket.SOL_SOCKET,
+                                                  socket.SO_SNDBUF)
+
+        for sock1, sock2 in pairs:
+            for sock in (sock1, sock2):
+                # NOTE: the kernel may round the size up, e.g. double it
+                self.assertEqual(
+                    sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF),
+                    expected_sndbuf)
+                self.assertGreaterEqual(
+                    sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF),
+                    16384)
+                self.assertEqual(sock.gettimeout(), 0.0)
+
+            with self.assertRaises(socket.error) as exc_ctx:
+                sock1.recv(1)
+            self.assertIn(exc_ctx.exception.errno,
+                          (errno.EAGAIN, errno.EWOULDBLOCK))
+
+
+    def testSocketPairPoolRefillsInBatches(self):
+        pool = SocketPairPool(batch_size=4)
+        self.addCleanup(pool.close)
+        # The first batch is ready before the first acquire
+        self.assertEqual(len(pool), 4)
+
+        pairs = [pool.acquire() for _ in range(5)]
+        for sock1, sock2 in pairs:
+            self.addCleanup(sock1.close)
+            self.addCleanup(sock2.close)
+        self.assertEqual(len(pool), 3)
+        self.assertEqual(len(set(pairs)), 5)
+
+        sock1, sock2 = pairs[-1]
+        sock1.sendall("abcd")
+        self.assertEqual(sock2.recv(4), "abcd")
+
+        pool.close()
+        self.assertEqual(len(pool), 0)
+
+
+
+class WakeupChannelTestCase(unittest.TestCase):
+
+    def testSignalsCoalesceUntilDrained(self):
+        channel = WakeupChannel()
+        self.addCleanup(channel.close)
+        self.assertEqual(select.select([channel], [], [], 0)[0], [])
+
+        self.assertTrue(channel.signal())
+        for _ in range(100):
+            self.assertFalse(channel.signal())
+        self.assertEqual(select.select([channel], [], [], 0)[0], [channel])
+
+        # A single byte was written for all of the signals
+        self.assertEqual(channel._rx.recv(4096), "\0")
+
+        channel.drain()
+        self.assertEqual(select.select([channel], [], [], 0)[0], [])
+
+        # A signal after draining wakes the waiter again
+        self.assertTrue(channel.signal())
+        self.assertEqual(select.select([channel], [], [], 0)[0], [channel])
+        channel.drain()
+        self.assertEqual(select.select([channel], [], [], 0)[0], [])
+
+
 
 
 if __name__ == '__main__':
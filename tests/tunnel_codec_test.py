@@ -0,0 +1,132 @@
+"""Test for tunnel_codec module"""
+
+# Supress pylint messages concerning missing class docstring
+# pylint: disable=C0111
+
+import os
+import time
+import unittest
+
+from inetpy import tunnel_codec
+from inetpy.forward_server import _SERVER_COUNTER_NAMES
+from inetpy.forward_stats import _SharedCounters
+
+
+
+class StreamCodecTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.counters = _SharedCounters(_SERVER_COUNTER_NAMES)
+        self.wire = []
+        self.decoded = []
+
+
+    def _round_trip(self, codec_name, chunks):
+        compressor = tunnel_codec.StreamCompressor(
+            tunnel_codec.get_codec(codec_name),
+            self.wire.append,
+            lambda timeout: False,
+            self.counters)
+        for chunk in chunks:
+            compressor.send(chunk)
+        compressor.flush()
+
+        decompressor = tunnel_codec.StreamDecompressor(self.decoded.append,
+                                                       self.counters)
+        # Feed the wire stream in odd-sized pieces to exercise reassembly
+        wire = b"".join(self.wire)
+        for offset in range(0, len(wire), 7):
+            decompressor.send(wire[offset:offset + 7])
+        decompressor.flush()
+
+        return b"".join(self.decoded), wire
+
+
+    def test_round_trip_all_available_codecs(self):
+        chunks = [(b"hello tunnel %d " % (i,)) * 50 for i in range(20)]
+        for name in tunnel_codec.available_codecs():
+            self.wire = []
+            self.decoded = []
+            decoded, wire = self._round_trip(name, chunks)
+            self.assertEqual(decoded, b"".join(chunks), name)
+            self.assertLess(len(wire), len(decoded) / 5, name)
+
+
+    def test_incompressible_data_bypasses_codec(self):
+        chunks = [os.urandom(4096) for _ in range(10)]
+        decoded, wire = self._round_trip("zlib", chunks)
+        self.assertEqual(decoded, b"".join(chunks))
+
+        stats = self.counters.snapshot()
+        self.assertEqual(stats["tunnel_bypasses"], 1)
+        self.assertEqual(stats["tunnel_frames"], 10)
+        # Everything after the bypass kicked in goes out raw, with only the
+        # frame header as overhead
+        self.assertLess(len(wire), len(decoded) * 1.01 + 100)
+
+
+    def test_held_data_is_coalesced_into_one_frame(self):
+        compressor = tunnel_codec.StreamCompressor(
+            tunnel_codec.get_codec("zlib"),
+            self.wire.append,
+            lambda timeout: True,
+            self.counters,
+            latency_budget=10)
+        for _ in range(5):
+            compressor.send(b"abc")
+        self.assertEqual(self.wire, [])
+
+        compressor.flush()
+        self.assertEqual(len(self.wire), 1)
+        self.assertEqual(self.counters.snapshot()["tunnel_plain_bytes"], 15)
+
+
+    def test_codec_cpu_time_is_reported(self):
+        compressor = tunnel_codec.StreamCompressor(
+            tunnel_codec.get_codec("zlib"),
+            self.wire.append,
+            lambda timeout: False,
+            self.counters)
+        line = b"2016-01-01 12:00:00 INFO connection accepted from 10.0.0.1\n"
+        chunk = line * (64 * 1024 // len(line))
+        for _ in range(4 * 1024 * 1024 // len(chunk)):
+            compressor.send(chunk)
+        compressor.flush()
+
+        self.assertGreater(self.counters.snapshot()["tunnel_codec_usec"], 0)
+
+
+    def test_cpu_clock_counts_cpu_time(self):
+        # pylint: disable=W0212
+        deadline = time.time() + 0.05
+        start = tunnel_codec._cpu_now()
+        while time.time() < deadline:
+            pass
+        self.assertGreater(tunnel_codec._cpu_now(), start)
+
+
+    def test_truncated_stream_is_rejected(self):
+        _, wire = self._round_trip("zlib", [b"abcdef" * 100])
+
+        decompressor = tunnel_codec.StreamDecompressor(self.decoded.append,
+                                                       self.counters)
+        decompressor.send(wire[:-1])
+        with self.assertRaises(ValueError):
+            decompressor.flush()
+
+
+    def test_garbage_stream_is_rejected(self):
+        decompressor = tunnel_codec.StreamDecompressor(self.decoded.append,
+                                                       self.counters)
+        with self.assertRaises(ValueError):
+            decompressor.send(b"GET / HTTP/1.0\r\n")
+
+
+    def test_unavailable_codec(self):
+        with self.assertRaises(ValueError):
+            tunnel_codec.get_codec("no-such-codec")
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,206 @@
+"""Test for tunnel_mux module"""
+
+# Supress pylint messages concerning missing class docstring
+# pylint: disable=C0111
+
+import errno
+import socket
+import threading
+import unittest
+
+from inetpy import tunnel_mux
+from inetpy.forward_server import _SERVER_COUNTER_NAMES
+from inetpy.forward_stats import _SharedCounters
+from inetpy.socket_pair import socket_pair
+
+
+
+def _recv_all(stream):
+    chunks = []
+    buf = bytearray(65536)
+    while True:
+        nbytes = stream.recv_into(buf)
+        if not nbytes:
+            return b"".join(chunks)
+        chunks.append(bytes(buf[:nbytes]))
+
+
+
+class MuxConnectionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.counters = _SharedCounters(_SERVER_COUNTER_NAMES)
+        self.accepted = []
+        self.opened = threading.Semaphore(0)
+
+        def on_open(stream):
+            self.accepted.append(stream)
+            self.opened.release()
+
+        sock1, sock2 = socket_pair()
+        self.client = tunnel_mux.MuxConnection(sock1, self.counters,
+                                               tunnel_mux.INITIAL_WINDOW)
+        self.server = tunnel_mux.MuxConnection(sock2, self.counters,
+                                               tunnel_mux.INITIAL_WINDOW,
+                                               on_open=on_open)
+        for connection in (self.client, self.server):
+            reader = threading.Thread(target=connection.run)
+            reader.setDaemon(True)
+            reader.start()
+        self.addCleanup(self.client.close)
+
+
+    def _open(self):
+        """:returns: (client_stream, server_stream)"""
+        stream = self.client.open_stream()
+        self.opened.acquire()
+        return stream, self.accepted[-1]
+
+
+    def test_streams_exchange_and_half_close_independently(self):
+        streams = [self._open() for _ in range(3)]
+        for i, (client_stream, _) in enumerate(streams):
+            client_stream.sendall(b"request %d " % (i,) * 1000)
+            client_stream.shutdown(socket.SHUT_WR)
+
+        for i, (client_stream, server_stream) in enumerate(streams):
+            self.assertEqual(_recv_all(server_stream),
+                             b"request %d " % (i,) * 1000)
+            # The opposite direction remains open
+            server_stream.sendall(b"response %d" % (i,))
+            server_stream.shutdown(socket.SHUT_WR)
+            self.assertEqual(_recv_all(client_stream), b"response %d" % (i,))
+
+        for client_stream, server_stream in streams:
+            client_stream.close()
+            server_stream.close()
+
+        self.assertEqual(self.client.stream_count, 0)
+        self.assertEqual(self.server.stream_count, 0)
+        self.assertEqual(self.counters.snapshot()["mux_resets"], 0)
+
+
+    def test_full_window_blocks_only_its_own_stream(self):
+        slow_sender, slow_receiver = self._open()
+        client_stream, server_stream = self._open()
+
+        # Nobody receives from the slow stream, so its sender stalls once it
+        # has sent a window's worth
+        done = threading.Event()
+        def send_lots():
+            try:
+                slow_sender.sendall(b"x" * (4 * tunnel_mux.INITIAL_WINDOW))
+            except socket.error:
+                pass
+            done.set()
+        sender = threading.Thread(target=send_lots)
+        sender.setDaemon(True)
+        sender.start()
+
+        self.assertFalse(done.wait(0.5))
+        self.assertEqual(self.counters.snapshot()["mux_window_waits"], 1)
+
+        client_stream.sendall(b"ping")
+        client_stream.shutdown(socket.SHUT_WR)
+        self.assertEqual(_recv_all(server_stream), b"ping")
+
+        # Receiving grants more window
+        buf = bytearray(4 * tunnel_mux.INITIAL_WINDOW)
+        received = 0
+        while received < len(buf):
+            received += slow_receiver.recv_into(memoryview(buf)[received:])
+        self.assertTrue(done.wait(10))
+
+
+    def test_close_resets_the_peer_stream(self):
+        client_stream, server_stream = self._open()
+        server_stream.close()
+
+        self.assertRaises(socket.error, client_stream.recv_into,
+                          bytearray(10))
+        try:
+            client_stream.sendall(b"data")
+        except socket.error as exc:
+            self.assertEqual(exc.errno, errno.EPIPE)
+        else:
+            self.fail("Expected EPIPE")
+        self.assertEqual(self.counters.snapshot()["mux_resets"], 2)
+
+
+    def test_connection_failure_resets_streams(self):
+        client_stream, _ = self._open()
+        self.server.close()
+
+        try:
+            client_stream.recv_into(bytearray(10))
+        except socket.error as exc:
+            self.assertEqual(exc.errno, errno.ECONNRESET)
+        else:
+            self.fail("Expected ECONNRESET")
+        self.assertTrue(self.client.closed)
+        self.assertRaises(socket.error, self.client.open_stream)
+
+
+    def test_close_before_pending_receive_is_clean(self):
+        traces = []
+        original_trace = tunnel_mux._trace  # pylint: disable=W0212
+        tunnel_mux._trace = lambda fmt, *args: traces.append(fmt % args)
+        self.addCleanup(setattr, tunnel_mux, "_trace", original_trace)
+
+        sock1, sock2 = socket_pair()
+        self.addCleanup(sock2.close)
+        connection = tunnel_mux.MuxConnection(sock1, self.counters,
+                                              tunnel_mux.INITIAL_WINDOW)
+        connection.close()
+        # As if the reader got to its receive only after the socket closed
+        connection.run()
+        self.assertEqual(traces, [])
+
+
+
+class MuxClientTestCase(unittest.TestCase):
+
+    def test_slow_connect_doesnt_hold_up_other_streams(self):
+        counters = _SharedCounters(_SERVER_COUNTER_NAMES)
+        release = threading.Event()
+        socks = []
+
+        def connect():
+            sock1, sock2 = socket_pair()
+            self.addCleanup(sock2.close)
+            socks.append(sock1)
+            if len(socks) == 1:
+                release.wait(10)
+            return sock1
+
+        client = tunnel_mux.MuxClient(connect, 2, counters,
+                                      tunnel_mux.INITIAL_WINDOW)
+        slow_opener = threading.Thread(target=client.open_stream)
+        slow_opener.setDaemon(True)
+        slow_opener.start()
+        self.addCleanup(release.set)
+        while not socks:
+            release.wait(0.01)
+
+        # Goes to the other connection rather than waiting for the first one
+        fast_opener = threading.Thread(target=client.open_stream)
+        fast_opener.setDaemon(True)
+        fast_opener.start()
+        fast_opener.join(5)
+        self.assertFalse(fast_opener.is_alive())
+
+        release.set()
+        slow_opener.join(10)
+        self.assertFalse(slow_opener.is_alive())
+
+        # Both connections are up now; no slot was connected twice
+        client.open_stream()
+        self.assertEqual(len(socks), 2)
+        self.assertEqual(counters.snapshot()["mux_connections"], 2)
+        self.assertEqual(counters.snapshot()["mux_streams"], 3)
+
+
+
+
+if __name__ == '__main__':
+    unittest.main()